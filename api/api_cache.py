@@ -0,0 +1,133 @@
+"""
+Server-side cache of API responses.
+
+Finished matches and their games never change, so their JSON is cached
+indefinitely, and served with a strong ETag and an "immutable"
+Cache-Control header.  Anything that can still change (e.g. a match in
+progress) is cached for a few seconds only.  Entries are kept in a
+bounded in-memory LRU cache, and immutable ones can also be written to
+disk (API_CACHE_DIR) so that they survive restarts and are shared
+between workers.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+# maximum number of responses kept in memory
+API_CACHE_SIZE = int(os.environ.get("API_CACHE_SIZE") or 4096)
+# optional directory in which immutable responses are also stored
+API_CACHE_DIR = os.environ.get("API_CACHE_DIR")
+# seconds for which responses that may still change are cached
+MUTABLE_TTL = 10
+# one year, the conventional max-age for immutable responses
+IMMUTABLE_MAX_AGE = 31536000
+
+
+class CacheEntry:
+    """
+    A serialized response, with its ETag.
+    """
+
+    def __init__(self, body, immutable=False, expires=None, etag=None):
+        self.body = body
+        self.immutable = immutable
+        self.expires = expires
+        if etag is None:
+            etag = hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+        self.etag = etag
+
+    @property
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    @property
+    def cache_control(self):
+        if self.immutable:
+            return "public, max-age={}, immutable".format(IMMUTABLE_MAX_AGE)
+        return "public, max-age={}".format(MUTABLE_TTL)
+
+
+class ResponseCache:
+    """
+    LRU cache of CacheEntry objects, keyed by e.g. "matches/12".
+
+    Usage:
+        entry = cache.get(key)
+        if entry is None:
+            entry = cache.set(key, data, immutable=is_finished)
+    """
+
+    def __init__(
+        self,
+        max_entries=API_CACHE_SIZE,
+        cache_dir=API_CACHE_DIR,
+        ttl=MUTABLE_TTL,
+    ):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "{}.json".format(name))
+
+    def get(self, key):
+        """
+        Return the cached entry for key, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not entry.expired:
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key)) as cache_file:
+                stored = json.load(cache_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        entry = CacheEntry(stored["body"], immutable=True, etag=stored["etag"])
+        self._remember(key, entry)
+        return entry
+
+    def set(self, key, data, immutable=False):
+        """
+        Serialize data and cache it, indefinitely if immutable, otherwise
+        for ttl seconds.
+
+        Returns:
+            the new CacheEntry
+        """
+        body = json.dumps(data)
+        expires = None if immutable else time.time() + self.ttl
+        entry = CacheEntry(body, immutable=immutable, expires=expires)
+        self._remember(key, entry)
+        if immutable and self.cache_dir:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump({"etag": entry.etag, "body": body}, tmp_file)
+            os.replace(tmp_path, self._path(key))
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,9 +1,53 @@
 """
 Functions used by the RL Tournament API
 """
-from flask import jsonify
+import json
+import logging
+import datetime
 
-from battleground.schema import Team, Agent, Tournament, Match, Game, session
+from flask import jsonify, Response, stream_with_context
+from sqlalchemy import case, func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import aliased, joinedload
+
+from battleground.schema import (
+    Team,
+    Agent,
+    Tournament,
+    Match,
+    Game,
+    assoc_table,
+    session,
+    PELICAN_WIN_CODES,
+    PANTHER_WIN_CODES,
+)
+
+logger = logging.getLogger(__name__)
+
+# columns that can be requested with ?fields= for each listing
+TEAM_FIELDS = {
+    "team_id": Team.team_id,
+    "team_name": Team.team_name,
+    "team_members": Team.team_members,
+}
+AGENT_FIELDS = {
+    "agent_id": Agent.agent_id,
+    "agent_name": Agent.agent_name,
+    "agent_type": Agent.agent_type,
+    "team_id": Agent.team_id,
+}
+TOURNAMENT_FIELDS = {
+    "tournament_id": Tournament.tournament_id,
+    "tournament_time": Tournament.tournament_time,
+}
+
+
+def add_headers(response):
+    response.headers.add(
+        "Access-Control-Allow-Headers",
+        "Origin, X-Requested-With, Content-Type, Accept, x-auth",
+    )
+    return response
 
 
 def create_response(orig_response):
@@ -11,120 +55,370 @@ def create_response(orig_response):
     Add headers to the response
     """
     response = jsonify(orig_response)
-    response.headers.add(
-        "Access-Control-Allow-Headers",
-        "Origin, X-Requested-With, Content-Type, Accept, x-auth",
+    return add_headers(response)
+
+
+def create_streamed_response(items):
+    """
+    Return a list (or any iterable, which may still be querying the
+    database as it is sent) as JSON, serialized one item at a time
+    rather than all at once.  If items is a Page with more results to
+    come, the after_id for the next page is given in the
+    X-Next-After-Id header.
+    """
+
+    def generate():
+        yield "["
+        for i, item in enumerate(items):
+            if i > 0:
+                yield ","
+            yield json.dumps(item)
+        yield "]"
+
+    # keep the request context (and so its db session) until the last
+    # item has been sent
+    response = add_headers(
+        Response(stream_with_context(generate()), mimetype="application/json")
     )
+    next_after_id = getattr(items, "next_after_id", None)
+    if next_after_id is not None:
+        response.headers["X-Next-After-Id"] = str(next_after_id)
+        response.headers.add(
+            "Access-Control-Expose-Headers", "X-Next-After-Id"
+        )
     return response
 
 
-def list_teams(dbsession=session):
+class Page(list):
+    """
+    A page of results from a listing, with the after_id to request the
+    next page with (None if this is the last page).
+    """
+
+    def __init__(self, items=(), next_after_id=None):
+        super().__init__(items)
+        self.next_after_id = next_after_id
+
+
+def paginate(query, id_column, limit=None, after_id=None):
+    """
+    Keyset pagination: the rows of query with id_column greater than
+    after_id, in id order, and at most limit of them.  The query must
+    select id_column first.
+
+    Returns:
+        rows - list of rows
+        next_after_id - id of the last row, if there are more rows
+    """
+    if after_id is not None:
+        query = query.filter(id_column > after_id)
+    query = query.order_by(id_column)
+    if limit is None:
+        return query.all(), None
+    # fetch one more row, to find out if there is another page
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1][0]
+    return rows, None
+
+
+def format_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat().split(".")[0]
+    return value
+
+
+def project(rows, fields):
+    """
+    Turn rows of (id, field1, field2, ...) into dicts of the fields.
+    """
+    return [
+        {field: format_value(value) for field, value in zip(fields, row[1:])}
+        for row in rows
+    ]
+
+
+def list_teams(limit=None, after_id=None, fields=None, dbsession=session):
+    """
+    Return a list of team names, or of dicts of the given fields
+    (see TEAM_FIELDS).
+    """
+    columns = [TEAM_FIELDS[f] for f in fields or ["team_name"]]
     try:
-        teams = dbsession.query(Team).all()
-        team_names = [team.team_name for team in teams]
-        dbsession.expunge_all()
-        return team_names
+        rows, next_after_id = paginate(
+            dbsession.query(Team.team_id, *columns),
+            Team.team_id,
+            limit,
+            after_id,
+        )
     except:
         dbsession.rollback()
-        return []
+        return Page()
+    if fields:
+        return Page(project(rows, fields), next_after_id)
+    return Page([row[1] for row in rows], next_after_id)
 
 
 def list_agents(
-    tournament="all", agent_type="all", team="all", dbsession=session
+    tournament="all",
+    agent_type="all",
+    team="all",
+    limit=None,
+    after_id=None,
+    fields=None,
+    dbsession=session,
 ):
     """
-    Return a list of agent names.
+    Return a list of agent names, or of dicts of the given fields (see
+    AGENT_FIELDS), optionally only those of one type, from one team
+    and/or in one tournament (in one query).
     """
+    columns = [AGENT_FIELDS[f] for f in fields or ["agent_name"]]
     try:
-        agents_query = dbsession.query(Agent)
+        agents_query = dbsession.query(Agent.agent_id, *columns)
         if agent_type != "all":
-            agents_query = agents_query.filter_by(agent_type=agent_type)
+            agents_query = agents_query.filter(Agent.agent_type == agent_type)
         if team != "all":
-            agents_query = agents_query.filter(Agent.team.has(team_name=team))
-            agents = agents_query.all()
+            agents_query = agents_query.join(
+                Team, Agent.team_id == Team.team_id
+            ).filter(Team.team_name == team)
+        if tournament != "all":
+            agents_query = agents_query.join(
+                assoc_table, assoc_table.c.agent_id == Agent.agent_id
+            ).filter(assoc_table.c.tournament_id == int(tournament))
+        rows, next_after_id = paginate(
+            agents_query, Agent.agent_id, limit, after_id
+        )
     except:
         dbsession.rollback()
-        return []
-    if tournament != "all":
-        agents = [a for a in agents if int(tournament) in \
-                  [t.tournament_id for t in a.tournaments]]
-    agent_names = [agent.agent_name for agent in agents]
-    dbsession.expunge_all()
-    return agent_names
+        return Page()
+    if fields:
+        return Page(project(rows, fields), next_after_id)
+    return Page([row[1] for row in rows], next_after_id)
 
 
-def list_tournaments(dbsession=session):
+def list_tournaments(
+    limit=None, after_id=None, fields=None, dbsession=session
+):
+    """
+    Return a list of dicts of the given fields (see TOURNAMENT_FIELDS)
+    for each tournament, by default its id and time.
+    """
+    if not fields:
+        fields = ["tournament_id", "tournament_time"]
+    columns = [TOURNAMENT_FIELDS[f] for f in fields]
     try:
-        tournaments = dbsession.query(Tournament).all()
+        rows, next_after_id = paginate(
+            dbsession.query(Tournament.tournament_id, *columns),
+            Tournament.tournament_id,
+            limit,
+            after_id,
+        )
     except:
         dbsession.rollback()
-        return []
-    tournament_list = [
-        {
-            "tournament_id": t.tournament_id,
-            "tournament_time": t.tournament_time.isoformat().split(".")[0],
-        }
-        for t in tournaments
-    ]
-    dbsession.expunge_all()
-    return tournament_list
+        return Page()
+    return Page(project(rows, fields), next_after_id)
 
 
 def list_matches(tournament_id="all", dbsession=session):
+    """
+    Return a list of matches, with their agents' names (in one query).
+    """
+    pelican = aliased(Agent)
+    panther = aliased(Agent)
     try:
-        matches_query = dbsession.query(Match)
+        matches_query = (
+            dbsession.query(
+                Match.match_id,
+                Match.match_time,
+                pelican.agent_name,
+                panther.agent_name,
+            )
+            .outerjoin(pelican, Match.pelican_agent_id == pelican.agent_id)
+            .outerjoin(panther, Match.panther_agent_id == panther.agent_id)
+            .order_by(Match.match_id)
+        )
         if tournament_id != "all":
-            matches_query = matches_query.filter_by(tournament_id=tournament_id)
+            matches_query = matches_query.filter(
+                Match.tournament_id == tournament_id
+            )
         matches = matches_query.all()
     except:
         dbsession.rollback()
         return []
     match_list = [
         {
-            "match_id": m.match_id,
-            "match_time": m.match_time.isoformat().split(".")[0],
-            "pelican": m.pelican_agent.agent_name,
-            "panther": m.panther_agent.agent_name,
+            "match_id": match_id,
+            "match_time": match_time.isoformat().split(".")[0],
+            "pelican": pelican_name,
+            "panther": panther_name,
         }
-        for m in matches
+        for match_id, match_time, pelican_name, panther_name in matches
     ]
-    dbsession.expunge_all()
     return match_list
 
 
 def get_tournament(tournament_id, dbsession=session):
+    """
+    Return info on a tournament, in three queries: the tournament, its
+    agents and its match ids.
+    """
     try:
         tournament = (
-            dbsession.query(Tournament)
+            dbsession.query(
+                Tournament.tournament_id, Tournament.tournament_time
+            )
             .filter_by(tournament_id=tournament_id)
             .first()
         )
+        if not tournament:
+            return {}
+        agents = (
+            dbsession.query(Agent.agent_name, Agent.agent_type)
+            .join(assoc_table, assoc_table.c.agent_id == Agent.agent_id)
+            .filter(assoc_table.c.tournament_id == tournament_id)
+            .order_by(Agent.agent_id)
+            .all()
+        )
+        match_ids = (
+            dbsession.query(Match.match_id)
+            .filter_by(tournament_id=tournament_id)
+            .order_by(Match.match_id)
+            .all()
+        )
     except:
         dbsession.rollback()
         return {}
-    if not tournament:
-        return {}
     tournament_info = {
         "tournament_id": tournament.tournament_id,
         "tournament_time": tournament.tournament_time.isoformat().split(".")[
             0
         ],
         "pelican_agents": [
-            a.agent_name
-            for a in tournament.agents
-            if a.agent_type == "pelican"
+            agent_name
+            for agent_name, agent_type in agents
+            if agent_type == "pelican"
         ],
         "panther_agents": [
-            a.agent_name
-            for a in tournament.agents
-            if a.agent_type == "panther"
+            agent_name
+            for agent_name, agent_type in agents
+            if agent_type == "panther"
         ],
-        "matches": [m.match_id for m in tournament.matches],
+        "matches": [match_id for match_id, in match_ids],
     }
-    dbsession.expunge_all()
     return tournament_info
 
 
+def get_tournament_results(tournament_id, dbsession=session):
+    """
+    Return a list with the details and scores of every match in a
+    tournament, all computed by one aggregate query.  Database errors
+    are logged and re-raised, rather than returning empty results that
+    would look like a tournament without matches.
+    """
+    pelican = aliased(Agent)
+    panther = aliased(Agent)
+    match_columns = [
+        Match.match_id,
+        Match.match_time,
+        pelican.agent_name,
+        panther.agent_name,
+        Match.game_config,
+        Match.logfile_url,
+        Match.num_games,
+    ]
+    pelican_win = case([(Game.result_code.in_(PELICAN_WIN_CODES), 1)], else_=0)
+    panther_win = case([(Game.result_code.in_(PANTHER_WIN_CODES), 1)], else_=0)
+    try:
+        rows = (
+            dbsession.query(
+                *match_columns,
+                func.count(Game.game_id),
+                func.sum(pelican_win),
+                func.sum(panther_win),
+            )
+            .outerjoin(pelican, Match.pelican_agent_id == pelican.agent_id)
+            .outerjoin(panther, Match.panther_agent_id == panther.agent_id)
+            .outerjoin(Game, Game.match_id == Match.match_id)
+            .filter(Match.tournament_id == tournament_id)
+            .group_by(*match_columns)
+            .order_by(Match.match_id)
+            .all()
+        )
+    except SQLAlchemyError as e:
+        logger.error(
+            "Failed to get results of tournament {}: {}".format(
+                tournament_id, e
+            )
+        )
+        dbsession.rollback()
+        raise
+    results = []
+    for (
+        match_id,
+        match_time,
+        pelican_name,
+        panther_name,
+        game_config,
+        logfile_url,
+        num_games,
+        games_played,
+        pelican_score,
+        panther_score,
+    ) in rows:
+        pelican_score = int(pelican_score or 0)
+        panther_score = int(panther_score or 0)
+        winner = "Tie"
+        if games_played == num_games:
+            if pelican_score > panther_score:
+                winner = pelican_name
+            elif panther_score > pelican_score:
+                winner = panther_name
+        results.append(
+            {
+                "match_id": match_id,
+                "match_time": match_time.isoformat().split(".")[0],
+                "pelican": pelican_name,
+                "panther": panther_name,
+                "config": game_config,
+                "logfile": logfile_url,
+                "num_games": num_games,
+                "games_played": games_played,
+                "pelican_score": pelican_score,
+                "panther_score": panther_score,
+                "winner": winner,
+            }
+        )
+    return results
+
+
+def results_to_columns(results):
+    """
+    Rearrange tournament results into columns, with one row per agent
+    per match, in the layout used by the frontend's tournament plot.
+    """
+    columns = {
+        "match_id": [],
+        "panther": [],
+        "pelican": [],
+        "agent_type": [],
+        "score": [],
+        "configs": [],
+        "logfiles": [],
+    }
+    for result in results:
+        for agent_type in ["panther", "pelican"]:
+            columns["match_id"].append(result["match_id"])
+            columns["panther"].append(result["panther"])
+            columns["pelican"].append(result["pelican"])
+            columns["agent_type"].append(agent_type)
+            columns["score"].append(result["{}_score".format(agent_type)])
+            columns["configs"].append(result["config"])
+            columns["logfiles"].append(result["logfile"])
+    return columns
+
+
 def get_match_id(tournament_id, panther, pelican, dbsession=session):
     try:
         match = (
@@ -145,13 +439,32 @@ def get_match_id(tournament_id, panther, pelican, dbsession=session):
 
 
 def get_match(match_id, dbsession=session):
+    """
+    Return info on a match, in two queries: the match (with its agents,
+    and its scores counted by the database) and its game ids.
+    """
     try:
-        match = dbsession.query(Match).filter_by(match_id=match_id).first()
+        match = (
+            dbsession.query(Match)
+            .options(
+                joinedload(Match.pelican_agent),
+                joinedload(Match.panther_agent),
+            )
+            .filter_by(match_id=match_id)
+            .first()
+        )
+        if not match:
+            return {}
+        game_ids = (
+            dbsession.query(Game.game_id)
+            .filter_by(match_id=match_id)
+            .order_by(Game.game_id)
+            .all()
+        )
     except:
         dbsession.rollback()
         return {}
-    if not match:
-        return {}
+    winning_agent = match.winning_agent
     match_info = {
         "match_id": match.match_id,
         "match_time": match.match_time.isoformat().split(".")[0],
@@ -160,10 +473,10 @@ def get_match(match_id, dbsession=session):
         "logfile": match.logfile_url,
         "config": match.game_config,
         "num_games": match.num_games,
-        "panther_score": match.score("panther"),
-        "pelican_score": match.score("pelican"),
-        "winner": match.winning_agent.agent_name if match.winning_agent else "Tie",
-        "games": [g.game_id for g in match.games],
+        "panther_score": match.panther_score,
+        "pelican_score": match.pelican_score,
+        "winner": winning_agent.agent_name if winning_agent else "Tie",
+        "games": [game_id for game_id, in game_ids],
     }
     dbsession.expunge_all()
     return match_info
@@ -171,7 +484,15 @@ def get_match(match_id, dbsession=session):
 
 def get_game(game_id, dbsession=session):
     try:
-        game = dbsession.query(Game).filter_by(game_id=game_id).first()
+        game = (
+            dbsession.query(Game)
+            .options(
+                joinedload(Game.match).joinedload(Match.pelican_agent),
+                joinedload(Game.match).joinedload(Match.panther_agent),
+            )
+            .filter_by(game_id=game_id)
+            .first()
+        )
     except:
         dbsession.rollback()
         return {}
@@ -5,20 +5,62 @@ API for returning info from the database
 HTTP requests to the endpoints defined here will give rise
 to calls to functions in api_utils.py
 """
-from flask import Blueprint, Flask, jsonify
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    jsonify,
+    redirect,
+    request,
+    url_for,
+)
 from flask_cors import CORS
 from flask_session import Session
+from sqlalchemy.exc import SQLAlchemyError
 
+from battleground.schema import session, LOGFILE_PENDING
+from api_cache import ResponseCache
 from api_utils import (
     list_agents,
     list_teams,
     list_tournaments,
     get_tournament,
+    get_tournament_results,
+    results_to_columns,
     get_match,
     get_game,
     create_response,
+    create_streamed_response,
+    add_headers,
+    TEAM_FIELDS,
+    AGENT_FIELDS,
+    TOURNAMENT_FIELDS,
 )
 
+# largest page that can be requested with ?limit=
+MAX_PAGE_SIZE = 1000
+
+# responses for matches and games
+response_cache = ResponseCache()
+
+# seconds after which clients should ask again for a video that is
+# being regenerated
+VIDEO_RETRY_AFTER = 10
+
+logger = logging.getLogger(__name__)
+
+# videos of games played in "replay" record mode are regenerated on a
+# worker thread, rather than inside the request.  video_jobs holds the
+# future of each regeneration in progress, by game_id.
+video_executor = ThreadPoolExecutor(max_workers=1)
+video_jobs = {}
+video_jobs_lock = threading.Lock()
+
 
 class ApiException(Exception):
     status_code = 500
@@ -50,13 +92,69 @@ def handle_exception(error):
     return response
 
 
+def listing_args(allowed_fields):
+    """
+    Read the optional query parameters of a listing:
+        limit - maximum number of results (at most MAX_PAGE_SIZE)
+        after_id - only return results with a greater id, i.e. the
+            X-Next-After-Id header of the previous page
+        fields - comma-separated list of fields to return
+    """
+    args = {}
+    for name, minimum in [("limit", 1), ("after_id", 0)]:
+        if name in request.args:
+            value = request.args.get(name, type=int)
+            if value is None or value < minimum:
+                raise ApiException(
+                    "{} must be an integer, at least {}".format(name, minimum),
+                    400,
+                )
+            args[name] = value
+    if "limit" in args:
+        args["limit"] = min(args["limit"], MAX_PAGE_SIZE)
+    if request.args.get("fields"):
+        fields = request.args["fields"].split(",")
+        unknown = [f for f in fields if f not in allowed_fields]
+        if unknown:
+            raise ApiException(
+                "unknown fields {}, must be from {}".format(
+                    unknown, list(allowed_fields)
+                ),
+                400,
+            )
+        args["fields"] = fields
+    return args
+
+
+def listing_response(list_function, allowed_fields, **filters):
+    """
+    Stream the results of a listing, e.g. list_teams.  If no limit is
+    requested, the results are read from the database a page of
+    MAX_PAGE_SIZE at a time, as they are sent, so that a long listing
+    is never held in memory all at once.
+    """
+    args = listing_args(allowed_fields)
+    if "limit" in args:
+        return create_streamed_response(list_function(**filters, **args))
+    args["limit"] = MAX_PAGE_SIZE
+
+    def all_pages():
+        while True:
+            page = list_function(**filters, **args)
+            yield from page
+            if page.next_after_id is None:
+                return
+            args["after_id"] = page.next_after_id
+
+    return create_streamed_response(all_pages())
+
+
 @blueprint.route("/teams", methods=["GET"])
 def get_team_list():
     """
     Return a list of all teams
     """
-    team_list = list_teams()
-    return create_response(team_list)
+    return listing_response(list_teams, TEAM_FIELDS)
 
 
 @blueprint.route("/tournaments", methods=["GET"])
@@ -64,8 +162,7 @@ def get_tournament_list():
     """
     Return a list of all tournaments
     """
-    tournaments = list_tournaments()
-    return create_response(tournaments)
+    return listing_response(list_tournaments, TOURNAMENT_FIELDS)
 
 
 @blueprint.route("/tournaments/<tid>", methods=["GET"])
@@ -77,13 +174,38 @@ def get_tournament_info(tid):
     return create_response(tournament)
 
 
+@blueprint.route("/tournaments/<tid>/results", methods=["GET"])
+def get_tournament_results_info(tid):
+    """
+    Return the details and scores of every match in tournament tid.
+    With ?format=columns, return them as columns, one row per agent per
+    match, ready to be plotted.
+    """
+    columnar = request.args.get("format") == "columns"
+
+    def build():
+        try:
+            results = get_tournament_results(tid)
+        except SQLAlchemyError:
+            # raised before anything is cached
+            raise ApiException("Unable to query tournament results", 500)
+        if columnar:
+            results = results_to_columns(results)
+        # matches can still be added to (or finish within) a tournament
+        return results, False
+
+    key = "tournaments/{}/results{}".format(
+        tid, "/columns" if columnar else ""
+    )
+    return cached_response(key, build)
+
+
 @blueprint.route("/agents/<team_name>", methods=["GET"])
 def get_agent_list(team_name):
     """
     Return a list of all agents for a given team
     """
-    agents = list_agents(team=team_name)
-    return create_response(agents)
+    return listing_response(list_agents, AGENT_FIELDS, team=team_name)
 
 
 @blueprint.route("/pelicans/<tid>", methods=["GET"])
@@ -91,8 +213,9 @@ def get_pelican_list(tid):
     """
     Return a list of all agents for a given team
     """
-    agents = list_agents(tournament=tid, agent_type="pelican")
-    return create_response(agents)
+    return listing_response(
+        list_agents, AGENT_FIELDS, tournament=tid, agent_type="pelican"
+    )
 
 
 @blueprint.route("/panthers/<tid>", methods=["GET"])
@@ -100,8 +223,33 @@ def get_panther_list(tid):
     """
     Return a list of all agents for a given team
     """
-    agents = list_agents(tournament=tid, agent_type="panther")
-    return create_response(agents)
+    return listing_response(
+        list_agents, AGENT_FIELDS, tournament=tid, agent_type="panther"
+    )
+
+
+def cached_response(key, build):
+    """
+    Return the cached response for key, or build it and cache it.
+    Answers If-None-Match requests for a cached response with 304
+    Not Modified, without querying the database.
+
+    Arguments:
+        key - cache key, e.g. "matches/12"
+        build - function returning (data, immutable), where immutable
+            says whether the data can never change
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        data, immutable = build()
+        entry = response_cache.set(key, data, immutable=immutable)
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, mimetype="application/json")
+    response.set_etag(entry.etag)
+    response.headers["Cache-Control"] = entry.cache_control
+    return add_headers(response)
 
 
 @blueprint.route("/matches/<mid>", methods=["GET"])
@@ -109,8 +257,19 @@ def get_match_info(mid):
     """
     Return details of match with match_id == mid
     """
-    match = get_match(mid)
-    return create_response(match)
+
+    def build():
+        match = get_match(mid)
+        # a match never changes once all its games have been played and
+        # the battleground has then saved its logfile
+        finished = (
+            bool(match)
+            and len(match["games"]) == match["num_games"]
+            and match["logfile"] != LOGFILE_PENDING
+        )
+        return match, finished
+
+    return cached_response("matches/{}".format(mid), build)
 
 
 @blueprint.route("/games/<gid>", methods=["GET"])
@@ -118,8 +277,75 @@ def get_game_info(gid):
     """
     Returne details of game with game_id == gid
     """
-    game = get_game(gid)
-    return create_response(game)
+
+    def build():
+        game = get_game(gid)
+        if game.get("video"):
+            # the video of a game played in "replay" record mode isn't
+            # in storage until it has been requested from this endpoint
+            # relative, as the response is cached for every client
+            game["video"] = url_for(".get_game_video", gid=game["game_id"])
+        # games are only written to the database once they are over
+        return game, bool(game)
+
+    return cached_response("games/{}".format(gid), build)
+
+
+def regenerate_game_video(gid):
+    """
+    Regenerate the video of game gid, on the video_executor's thread.
+    """
+    # needs plark_game to render the game, so is only imported here
+    from battleground.replay import regenerate_video
+
+    try:
+        return regenerate_video(gid)
+    finally:
+        session.remove()
+
+
+def finish_video_job(gid, future):
+    with video_jobs_lock:
+        video_jobs.pop(gid, None)
+    if future.exception() is not None:
+        logger.error(
+            "Failed to regenerate video of game {}: {}".format(
+                gid, future.exception()
+            )
+        )
+
+
+@blueprint.route("/games/<int:gid>/video", methods=["GET"])
+def get_game_video(gid):
+    """
+    Redirect to the video of game with game_id == gid.  Games played in
+    "replay" record mode only have a replay log until their video is
+    first requested, when it is generated from the log in the
+    background, and 202 is returned until it is ready.
+    """
+    from battleground.replay import find_video
+
+    try:
+        video_url, exists = find_video(gid)
+    except RuntimeError as e:
+        raise ApiException(str(e), 404)
+    if exists:
+        return add_headers(redirect(video_url))
+
+    with video_jobs_lock:
+        future = video_jobs.get(gid)
+        start = future is None
+        if start:
+            future = video_executor.submit(regenerate_game_video, gid)
+            video_jobs[gid] = future
+    if start:
+        # outside the lock, as the callback runs straight away if the
+        # job has already finished
+        future.add_done_callback(partial(finish_video_job, gid))
+    response = jsonify({"status": "pending"})
+    response.status_code = 202
+    response.headers["Retry-After"] = str(VIDEO_RETRY_AFTER)
+    return add_headers(response)
 
 
 def create_app(name=__name__):
@@ -129,6 +355,12 @@ def create_app(name=__name__):
     CORS(app, supports_credentials=True)
     app.register_blueprint(blueprint)
     Session(app)
+
+    @app.teardown_appcontext
+    def remove_db_session(exception=None):
+        # each request gets its own database session, from the pool
+        session.remove()
+
     return app
 
 
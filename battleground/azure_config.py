@@ -6,4 +6,7 @@ config = {
     "config_container_name": os.environ["AZ_CONFIG_CONTAINER"],
     "logfile_container_name": os.environ["AZ_LOGFILE_CONTAINER"],
     "video_container_name": os.environ["AZ_VIDEO_CONTAINER"],
+    # replay logs go in the video container unless told otherwise
+    "replay_container_name": os.environ.get("AZ_REPLAY_CONTAINER")
+    or os.environ["AZ_VIDEO_CONTAINER"],
 }
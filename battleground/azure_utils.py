@@ -1,6 +1,16 @@
 import os
+import copy
+import glob
 import json
+import time
+import hashlib
+import tempfile
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from azure.storage.blob import (
     BlockBlobService,
 )
@@ -8,16 +18,70 @@ from azure.common import AzureMissingResourceHttpError
 
 from battleground.azure_config import config
 
+logger = logging.getLogger("battleground_logger")
+
+# maximum number of HTTP connections kept alive to blob storage
+HTTP_POOL_SIZE = 16
+# files uploaded at the same time by write_files_to_blob
+UPLOAD_WORKERS = 4
+# seconds for which a listing of a container's blob names is reused by
+# check_blob_exists(..., use_cache=True)
+BLOB_LIST_TTL = 60
+
+_blob_service = None
+_blob_service_lock = threading.Lock()
+# container_name -> (time listed, set of blob names)
+_blob_name_cache = {}
+_blob_name_cache_lock = threading.Lock()
+
+# read_json keeps the JSON blobs it downloads in CONFIG_CACHE_DIR, named
+# after the blob and its ETag, so that matches on the same host (which
+# mount the same directory) only download each version once.
+CONFIG_CACHE_DIR = (
+    os.environ.get("CONFIG_CACHE_DIR") or "/tmp/plark_config_cache"
+)
+# least recently used files are removed beyond this total size
+CONFIG_CACHE_MAX_BYTES = 50 * 1024 * 1024
+# seconds for which a blob read in this process is assumed not to have
+# changed, before its ETag is checked again
+CONFIG_CACHE_TTL = 60
+# number of blobs read_json keeps in memory, least recently used first out
+CONFIG_MEMO_SIZE = 64
+# (container_name, blob_name) -> (time checked, etag, data)
+_json_memo = OrderedDict()
+_json_memo_lock = threading.Lock()
+
+
+def get_blob_service():
+    """
+    Return the BlockBlobService shared by the whole process, creating it
+    on first use.  It is safe to use from several threads, and keeps its
+    HTTP(S) connections alive between calls, so that each upload or
+    download doesn't pay for a new TLS handshake.
+    """
+    global _blob_service
+    with _blob_service_lock:
+        if _blob_service is None:
+            request_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+            )
+            request_session.mount("https://", adapter)
+            request_session.mount("http://", adapter)
+            _blob_service = BlockBlobService(
+                account_name=config["storage_account_name"],
+                account_key=config["storage_account_key"],
+                request_session=request_session,
+            )
+    return _blob_service
+
 
 def check_container_exists(container_name, bbs=None):
     """
     See if a container already exists for this account name.
     """
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
+        bbs = get_blob_service()
     return bbs.exists(container_name)
 
 
@@ -26,26 +90,53 @@ def create_container(container_name, bbs=None):
     Create a storage container with the specified name.
     """
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
+        bbs = get_blob_service()
     exists = check_container_exists(container_name, bbs)
     if not exists:
         bbs.create_container(container_name)
 
 
-def check_blob_exists(blob_name, container_name, bbs=None):
+def list_blob_names_cached(container_name, bbs=None, ttl=BLOB_LIST_TTL):
+    """
+    Return the set of blob names in a container, listing the container
+    at most once every ttl seconds.  Useful when checking many blobs at
+    once - for a single blob, check_blob_exists is cheaper.
+    """
+    with _blob_name_cache_lock:
+        cached = _blob_name_cache.get(container_name)
+        if cached and time.time() - cached[0] < ttl:
+            return cached[1]
+    if not bbs:
+        bbs = get_blob_service()
+    blob_names = set(bbs.list_blob_names(container_name))
+    with _blob_name_cache_lock:
+        _blob_name_cache[container_name] = (time.time(), blob_names)
+    return blob_names
+
+
+def clear_blob_name_cache(container_name=None):
+    """
+    Forget the cached listing of one container, or of all of them.
+    """
+    with _blob_name_cache_lock:
+        if container_name is None:
+            _blob_name_cache.clear()
+        else:
+            _blob_name_cache.pop(container_name, None)
+
+
+def check_blob_exists(blob_name, container_name, bbs=None, use_cache=False):
     """
     See if a blob already exists for this account name.
+    By default this makes a single request for the blob's properties;
+    with use_cache=True it looks the name up in a recent listing of
+    the container instead (see list_blob_names_cached).
     """
+    if use_cache:
+        return blob_name in list_blob_names_cached(container_name, bbs)
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
-    blob_names = bbs.list_blob_names(container_name)
-    return blob_name in blob_names
+        bbs = get_blob_service()
+    return bbs.exists(container_name, blob_name)
 
 
 def retrieve_blob(blob_name, container_name, destination="/tmp/", bbs=None):
@@ -54,10 +145,7 @@ def retrieve_blob(blob_name, container_name, destination="/tmp/", bbs=None):
     and place in destination folder.
     """
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
+        bbs = get_blob_service()
     local_filename = blob_name.split("/")[-1]
     try:
         bbs.get_blob_to_path(
@@ -75,11 +163,7 @@ def retrieve_blob(blob_name, container_name, destination="/tmp/", bbs=None):
 
 def list_directory(path, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
-        pass
+        bbs = get_blob_service()
     prefix = remove_container_name_from_blob_path(path, container_name)
     if prefix and not prefix.endswith("/"):
         prefix += "/"
@@ -132,41 +216,58 @@ def remove_container_name_from_blob_path(blob_path, container_name):
 
 def delete_blob(blob_name, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
-    blob_exists = check_blob_exists(blob_name, container_name, bbs)
-    if not blob_exists:
-        return
-    bbs.delete_blob(container_name, blob_name)
+        bbs = get_blob_service()
+    try:
+        bbs.delete_blob(container_name, blob_name)
+    except AzureMissingResourceHttpError:
+        # already gone
+        pass
+    with _blob_name_cache_lock:
+        cached = _blob_name_cache.get(container_name)
+        if cached:
+            cached[1].discard(blob_name)
 
 
-def write_file_to_blob(file_path, blob_name, container_name, bbs=None):
+def write_file_to_blob(
+    file_path, blob_name, container_name, bbs=None, max_connections=2
+):
+    """
+    Upload a file.  Large files are split into blocks, and
+    max_connections blocks are uploaded at a time.
+    """
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
-    bbs.create_blob_from_path(container_name, blob_name, file_path)
+        bbs = get_blob_service()
+    bbs.create_blob_from_path(
+        container_name,
+        blob_name,
+        file_path,
+        max_connections=max_connections,
+    )
+    with _blob_name_cache_lock:
+        cached = _blob_name_cache.get(container_name)
+        if cached:
+            cached[1].add(blob_name)
 
 
 def write_files_to_blob(
-    path, container_name, blob_path=None, file_endings=[], bbs=None
+    path,
+    container_name,
+    blob_path=None,
+    file_endings=[],
+    bbs=None,
+    num_workers=UPLOAD_WORKERS,
 ):
     """
     Upload a whole directory structure to blob storage.
     If we are given 'blob_path' we use that - if not we preserve
     the given file path structure.
     In both cases we take care to remove the container name from
-    the start of the blob path
+    the start of the blob path.
+    Up to num_workers files are uploaded at the same time.
     """
 
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
+        bbs = get_blob_service()
     filepaths_to_upload = []
     for root, dirs, files in os.walk(path):
         for filename in files:
@@ -177,6 +278,7 @@ def write_files_to_blob(
                         filepaths_to_upload.append(filepath)
             else:
                 filepaths_to_upload.append(filepath)
+    uploads = []
     for filepath in filepaths_to_upload:
         if blob_path:
             blob_fullpath = os.path.join(
@@ -188,16 +290,162 @@ def write_files_to_blob(
             blob_fullpath, container_name
         )
 
-        write_file_to_blob(filepath, blob_name, container_name, bbs)
+        uploads.append((filepath, blob_name))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                write_file_to_blob, filepath, blob_name, container_name, bbs
+            )
+            for filepath, blob_name in uploads
+        ]
+        # re-raise any upload error
+        for future in futures:
+            future.result()
+
+
+def _cache_prefix(blob_name, container_name):
+    """
+    Start of the name of the cache files holding versions of this blob.
+    """
+    key = "{}/{}".format(container_name, blob_name).encode("utf-8")
+    return hashlib.sha256(key).hexdigest()[:32]
+
+
+def _cache_path(blob_name, container_name, etag, cache_dir):
+    etag_hash = hashlib.sha256(etag.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(
+        cache_dir,
+        "{}_{}.json".format(
+            _cache_prefix(blob_name, container_name), etag_hash
+        ),
+    )
+
+
+def _write_cache_file(cache_path, content, cache_dir, max_bytes):
+    """
+    Write a file into the cache (atomically, as other matches may be
+    reading it), then evict least recently used files over max_bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as tmp_file:
+        tmp_file.write(content)
+    os.replace(tmp_path, cache_path)
+    os.utime(cache_path)
+
+    cached_files = []
+    for path in glob.glob(os.path.join(cache_dir, "*.json")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        cached_files.append((stat.st_atime, stat.st_size, path))
+    total_size = sum(size for _, size, _ in cached_files)
+    for _, size, path in sorted(cached_files):
+        if total_size <= max_bytes:
+            break
+        if path == cache_path:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def _read_cache_file(cache_path):
+    with open(cache_path) as cache_file:
+        data = json.load(cache_file)
+    # mark as recently used, for the LRU eviction
+    os.utime(cache_path)
+    return data
 
 
-def read_json(blob_name, container_name, bbs=None):
+def read_json(
+    blob_name,
+    container_name,
+    bbs=None,
+    use_cache=True,
+    cache_dir=CONFIG_CACHE_DIR,
+    max_cache_bytes=CONFIG_CACHE_MAX_BYTES,
+    ttl=CONFIG_CACHE_TTL,
+):
+    """
+    Read a JSON blob.
+
+    With use_cache, a blob read within the last ttl seconds is returned
+    from memory, and otherwise its ETag is checked (a single small
+    request) and the contents are only downloaded if that version is not
+    already in cache_dir.  If blob storage can't be reached, the most
+    recently used cached version of the blob is returned.
+
+    Returns a new copy of the data each time, so callers may modify it.
+    """
     if not bbs:
-        bbs = BlockBlobService(
-            account_name=config["storage_account_name"],
-            account_key=config["storage_account_key"],
-        )
+        bbs = get_blob_service()
     blob_name = remove_container_name_from_blob_path(blob_name, container_name)
-    data_blob = bbs.get_blob_to_text(container_name, blob_name)
-    data = json.loads(data_blob.content)
-    return data
+    if not use_cache:
+        data_blob = bbs.get_blob_to_text(container_name, blob_name)
+        return json.loads(data_blob.content)
+
+    memo_key = (container_name, blob_name)
+    with _json_memo_lock:
+        memo = _json_memo.get(memo_key)
+        if memo:
+            _json_memo.move_to_end(memo_key)
+    if memo and time.time() - memo[0] < ttl:
+        return copy.deepcopy(memo[2])
+
+    try:
+        etag = bbs.get_blob_properties(
+            container_name, blob_name
+        ).properties.etag
+    except AzureMissingResourceHttpError:
+        raise
+    except Exception as e:
+        cached_paths = glob.glob(
+            os.path.join(
+                cache_dir,
+                "{}_*.json".format(_cache_prefix(blob_name, container_name)),
+            )
+        )
+        if memo:
+            data = memo[2]
+        elif cached_paths:
+            data = _read_cache_file(max(cached_paths, key=os.path.getatime))
+        else:
+            raise
+        logger.warning(
+            "Unable to check {}/{} ({}), using cached copy".format(
+                container_name, blob_name, e
+            )
+        )
+        return copy.deepcopy(data)
+
+    if memo and memo[1] == etag:
+        data = memo[2]
+    else:
+        cache_path = _cache_path(blob_name, container_name, etag, cache_dir)
+        try:
+            data = _read_cache_file(cache_path)
+        except (FileNotFoundError, ValueError):
+            data_blob = bbs.get_blob_to_text(container_name, blob_name)
+            data = json.loads(data_blob.content)
+            # the blob may have changed since its properties were read
+            etag = data_blob.properties.etag or etag
+            cache_path = _cache_path(
+                blob_name, container_name, etag, cache_dir
+            )
+            try:
+                _write_cache_file(
+                    cache_path, data_blob.content, cache_dir, max_cache_bytes
+                )
+            except OSError as e:
+                logger.warning("Unable to cache {}: {}".format(blob_name, e))
+    with _json_memo_lock:
+        _json_memo[memo_key] = (time.time(), etag, data)
+        _json_memo.move_to_end(memo_key)
+        while len(_json_memo) > CONFIG_MEMO_SIZE:
+            _json_memo.popitem(last=False)
+    return copy.deepcopy(data)
@@ -10,13 +10,10 @@ import numpy as np
 import pika
 import uuid
 import time
+import random
+from concurrent.futures import ThreadPoolExecutor
 
-from pika.adapters.utils.connection_workflow import (
-    AMQPConnectorSocketConnectError,
-)
-
-import imageio
-import PIL.Image
+from sqlalchemy.orm import sessionmaker
 
 import logging
 from logging.handlers import RotatingFileHandler
@@ -25,10 +22,24 @@ from plark_game.classes.newgamebase import NewgameBase
 from plark_game.classes.move import Move
 from plark_game.classes.observation import Observation
 
-from battleground.serialization import serialize_state
+from battleground.serialization import (
+    serialize_state,
+    state_delta,
+    encode_message,
+    dump_replay_log,
+    ENCODING_JSON,
+    CONTENT_TYPES,
+)
 from battleground.schema import Match, Game, session
 
-from battleground.azure_utils import write_file_to_blob, read_json
+from battleground.azure_utils import read_json
+from battleground.upload_manager import get_upload_manager
+from battleground.rabbitmq_utils import (
+    connection_pool,
+    get_queue_prefix,
+    queue_name,
+)
+from battleground.video import VideoWriter
 from battleground.azure_config import config
 
 # configure the logger
@@ -40,8 +51,67 @@ c_handler.setFormatter(formatter)
 
 logger.addHandler(c_handler)
 
-VIDEO_BASE_WIDTH = 512
-VIDEO_FPS = 1
+# optional protocol features that an agent can announce in its
+# "ready" message.
+# "batch_actions": the agent can reply to a "turn" request with a
+# JSON list of actions covering its whole turn.
+CAPABILITY_BATCH_ACTIONS = "batch_actions"
+# "encoding": "json" (default) or "msgpack", in which case the
+# observation arrays are sent as raw float32/int32 buffers.
+CAPABILITY_ENCODING = "encoding"
+# "fields": list of the request fields the agent uses, e.g.
+# ["obs_normalised"] - the others aren't computed or sent.
+CAPABILITY_FIELDS = "fields"
+# "state_delta": only the first request of a game carries the full
+# state, later ones carry the changes since the last state sent.
+CAPABILITY_STATE_DELTA = "state_delta"
+# "queue_prefix": the QUEUE_PREFIX the agent prepends to its queue
+# names - required when the broker is shared between matches.
+CAPABILITY_QUEUE_PREFIX = "queue_prefix"
+# reply sent by a "state_delta" agent that has missed a message and
+# needs the full state again
+RESYNC_REQUEST = "resync"
+REQUEST_FIELDS = [
+    "state",
+    "obs",
+    "obs_normalised",
+    "domain_parameters",
+    "domain_parameters_normalised",
+]
+
+# how long (in seconds) to wait for an agent to reply to a request,
+# and the action to apply on its behalf if it doesn't.
+DEFAULT_MOVE_TIMEOUT = 60
+DEFAULT_TIMEOUT_ACTION = "end"
+
+# how long (in seconds) to wait for both agents to be ready when the
+# broker is shared, as an agent that ignores QUEUE_PREFIX never sends
+# its "ready" message to this match's queue.  With a broker of its own,
+# the match waits for the agents indefinitely.
+DEFAULT_SHARED_READY_TIMEOUT = 600
+
+# what Battle.play records for each game:
+# "video": render every turn and upload an MP4 (default)
+# "replay": record the actions in a compact replay log, from which the
+#           video can be regenerated later (see battleground/replay.py)
+# "none": record nothing but the result
+RECORD_VIDEO = "video"
+RECORD_REPLAY = "replay"
+RECORD_NONE = "none"
+RECORD_MODES = [RECORD_VIDEO, RECORD_REPLAY, RECORD_NONE]
+REPLAY_LOG_SUFFIX = ".replay.json.gz"
+
+# draws the seed of each game, without touching the global random
+# number generators (which replayable games reseed)
+seed_source = random.Random()
+
+# where the match's logfile, videos and replay logs are written before
+# they are uploaded.  The match templates mount it from the host, so that
+# uploads left in the spool (see upload_manager.py) can still be resumed
+# after the battleground's container has been removed.
+MATCH_OUTPUT_DIR = (
+    os.environ.get("MATCH_OUTPUT_DIR") or "/tmp/plark_match_output"
+)
 
 
 def make_az_url(storage_account_name, container_name, blob_name):
@@ -53,7 +123,111 @@ def make_az_url(storage_account_name, container_name, blob_name):
     )
 
 
-class Battleground():
+def as_sequence(values):
+    """
+    Observations are sent as numpy arrays where possible (so that they
+    can be packed as raw buffers), and as lists otherwise.
+    """
+    if isinstance(values, np.ndarray):
+        return values
+    return list(values)
+
+
+def parse_ready_message(body):
+    """
+    Agents announce that they are ready either with the plain string
+    "PELICAN_READY" / "PANTHER_READY", or with a JSON object that also
+    lists the optional protocol features they support, e.g.
+    {"ready": "PELICAN_READY", "batch_actions": true}
+
+    Parameters
+    ==========
+    body: bytes, body of the message sent by the agent
+
+    Returns
+    =======
+    message: str, e.g. "PELICAN_READY"
+    capabilities: dict, protocol features supported by the agent
+    """
+    message = body.decode("utf-8")
+    try:
+        payload = json.loads(message)
+    except ValueError:
+        return message, {}
+    if not isinstance(payload, dict):
+        return message, {}
+    message = payload.pop("ready", "")
+    return message, payload
+
+
+def validate_capabilities(agent, capabilities):
+    """
+    Check the protocol features announced by an agent, dropping (with a
+    warning) any "encoding" we can't send, and any "fields" that aren't
+    a list of request fields, so that the agent gets the defaults
+    instead: JSON messages, with all the fields.
+
+    Parameters
+    ==========
+    agent: str, e.g. "PELICAN_READY", used in the warnings
+    capabilities: dict, as returned by parse_ready_message
+
+    Returns
+    =======
+    capabilities: dict, with only the valid features
+    """
+    capabilities = dict(capabilities)
+    encoding = capabilities.get(CAPABILITY_ENCODING, ENCODING_JSON)
+    if encoding not in CONTENT_TYPES:
+        logger.warning(
+            "{} asked for unknown encoding {!r}, using {}".format(
+                agent, encoding, ENCODING_JSON
+            )
+        )
+        del capabilities[CAPABILITY_ENCODING]
+    if CAPABILITY_FIELDS in capabilities:
+        fields = capabilities[CAPABILITY_FIELDS]
+        if not isinstance(fields, list) or any(
+            field not in REQUEST_FIELDS for field in fields
+        ):
+            logger.warning(
+                "{} asked for fields {!r}, must be a list from {}, "
+                "sending all fields".format(agent, fields, REQUEST_FIELDS)
+            )
+            del capabilities[CAPABILITY_FIELDS]
+    return capabilities
+
+
+def check_queue_prefix(agent, capabilities):
+    """
+    When the broker is shared between matches, check that the agent has
+    confirmed in its "ready" message that it prefixes its queue names
+    with this match's QUEUE_PREFIX.
+
+    Parameters
+    ==========
+    agent: str, e.g. "PELICAN_READY", used in the error
+    capabilities: dict, as returned by parse_ready_message
+
+    Raises
+    ======
+    RuntimeError, if the agent doesn't confirm the prefix
+    """
+    prefix = get_queue_prefix()
+    if not prefix:
+        return
+    confirmed = capabilities.get(CAPABILITY_QUEUE_PREFIX)
+    if confirmed != prefix:
+        raise RuntimeError(
+            "{} did not confirm QUEUE_PREFIX {!r} (got {!r}) - agents "
+            "sharing a broker must prefix their queue names and send "
+            '{{"ready": ..., "{}": <QUEUE_PREFIX>}}'.format(
+                agent, prefix, confirmed, CAPABILITY_QUEUE_PREFIX
+            )
+        )
+
+
+class Battleground:
     """
     Equivalent of 'Environment' class in plark_ai_public/Components/plark-game.
     Fulfils the same role - manages the creation and configuration of games.
@@ -63,14 +237,25 @@ class Battleground():
     that the RabbitMQ queue is up, and both agents have sent a "ready" message.
     """
 
-    def __init__(self, match_id, dbsession=session, **kwargs):
+    def __init__(
+        self,
+        match_id,
+        dbsession=session,
+        output_dir=MATCH_OUTPUT_DIR,
+        **kwargs
+    ):
         self.activeGames = []
         self.numberOfActiveGames = 0
         match_id = int(match_id)
+        self.output_dir = output_dir
+        os.makedirs(self.output_dir, exist_ok=True)
         # new logfile name for this match
         self.f_handler = RotatingFileHandler(
-            "match_{}_{}.log".format(
-                match_id, time.strftime("%Y-%m-%d_%H-%M-%S")
+            os.path.join(
+                self.output_dir,
+                "match_{}_{}.log".format(
+                    match_id, time.strftime("%Y-%m-%d_%H-%M-%S")
+                ),
             ),
             maxBytes=5 * 1024 * 1024,
             backupCount=10,
@@ -83,15 +268,20 @@ class Battleground():
                 "Could not find match {} in DB".format(match_id)
             )
         self.match_id = match_id
+        self.dbsession = dbsession
         self.num_games = match.num_games
         self.config_file = match.game_config
         # see if we have established communication with the agents
         self.pelican_ready = False
         self.panther_ready = False
+        # protocol features announced by the agents
+        self.agent_capabilities = {"PELICAN": {}, "PANTHER": {}}
 
     def setup_games(self, **kwargs):
         """
-        Create num_games Battle objects, with the chosen game_config
+        Create num_games Battle objects, with the chosen game_config.
+        kwargs are passed on to Battle, e.g. record_mode="replay" for
+        games that will be played in "replay" mode.
         """
         self.game_config = read_json(
             blob_name=self.config_file,
@@ -104,7 +294,10 @@ class Battleground():
         logger.info("Loaded game config {}".format(self.config_file))
         for i in range(self.num_games):
             logger.info("Creating game {}".format(i))
-            self.create_battle(**kwargs)
+            # tag each game so that agents can tell concurrent games apart
+            self.create_battle(
+                game_id="{}_{}".format(self.match_id, i), **kwargs
+            )
 
     # Triggers the creation of a new game
     def create_battle(self, **kwargs):
@@ -114,39 +307,30 @@ class Battleground():
         self.numberOfActiveGames = self.numberOfActiveGames + 1
         logger.info("Game Created")
 
-    def listen_for_ready(self):
+    def listen_for_ready(self, timeout=None):
         """
         When they have started up, the agents will send a "ready"
-        message to the queue 'rpc_queue_ready'.  Here we setup the
-        queue to listen for those messages, and once connected to it,
-        start listening.
-        """
+        message to the queue 'rpc_queue_ready' (prefixed with
+        QUEUE_PREFIX when the broker is shared between matches).
+        Here we setup the queue to listen for those messages, and once
+        connected to it, start listening.
 
-        ready_queue = "rpc_queue_ready"
+        Arguments:
+            timeout - seconds to wait for both agents.  By default,
+                DEFAULT_SHARED_READY_TIMEOUT when the broker is shared,
+                otherwise no limit.
+        Raises:
+            RuntimeError - if an agent sharing the broker doesn't
+                confirm QUEUE_PREFIX, or the agents aren't ready in time
+        """
 
-        if "RABBITMQ_HOST" in os.environ.keys():
-            hostname = os.environ["RABBITMQ_HOST"]
-        else:
-            hostname = "localhost"
+        ready_queue = queue_name("rpc_queue_ready")
+        if timeout is None and get_queue_prefix():
+            timeout = DEFAULT_SHARED_READY_TIMEOUT
+        self.ready_error = None
 
         # wait for the RabbitMQ queue to become ready
-        connected = False
-        while not connected:
-            try:
-                self.connection = pika.BlockingConnection(
-                    pika.ConnectionParameters(
-                        host=hostname,
-                        heartbeat=600,
-                        blocked_connection_timeout=300
-                    )
-                )
-                connected = True
-            except (
-                pika.exceptions.AMQPConnectionError,
-                AMQPConnectorSocketConnectError,
-            ):
-                logger.info("Waiting for connection...")
-                time.sleep(2)
+        self.connection = connection_pool.acquire()
         self.channel = self.connection.channel()
 
         self.channel.queue_declare(queue=ready_queue)
@@ -157,50 +341,221 @@ class Battleground():
             on_message_callback=self.set_agent_ready,
             auto_ack=True,
         )
+        self.ready_timer = None
+        if timeout is not None:
+            self.ready_timer = self.connection.call_later(
+                timeout, self.ready_timeout
+            )
         logger.info("Listening for agents becoming ready.")
         self.channel.start_consuming()
-
+        if self.ready_timer is not None:
+            # the agents were ready (or failed) before it fired
+            self.connection.remove_timeout(self.ready_timer)
+            self.ready_timer = None
+        # hand the connection back, so the games can reuse it
+        self.channel.close()
+        connection_pool.release(self.connection)
+        if self.ready_error is not None:
+            logger.error(str(self.ready_error))
+            raise self.ready_error
+
+    def ready_timeout(self):
+        """
+        Give up waiting for the agents, as they haven't both sent a
+        "ready" message in time.
+        """
+        waiting = [
+            agent
+            for agent, ready in [
+                ("PELICAN", self.pelican_ready),
+                ("PANTHER", self.panther_ready),
+            ]
+            if not ready
+        ]
+        self.ready_timer = None
+        message = "{} not ready in time".format(" and ".join(waiting))
+        if get_queue_prefix():
+            message += (
+                " - check that the agents prefix their queue names with "
+                "QUEUE_PREFIX {!r}".format(get_queue_prefix())
+            )
+        self.ready_error = RuntimeError(message)
+        self.channel.stop_consuming()
 
     def set_agent_ready(self, ch, method, props, body):
         """
         If we receive a message saying "panther_ready" or "pelican_ready",
         set our flags accordingly, and reply with the correlation_id
         """
-        print("got a message: {}".format(body))
-        message = body.decode("utf-8")
+        logger.debug("got a message: {}".format(body))
+        message, capabilities = parse_ready_message(body)
+        try:
+            check_queue_prefix(message, capabilities)
+        except RuntimeError as e:
+            self.ready_error = e
+            self.channel.stop_consuming()
+            return
+        capabilities.pop(CAPABILITY_QUEUE_PREFIX, None)
+        capabilities = validate_capabilities(message, capabilities)
         if message == "PANTHER_READY":
             self.panther_ready = True
+            self.agent_capabilities["PANTHER"] = capabilities
         elif message == "PELICAN_READY":
             self.pelican_ready = True
+            self.agent_capabilities["PELICAN"] = capabilities
+        if capabilities:
+            logger.info(
+                "{} supports {}".format(message, sorted(capabilities.keys()))
+            )
 
         if self.pelican_ready and self.panther_ready:
             logger.info("Both agents ready, will start match")
             time.sleep(1)
             self.channel.stop_consuming()
 
-    def play(self):
+    def play(self, num_workers=1, record_mode=RECORD_VIDEO):
+        """
+        Play all the games in the match.
+
+        Arguments:
+            num_workers - number of games to play at the same time.
+                Each game has its own connection and callback queue,
+                so while one game waits for an agent's reply the others
+                can carry on.
+            record_mode - "video", "replay" or "none", see Battle.play.
+                In "replay" mode the games are always played one at a
+                time, so that they can be reproduced from their seeds,
+                and must have been set up with record_mode="replay".
+        """
         print("In play - will do {} games".format(len(self.activeGames)))
-        for i, game in enumerate(self.activeGames):
-            video_filename = "match_{}_game_{}_{}.mp4".format(
-                self.match_id, i, time.strftime("%Y-%m-%d_%H-%M-%S")
+        if record_mode == RECORD_REPLAY and num_workers > 1:
+            # the games are seeded through the global random number
+            # generators, which threads playing at once would share
+            logger.warning(
+                "Replay logs need the games to be played one at a time, "
+                "ignoring num_workers={}".format(num_workers)
             )
-            game.play(match_id=self.match_id, video_file_path=video_filename)
+            num_workers = 1
+        if num_workers > 1:
+            logger.info("Playing up to {} games at once".format(num_workers))
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [
+                    executor.submit(self.play_game, i, game, record_mode, True)
+                    for i, game in enumerate(self.activeGames)
+                ]
+                # re-raise any exception from the games
+                for future in futures:
+                    future.result()
+        else:
+            for i, game in enumerate(self.activeGames):
+                self.play_game(i, game, record_mode)
+        self.delete_match_queues()
+        connection_pool.close_all()
+        # videos are encoded and uploaded in the background while the
+        # next games are played - make sure they are all done
+        for game in self.activeGames:
+            game.wait_for_video()
         self.save_logfile()
+        failed = get_upload_manager().join()
+        if failed:
+            logger.error(
+                "{} uploads failed, they will be retried on the next "
+                "run".format(len(failed))
+            )
+
+    def delete_match_queues(self):
+        """
+        When the broker is shared between matches, delete this match's
+        prefixed queues once its games are over, so that they don't
+        build up on the broker over a tournament.  (With a broker of its
+        own, the queues go when the match's broker is removed.)
+        """
+        if not get_queue_prefix():
+            return
+        connection = connection_pool.acquire()
+        try:
+            channel = connection.channel()
+            for name in [
+                "rpc_queue_ready",
+                "rpc_queue_pelican",
+                "rpc_queue_panther",
+            ]:
+                channel.queue_delete(queue=queue_name(name))
+            channel.close()
+        except pika.exceptions.AMQPError as e:
+            logger.warning("Failed to delete the match's queues: {}".format(e))
+        finally:
+            connection_pool.release(connection)
+
+    def play_game(
+        self, game_index, game, record_mode=RECORD_VIDEO, own_session=False
+    ):
+        """
+        Play a single game of the match.
+
+        Arguments:
+            game_index - position of the game within the match
+            game - the Battle instance to play
+            record_mode - "video", "replay" or "none", see Battle.play
+            own_session - if True, record the game using a new database
+                session, rather than the one shared by the Battleground
+                (sessions can't be shared between threads).
+        """
+        game.agent_capabilities = self.agent_capabilities
+        video_file_path = os.path.join(
+            self.output_dir,
+            "match_{}_game_{}_{}.mp4".format(
+                self.match_id, game_index, time.strftime("%Y-%m-%d_%H-%M-%S")
+            ),
+        )
+        if not own_session:
+            game.play(
+                match_id=self.match_id,
+                video_file_path=video_file_path,
+                dbsession=self.dbsession,
+                wait_for_video=False,
+                record_mode=record_mode,
+                delete_after_upload=True,
+            )
+            return
+        dbsession = sessionmaker(bind=self.dbsession.get_bind())()
+        try:
+            game.play(
+                match_id=self.match_id,
+                video_file_path=video_file_path,
+                dbsession=dbsession,
+                wait_for_video=False,
+                record_mode=record_mode,
+                delete_after_upload=True,
+            )
+        finally:
+            dbsession.close()
 
     def save_logfile(self):
         """
         Save the logfile to cloud storage, then update location in the
         database.
         """
-        # save logfile to Cloud storage
+        # stop logging to the file, so it is complete when uploaded and
+        # can then be deleted
         log_path = self.f_handler.baseFilename
+        logger.removeHandler(self.f_handler)
+        self.f_handler.close()
+        # save logfile to Cloud storage
         log_filename = os.path.basename(log_path)
-        write_file_to_blob(
-            log_path, log_filename, config["logfile_container_name"]
+        get_upload_manager().submit(
+            log_path,
+            log_filename,
+            config["logfile_container_name"],
+            delete_after_upload=True,
         )
 
         # retrieve the match from the db so we can update its logfile_url
-        m = session.query(Match).filter_by(match_id=self.match_id).first()
+        m = (
+            self.dbsession.query(Match)
+            .filter_by(match_id=self.match_id)
+            .first()
+        )
         if not m:
             raise RuntimeError(
                 "Unable to retrieve match {} from db".format(self.match_id)
@@ -211,8 +566,8 @@ class Battleground():
             log_filename,
         )
         m.logfile_url = logfile_url
-        session.add(m)
-        session.commit()
+        self.dbsession.add(m)
+        self.dbsession.commit()
 
 
 class Battle(NewgameBase):
@@ -230,14 +585,56 @@ class Battle(NewgameBase):
         Arguments:
             game_config -
             kwargs -
+                move_timeout - seconds to wait for an agent's reply
+                timeout_action - action applied when an agent times out
+                game_id - identifier sent to the agents with each request
+                seed - seed for the random number generators, so that a
+                    game can be replayed from its actions
+                record_mode - "replay" if the game will be played with
+                    record_mode="replay", in which case the global random
+                    number generators are seeded from seed when the game
+                    is set up and played.  They are left alone otherwise.
         """
+        self.move_timeout = kwargs.pop("move_timeout", DEFAULT_MOVE_TIMEOUT)
+        self.timeout_action = kwargs.pop(
+            "timeout_action", DEFAULT_TIMEOUT_ACTION
+        )
+        # number of requests each agent failed to answer in time
+        self.timeouts = {"PELICAN": 0, "PANTHER": 0}
+        # last serialized state sent to each agent, and its sequence
+        # number, for the "state_delta" protocol
+        self.last_state = {"PELICAN": None, "PANTHER": None}
+        self.state_seq = {"PELICAN": 0, "PANTHER": 0}
+        # sent with every request, so that an agent serving several
+        # games at once knows which one the request belongs to
+        self.game_id = kwargs.pop("game_id", None) or uuid.uuid4().hex
+        self.seed = kwargs.pop("seed", None)
+        if self.seed is None:
+            self.seed = seed_source.randrange(2 ** 32)
+        # kept for the replay log
+        self.source_game_config = game_config
+        self.replay_log = None
+        self.replayable = (
+            kwargs.pop("record_mode", RECORD_VIDEO) == RECORD_REPLAY
+        )
+        if self.replayable:
+            self.seed_random(0)
 
         super().__init__(game_config, **kwargs)
 
         self.gamePlayerTurn = None
 
-        # Initialize the RabbitMQ connection
-        self.setup_message_queues()
+        # protocol features supported by the agents - by default agents
+        # are asked for one action per message.
+        self.agent_capabilities = {"PELICAN": {}, "PANTHER": {}}
+
+        # the RabbitMQ channel is only opened when the game is played,
+        # so that games can share pooled connections
+        self.connection = None
+        self.channel = None
+        self.video_writer = None
+        # set by play()
+        self.delete_after_upload = False
 
         self.gamePlayerTurn = "ALL"
 
@@ -272,27 +669,11 @@ class Battle(NewgameBase):
         self.render(self.render_width, self.render_height, self.gamePlayerTurn)
 
     def setup_message_queues(self):
-        if "RABBITMQ_HOST" in os.environ.keys():
-            hostname = os.environ["RABBITMQ_HOST"]
-        else:
-            hostname = "localhost"
-        connected = False
-        while not connected:
-            try:
-                self.connection = pika.BlockingConnection(
-                    pika.ConnectionParameters(
-                        host=hostname,
-                        heartbeat=600,
-                        blocked_connection_timeout=300
-                    )
-                )
-                connected = True
-            except (
-                pika.exceptions.AMQPConnectionError,
-                AMQPConnectorSocketConnectError,
-            ):
-                logger.info("Waiting for connection...")
-                time.sleep(2)
+        """
+        Open a channel for this game on a pooled connection, with an
+        exclusive queue for the agents' replies.
+        """
+        self.connection = connection_pool.acquire()
         self.channel = self.connection.channel()
 
         result = self.channel.queue_declare(queue="", exclusive=True)
@@ -304,18 +685,40 @@ class Battle(NewgameBase):
             auto_ack=True,
         )
         self.routing_keys = {
-            "PELICAN": "rpc_queue_pelican",
-            "PANTHER": "rpc_queue_panther",
+            "PELICAN": queue_name("rpc_queue_pelican"),
+            "PANTHER": queue_name("rpc_queue_panther"),
         }
 
+    def close_message_queues(self):
+        """
+        Remove this game's reply queue and channel, and give the
+        connection back to the pool for the next game.
+        """
+        if self.channel is None:
+            return
+        self.channel.queue_delete(queue=self.callback_queue)
+        self.channel.close()
+        connection_pool.release(self.connection)
+        self.channel = None
+        self.connection = None
+
     def on_response(self, ch, method, props, body):
         if self.corr_id == props.correlation_id:
             self.response = body
 
-    def get_agent_action(self, agent_type):
+    def supports(self, agent_type, capability):
         """
-        Send a message to the appropriate queue to get
-        an "action" from an agent.
+        Whether the agent has announced support for an optional
+        protocol feature in its "ready" message.
+        """
+        return bool(self.agent_capabilities[agent_type].get(capability))
+
+    def build_request(self, agent_type):
+        """
+        Build the body of a request to an agent, containing the game
+        state and observations from the point-of-view of that agent.
+        If the agent has said which fields it uses, only those are
+        computed.
 
         Parameters
         ==========
@@ -323,7 +726,7 @@ class Battle(NewgameBase):
 
         Returns
         =======
-        action: str, representation of an integer.
+        body: dict, request body, to be encoded by encode_message.
         """
         if agent_type not in ["PANTHER", "PELICAN"]:
             raise RuntimeError(
@@ -331,28 +734,99 @@ class Battle(NewgameBase):
                     agent_type
                 )
             )
-        # generate a uuid to identify this message
-        self.corr_id = str(uuid.uuid4())
+        wanted = self.agent_capabilities[agent_type].get(
+            CAPABILITY_FIELDS, REQUEST_FIELDS
+        )
+        observation = self.observation[agent_type]
         # get the game state from the point-of-view of this agent
         game_state = self._state(agent_type)
-        serialized_game_state = serialize_state(game_state)
-        obs = self.observation[agent_type].get_original_observation(game_state)
-        obs_normalised = self.observation[
-            agent_type
-        ].get_normalised_observation(game_state)
-        domain_parameters = self.observation[
-            agent_type
-        ].get_remaining_domain_parameters()
-        domain_parameters_normalised = self.observation[
-            agent_type
-        ].get_normalised_remaining_domain_parameters()
-        body = {
-            "state": serialized_game_state,
-            "obs": list(obs),
-            "obs_normalised": list(obs_normalised),
-            "domain_parameters": list(domain_parameters),
-            "domain_parameters_normalised": list(domain_parameters_normalised),
-        }
+        body = {"game_id": self.game_id}
+        if "state" in wanted:
+            state = serialize_state(game_state)
+            if self.supports(agent_type, CAPABILITY_STATE_DELTA):
+                self.add_state_delta(agent_type, body, state)
+            else:
+                body["state"] = state
+        if "obs" in wanted:
+            body["obs"] = as_sequence(
+                observation.get_original_observation(game_state)
+            )
+        if "obs_normalised" in wanted:
+            body["obs_normalised"] = as_sequence(
+                observation.get_normalised_observation(game_state)
+            )
+        if "domain_parameters" in wanted:
+            body["domain_parameters"] = as_sequence(
+                observation.get_remaining_domain_parameters()
+            )
+        if "domain_parameters_normalised" in wanted:
+            body["domain_parameters_normalised"] = as_sequence(
+                observation.get_normalised_remaining_domain_parameters()
+            )
+        return body
+
+    def add_state_delta(self, agent_type, body, state):
+        """
+        For agents using the "state_delta" protocol, add either the full
+        state (first request of the game, or after a resync) or the
+        changes since the last state sent, to the request body.  Each
+        carries a sequence number, so the agent can detect a gap and
+        reply "resync".
+        """
+        self.state_seq[agent_type] += 1
+        body["state_seq"] = self.state_seq[agent_type]
+        previous = self.last_state[agent_type]
+        if previous is None:
+            body["state"] = state
+        else:
+            body["state_delta"] = state_delta(previous, state)
+        self.last_state[agent_type] = state
+
+    def request_agent(self, agent_type, **kwargs):
+        """
+        Build a request for an agent, with any extra fields given in
+        kwargs, send it and return the reply.  If the agent asks for a
+        resync, the request is sent again with the full state.
+        """
+        body = self.build_request(agent_type)
+        body.update(kwargs)
+        reply = self.send_request(agent_type, body)
+        if reply == RESYNC_REQUEST and "state_delta" in body:
+            logger.info("{} asked for a resync".format(agent_type))
+            self.last_state[agent_type] = None
+            body = self.build_request(agent_type)
+            body.update(kwargs)
+            reply = self.send_request(agent_type, body)
+        if reply == RESYNC_REQUEST:
+            logger.warning(
+                "{} asked for a resync of a full state, applying {}".format(
+                    agent_type, self.timeout_action
+                )
+            )
+            reply = self.timeout_action
+        return reply
+
+    def send_request(self, agent_type, body):
+        """
+        Publish a request to the appropriate queue, and wait for the
+        agent's reply.  If no reply arrives within move_timeout seconds,
+        the timeout is recorded and timeout_action is returned instead.
+
+        Parameters
+        ==========
+        agent_type: str, must be "PELICAN" or "PANTHER"
+        body: dict, request body, as returned by build_request
+
+        Returns
+        =======
+        reply: str, decoded body of the agent's reply, or timeout_action.
+        """
+        encoding = self.agent_capabilities[agent_type].get(
+            CAPABILITY_ENCODING, ENCODING_JSON
+        )
+        payload, content_type = encode_message(body, encoding)
+        # generate a uuid to identify this message
+        self.corr_id = str(uuid.uuid4())
         self.response = None
         self.channel.basic_publish(
             exchange="",
@@ -360,13 +834,157 @@ class Battle(NewgameBase):
             properties=pika.BasicProperties(
                 reply_to=self.callback_queue,
                 correlation_id=self.corr_id,
+                content_type=content_type,
             ),
-            body=json.dumps(body),
+            body=payload,
         )
+        deadline = time.time() + self.move_timeout
         while self.response is None:
-            self.connection.process_data_events()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # any late reply will have a stale correlation_id,
+                # so will be ignored by on_response
+                self.timeouts[agent_type] += 1
+                logger.warning(
+                    "{} did not reply within {} s, applying action {}".format(
+                        agent_type, self.move_timeout, self.timeout_action
+                    )
+                )
+                return self.timeout_action
+            # blocks until a message arrives or time_limit expires
+            self.connection.process_data_events(time_limit=remaining)
         return self.response.decode("utf-8")
 
+    def get_agent_action(self, agent_type):
+        """
+        Send a message to the appropriate queue to get
+        an "action" from an agent.
+
+        Parameters
+        ==========
+        agent_type: str, must be "PELICAN" or "PANTHER"
+
+        Returns
+        =======
+        action: str, representation of an integer.
+        """
+        return self.request_agent(agent_type)
+
+    def get_agent_turn(self, agent_type, moves_remaining):
+        """
+        Ask an agent that supports the "batch_actions" protocol for
+        the sequence of actions making up the rest of its turn, in a
+        single message.
+
+        Parameters
+        ==========
+        agent_type: str, must be "PELICAN" or "PANTHER"
+        moves_remaining: int, number of moves the agent has left this turn
+
+        Returns
+        =======
+        actions: list of str, the actions in the order they should be
+                 performed.
+        """
+        reply = self.request_agent(
+            agent_type, request="turn", moves_remaining=moves_remaining
+        )
+        try:
+            actions = json.loads(reply)
+        except ValueError:
+            # a bare action string rather than a JSON list
+            return [reply]
+        if not isinstance(actions, list):
+            actions = [actions]
+        return [str(action) for action in actions]
+
+    def perform_agent_action(self, agent_type, action):
+        """
+        Apply a single action from the agent to the game, recording it
+        in the replay log if there is one.
+        """
+        if self.replay_log is not None:
+            self.replay_log["actions"].append([agent_type, action])
+        if agent_type == "PELICAN":
+            self.perform_pelican_action(action)
+        else:
+            self.perform_panther_action(action)
+
+    def moves_in_turn(self, agent_type):
+        """
+        Number of moves the agent has made so far in this turn.
+        """
+        if agent_type == "PELICAN":
+            return self.pelican_move_in_turn
+        return self.panther_move_in_turn
+
+    def action_footprint(self, agent_type):
+        """
+        The parts of the game that an action by the agent can change:
+        its moves this turn and position, the number of sonobuoys and
+        torpedoes deployed, and the game state.  Much cheaper to compare
+        than the serialized state.
+        """
+        if agent_type == "PELICAN":
+            player = self.pelicanPlayer
+        else:
+            player = self.pantherPlayer
+        return (
+            self.moves_in_turn(agent_type),
+            player.col,
+            player.row,
+            len(self.globalSonobuoys),
+            len(self.globalTorpedoes),
+            self.gameState,
+        )
+
+    def agent_phase(self, agent_type, turn_finished):
+        """
+        Play one agent's turn.  Agents that support the "batch_actions"
+        protocol are asked for their whole turn at once, and the actions
+        are then validated locally one at a time.  If an action has no
+        effect on the game (e.g. it has become illegal because of an
+        earlier move), which is spotted by comparing action_footprint,
+        the rest of the batch is discarded and the agent is asked again,
+        with the up-to-date state.
+        Other agents are asked for one action per message.
+
+        Parameters
+        ==========
+        agent_type: str, must be "PELICAN" or "PANTHER"
+        turn_finished: function taking the last action, returning True
+                       when the agent's turn is over.
+        """
+        if agent_type == "PELICAN":
+            move_limit = self.pelican_parameters["move_limit"]
+        else:
+            move_limit = self.panther_parameters["move_limit"]
+        batch = self.supports(agent_type, CAPABILITY_BATCH_ACTIONS)
+        while True:
+            if batch:
+                moves_remaining = move_limit - self.moves_in_turn(agent_type)
+                actions = self.get_agent_turn(agent_type, moves_remaining)
+                if not actions:
+                    actions = ["end"]
+            else:
+                actions = [self.get_agent_action(agent_type)]
+            for action in actions:
+                logger.info("{} action {}".format(agent_type.lower(), action))
+                if batch:
+                    footprint_before = self.action_footprint(agent_type)
+                self.perform_agent_action(agent_type, action)
+                if turn_finished(action):
+                    return
+                if batch and footprint_before == self.action_footprint(
+                    agent_type
+                ):
+                    logger.info(
+                        "{} action {} rejected, requesting new actions".format(
+                            agent_type.lower(), action
+                        )
+                    )
+                    break
+
     def pelicanPhase(self):
         """
         Pelican's move
@@ -375,16 +993,14 @@ class Battle(NewgameBase):
         logger.info("Pelican's move")
 
         self.pelicanMove = Move()
-        while True:
-            pelican_action = self.get_agent_action("PELICAN")
-            logger.info("pelican action {}".format(pelican_action))
-            self.perform_pelican_action(pelican_action)
-            if (
+        self.agent_phase(
+            "PELICAN",
+            lambda action: (
                 self.pelican_move_in_turn
                 >= self.pelican_parameters["move_limit"]
-                or pelican_action == "end"
-            ):
-                break
+                or action == "end"
+            ),
+        )
 
     def pantherPhase(self):
         """
@@ -394,30 +1010,105 @@ class Battle(NewgameBase):
         logger.info("Panther's move")
 
         self.pantherMove = Move()
-        while True:
-            panther_action = self.get_agent_action("PANTHER")
-            logger.info("panther action {}".format(panther_action))
-            self.perform_panther_action(panther_action)
-            if (
+        self.agent_phase(
+            "PANTHER",
+            lambda action: (
                 self.gameState == "ESCAPE"
                 or self.panther_move_in_turn
                 >= self.panther_parameters["move_limit"]
-                or panther_action == "end"
-            ):
-                break
+                or action == "end"
+            ),
+        )
 
-    def play(self, match_id=0, video_file_path=None, dbsession=session):
+    def seed_random(self, offset):
+        """
+        Seed the global random number generators, which the game draws
+        from, from this game's seed, so that replaying the same actions
+        gives the same game.  Only done for replayable games.  Done separately
+        for setting up and for playing the game, as other games may be
+        set up in between.
+        """
+        random.seed(self.seed + offset)
+        np.random.seed((self.seed + offset) % 2 ** 32)
+
+    def run_game(self):
+        """
+        Play the game until it is over, adding a frame to the video
+        (if there is a video_writer) every turn.
+
+        Returns:
+            state - the final state of the game, e.g. "PELICANWIN"
+            num_turns - the number of turns played
+        """
+        if self.replayable:
+            self.seed_random(1)
+        num_turns = 0
+        state = None
+        self.setup_message_queues()
+        try:
+            while True:
+                if self.video_writer is not None:
+                    image = self.render(
+                        view="ALL",
+                        render_width=self.render_width,
+                        render_height=self.render_height,
+                    )
+                    self.video_writer.add_frame(image)
+
+                state, output = self.game_step(None)
+
+                logger.debug("state: {}".format(state))
+
+                if state != "Running":
+                    break
+                num_turns += 1
+        finally:
+            self.close_message_queues()
+        return state, num_turns
+
+    def play(
+        self,
+        match_id=0,
+        video_file_path=None,
+        dbsession=session,
+        wait_for_video=True,
+        record_mode=RECORD_VIDEO,
+        delete_after_upload=False,
+    ):
         """
         Plays a battle.
 
         Arguments:
             video_file_path - full path to where the resulting
                 video file should be saved. (optional)
+            wait_for_video - if False, return as soon as the game is
+                over, leaving the video to be encoded and uploaded in
+                the background - call wait_for_video() before exiting.
+            record_mode - "video", "replay" or "none".  In "replay" mode
+                (for which the Battle must have been created with
+                record_mode="replay") no video is rendered: the actions
+                are saved in a replay log next to video_file_path, and
+                the game's video_url points to where the video will be
+                once it has been regenerated from the log.
+            delete_after_upload - delete the video or replay log once it
+                has been uploaded.  Only for files in a temporary output
+                directory, such as the Battleground's.
         Returns:
             None
         """
+        if record_mode not in RECORD_MODES:
+            raise RuntimeError(
+                "record_mode must be one of {}, not {}".format(
+                    RECORD_MODES, record_mode
+                )
+            )
+        if record_mode == RECORD_REPLAY and not self.replayable:
+            raise RuntimeError(
+                "Battle {} must be created with record_mode={!r} to be "
+                "replayed".format(self.game_id, RECORD_REPLAY)
+            )
 
-        logger.info("Battle begins!")
+        logger.info("Battle {} begins!".format(self.game_id))
         parent_match = (
             dbsession.query(Match).filter_by(match_id=match_id).first()
         )
@@ -429,60 +1120,98 @@ class Battle(NewgameBase):
         g = Game()
         g.match = parent_match
         g.game_time = datetime.datetime.now()
-        if video_file_path is not None:
-            writer = imageio.get_writer(video_file_path, fps=VIDEO_FPS)
-        else:
-            writer = None
-        num_turns = 0
-        state = None
-        while True:
-            if writer is not None:
-                image = self.render(
-                    view="ALL",
-                    render_width=self.render_width,
-                    render_height=self.render_height,
-                )
-
-                wpercent = VIDEO_BASE_WIDTH / float(image.size[0])
-                hsize = int((float(image.size[1]) * float(wpercent)))
+        self.delete_after_upload = delete_after_upload
+        if video_file_path is None:
+            record_mode = RECORD_NONE
+        if record_mode == RECORD_VIDEO:
+            # frames are resized, encoded and uploaded on another thread
+            self.video_writer = VideoWriter(
+                video_file_path, on_finished=self.upload_video
+            )
+        elif record_mode == RECORD_REPLAY:
+            self.replay_log = {
+                "game_id": self.game_id,
+                "seed": self.seed,
+                "game_config": self.source_game_config,
+                "actions": [],
+            }
 
-                res_image = image.resize(
-                    (VIDEO_BASE_WIDTH, hsize), PIL.Image.ANTIALIAS
-                )
+        state, num_turns = self.run_game()
 
-                writer.append_data(np.copy(np.array(res_image)))
+        g.num_turns = num_turns
+        g.result_code = state
+        if any(self.timeouts.values()):
+            logger.warning(
+                "Agent timeouts in this game: {}".format(self.timeouts)
+            )
+        if record_mode == RECORD_VIDEO:
+            self.video_writer.close()
+        elif record_mode == RECORD_REPLAY:
+            self.replay_log["result_code"] = state
+            self.replay_log["num_turns"] = num_turns
+            self.save_replay_log(video_file_path)
+        if record_mode == RECORD_NONE:
+            g.video_url = ""
+        else:
+            video_filename = os.path.basename(video_file_path)
+            g.video_url = make_az_url(
+                config["storage_account_name"],
+                config["video_container_name"],
+                video_filename,
+            )
+        logger.info("Battle {} finished.".format(self.game_id))
 
-            state, output = self.game_step(None)
+        dbsession.add(g)
+        dbsession.commit()
 
-            print("state: ", state)
+        if wait_for_video:
+            self.wait_for_video()
 
-            if state != "Running":
-                break
-            num_turns += 1
+        return
 
-        g.num_turns = num_turns
-        g.result_code = state
-        if writer is not None:
-            writer.close()
+    def save_replay_log(self, video_file_path):
+        """
+        Write the replay log to a file alongside where the video would
+        have been, and upload it to cloud storage.
+        """
+        replay_file_path = video_file_path + REPLAY_LOG_SUFFIX
+        dump_replay_log(self.replay_log, replay_file_path)
+        replay_filename = os.path.basename(replay_file_path)
         logger.info(
-            "Saving video to {}/{}".format(
-                config["video_container_name"],
-                os.path.basename(video_file_path),
+            "Saving replay log to {}/{}".format(
+                config["replay_container_name"], replay_filename
             )
         )
+        get_upload_manager().submit(
+            replay_file_path,
+            replay_filename,
+            config["replay_container_name"],
+            delete_after_upload=self.delete_after_upload,
+        )
+
+    def upload_video(self, video_file_path):
+        """
+        Queue the finished video to be uploaded to cloud storage (called
+        by the VideoWriter once the video has been encoded).
+        """
         video_filename = os.path.basename(video_file_path)
-        write_file_to_blob(
-            video_file_path, video_filename, config["video_container_name"]
+        logger.info(
+            "Saving video to {}/{}".format(
+                config["video_container_name"], video_filename
+            )
         )
-        logger.info("Battle finished.")
-        video_url = make_az_url(
-            config["storage_account_name"],
-            config["video_container_name"],
+        get_upload_manager().submit(
+            video_file_path,
             video_filename,
+            config["video_container_name"],
+            delete_after_upload=self.delete_after_upload,
         )
-        g.video_url = video_url
 
-        dbsession.add(g)
-        dbsession.commit()
-
-        return
+    def wait_for_video(self):
+        """
+        Block until the video of this battle has been encoded and
+        uploaded (along with anything else waiting to be uploaded).
+        """
+        if self.video_writer is not None:
+            self.video_writer.wait()
+        get_upload_manager().join()
@@ -8,7 +8,7 @@ from contextlib import contextmanager
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from battleground.schema import Base
+from battleground.schema import Base, create_missing_indexes
 
 if os.name == "posix":
     TMPDIR = "/tmp"
@@ -20,6 +20,7 @@ TMPDB = os.path.join(TMPDIR, "plarktest.db")
 testengine = create_engine("sqlite:///{}".format(TMPDB))
 
 Base.metadata.create_all(testengine)
+create_missing_indexes(testengine)
 Base.metadata.bind = testengine
 
 
@@ -9,3 +9,10 @@ else:
         os.environ["DB_URI"],
         os.environ["DB_NAME"],
     )
+
+# connection pool settings for the engine (not used for sqlite)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE") or 5)
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW") or 10)
+# seconds after which a pooled connection is replaced, as Azure drops
+# idle connections
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE") or 1800)
@@ -8,18 +8,32 @@ an environment variable to the 'battleground' container.
 
 import datetime
 
-from battleground.schema import session, Team, Agent, Match, Tournament
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+
+from battleground.schema import (
+    session,
+    Team,
+    Agent,
+    Match,
+    Tournament,
+    Game,
+    LOGFILE_PENDING,
+)
 
 
 def create_db_team(name, members="placeholder", dbsession=session):
     """
     Create a new team in the db after first checking if it already exists
     """
-    existing_teams = dbsession.query(Team).all()
-    for t in existing_teams:
-        if t.team_name == name and t.team_members == members:
-            print("Team already exists")
-            return t.team_id
+    existing_team = (
+        dbsession.query(Team.team_id)
+        .filter_by(team_name=name, team_members=members)
+        .first()
+    )
+    if existing_team:
+        print("Team already exists")
+        return existing_team.team_id
     print("Creating new team {}".format(name))
     new_team = Team()
     new_team.team_name = name
@@ -40,11 +54,14 @@ def create_db_agent(agent_name, agent_type, dbsession=session):
         raise RuntimeError(
             "agent_name must be in format <<TEAM_NAME>>:<<TAG>>"
         )
-    existing_agents = dbsession.query(Agent).all()
-    for a in existing_agents:
-        if a.agent_name == agent_name:
-            print("Agent {} already exists".format(agent_name))
-            return a.agent_id
+    existing_agent = (
+        dbsession.query(Agent.agent_id)
+        .filter_by(agent_name=agent_name)
+        .first()
+    )
+    if existing_agent:
+        print("Agent {} already exists".format(agent_name))
+        return existing_agent.agent_id
     team_name, agent_tag = agent_name.split(":")
     # create_db_team will do the check for us if the team already exists
     tid = create_db_team(team_name, dbsession=dbsession)
@@ -66,12 +83,10 @@ def create_db_tournament(agents, dbsession=session):
     print("Creating new tournament")
     tourn = Tournament()
     tourn.tournament_time = datetime.datetime.now()
-    existing_agents = dbsession.query(Agent).all()
-
-    for a in existing_agents:
-        if a.agent_name in agents:
-            tourn.agents.append(a)
-    dbsession.add(a)
+    if agents:
+        tourn.agents.extend(
+            dbsession.query(Agent).filter(Agent.agent_name.in_(agents)).all()
+        )
     dbsession.add(tourn)
     dbsession.commit()
     return tourn.tournament_id
@@ -120,14 +135,25 @@ def create_db_match(
     match_id: int, ID of the existing or newly created match in the db.
     """
     if check_for_existing:
-        existing_matches = dbsession.query(Match).all()
-        for m in existing_matches:
-            if (
-                m.pelican_agent.agent_name == pelican_agent
-                and m.panther_agent.agent_name == panther_agent
-            ):
-                print("Match already exists")
-                return m.match_id
+        pelican_alias = aliased(Agent)
+        panther_alias = aliased(Agent)
+        existing_match = (
+            dbsession.query(Match.match_id)
+            .join(
+                pelican_alias, Match.pelican_agent_id == pelican_alias.agent_id
+            )
+            .join(
+                panther_alias, Match.panther_agent_id == panther_alias.agent_id
+            )
+            .filter(
+                pelican_alias.agent_name == pelican_agent,
+                panther_alias.agent_name == panther_agent,
+            )
+            .first()
+        )
+        if existing_match:
+            print("Match already exists")
+            return existing_match.match_id
     print("Creating new match: {} {}".format(pelican_agent, panther_agent))
 
     # if given team names for pelican and panther, attach the Agents.
@@ -162,7 +188,7 @@ def create_db_match(
     new_match.game_config = game_config
     new_match.match_time = datetime.datetime.now()
     new_match.num_games = num_games
-    new_match.logfile_url = "empty_for_now"
+    new_match.logfile_url = LOGFILE_PENDING
     # see if we have a tournament to assign the match to
     if tournament_id:
         tournament = get_db_tournament(tournament_id, dbsession)
@@ -176,9 +202,147 @@ def create_db_match(
 def match_finished(match_id, dbsession=session):
     """
     Query the database for the match with match_id,
-    see if it is finished (num_games == len(completed games))
+    see if it is finished (num_games == number of completed games).
+    Only counts the games, rather than loading them.
     """
-    match = dbsession.query(Match).filter_by(match_id=match_id).first()
-    if not match:
+    num_games = (
+        dbsession.query(Match.num_games).filter_by(match_id=match_id).scalar()
+    )
+    if num_games is None:
         raise RuntimeError("Match {} not found in db".format(match_id))
-    return match.is_finished
+    num_played = (
+        dbsession.query(func.count(Game.game_id))
+        .filter_by(match_id=match_id)
+        .scalar()
+    )
+    return num_played == num_games
+
+
+def bootstrap_tournament(
+    pairings,
+    game_configs,
+    num_games=10,
+    tournament_id=None,
+    dbsession=session,
+):
+    """
+    Create everything needed to run a tournament in one transaction:
+    any agents (and their teams) not already in the db, the tournament
+    (unless tournament_id is given) and one match per pairing.
+
+    Parameters
+    ==========
+    pairings: list of (pelican agent name, panther agent name) tuples,
+              agent names in the format <<TEAM_NAME>>:<<TAG>>
+    game_configs: list of str, name of the game config json file for
+                  each pairing
+    num_games: int, number of Games in each Match
+    tournament_id: int, ID of an existing tournament to add the matches
+                   to (e.g. when retrying a tournament).  If None, a new
+                   tournament is created.
+    dbsession: sqlalchemy.orm.session.Session, the database session.
+
+    Returns
+    =======
+    tournament_id: int, ID of the tournament in the db.
+    match_ids: list of int, the ID of the match for each pairing, in the
+               same order as pairings (a pairing may appear more than
+               once, and gets a match each time)
+    """
+    if len(pairings) != len(game_configs):
+        raise RuntimeError("Need one game config per pairing")
+    agent_types = {}
+    for pelican_agent, panther_agent in pairings:
+        agent_types[pelican_agent] = "pelican"
+        agent_types[panther_agent] = "panther"
+    for agent_name in agent_types:
+        if ":" not in agent_name:
+            raise RuntimeError(
+                "agent_name must be in format <<TEAM_NAME>>:<<TAG>>"
+            )
+
+    try:
+        agents = {}
+        if agent_types:
+            for a in (
+                dbsession.query(Agent)
+                .filter(Agent.agent_name.in_(list(agent_types)))
+                .order_by(Agent.agent_id)
+            ):
+                agents.setdefault(a.agent_name, a)
+
+        # create the missing agents, and their teams if necessary
+        new_agent_names = [name for name in agent_types if name not in agents]
+        team_names = {name.split(":")[0] for name in new_agent_names}
+        teams = {}
+        if team_names:
+            for t in (
+                dbsession.query(Team)
+                .filter(
+                    Team.team_name.in_(list(team_names)),
+                    Team.team_members == "placeholder",
+                )
+                .order_by(Team.team_id)
+            ):
+                teams.setdefault(t.team_name, t)
+        for team_name in team_names:
+            if team_name not in teams:
+                print("Creating new team {}".format(team_name))
+                t = Team()
+                t.team_name = team_name
+                t.team_members = "placeholder"
+                dbsession.add(t)
+                teams[team_name] = t
+        for agent_name in new_agent_names:
+            a = Agent()
+            a.agent_name = agent_name
+            a.agent_type = agent_types[agent_name]
+            a.team = teams[agent_name.split(":")[0]]
+            dbsession.add(a)
+            agents[agent_name] = a
+
+        if tournament_id:
+            tourn = get_db_tournament(tournament_id, dbsession)
+            if not tourn:
+                raise RuntimeError(
+                    "Tournament {} not found in db".format(tournament_id)
+                )
+        else:
+            print("Creating new tournament")
+            tourn = Tournament()
+            tourn.tournament_time = datetime.datetime.now()
+            dbsession.add(tourn)
+        for a in agents.values():
+            if a not in tourn.agents:
+                tourn.agents.append(a)
+
+        # assign ids to the new agents, so that the matches can refer to
+        # them by id - setting Match.pelican_agent / panther_agent on new
+        # agents would populate Agent.matches, whose join condition
+        # covers both columns
+        dbsession.flush()
+
+        print("Creating {} matches".format(len(pairings)))
+        match_time = datetime.datetime.now()
+        new_matches = []
+        for (pelican_agent, panther_agent), game_config in zip(
+            pairings, game_configs
+        ):
+            m = Match()
+            m.pelican_agent_id = agents[pelican_agent].agent_id
+            m.panther_agent_id = agents[panther_agent].agent_id
+            m.game_config = game_config
+            m.match_time = match_time
+            m.num_games = num_games
+            m.logfile_url = LOGFILE_PENDING
+            m.tournament_id = tourn.tournament_id
+            dbsession.add(m)
+            new_matches.append(m)
+
+        dbsession.commit()
+    except Exception:
+        dbsession.rollback()
+        raise
+
+    match_ids = [m.match_id for m in new_matches]
+    return tourn.tournament_id, match_ids
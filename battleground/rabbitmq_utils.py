@@ -0,0 +1,133 @@
+"""
+Helpers for connecting to RabbitMQ, shared by the Battleground and
+Battle classes.
+
+Connections are pooled, so that a match opens one connection (or one per
+concurrently-played game) rather than one per game, and queue names can
+be prefixed so that several matches can share a single broker.
+"""
+
+import os
+import time
+import threading
+import logging
+
+import pika
+
+from pika.adapters.utils.connection_workflow import (
+    AMQPConnectorSocketConnectError,
+)
+
+logger = logging.getLogger("battleground_logger")
+
+
+def get_rabbitmq_host():
+    """
+    Hostname of the RabbitMQ broker, from the RABBITMQ_HOST
+    environment variable.
+    """
+    if "RABBITMQ_HOST" in os.environ.keys():
+        return os.environ["RABBITMQ_HOST"]
+    else:
+        return "localhost"
+
+
+def get_queue_prefix():
+    """
+    Prefix of this match's queue names, from the QUEUE_PREFIX
+    environment variable - empty unless the broker is shared.
+    """
+    return os.environ.get("QUEUE_PREFIX", "")
+
+
+def queue_name(name):
+    """
+    Return the name of a queue for this match.  When several matches
+    share one broker, each match is given its own QUEUE_PREFIX
+    (e.g. "match_12.") so that their queues don't clash.
+    """
+    return get_queue_prefix() + name
+
+
+def connect(hostname=None):
+    """
+    Open a new connection to the broker, waiting for it to become
+    available if necessary.
+    """
+    if hostname is None:
+        hostname = get_rabbitmq_host()
+    while True:
+        try:
+            return pika.BlockingConnection(
+                pika.ConnectionParameters(
+                    host=hostname,
+                    heartbeat=600,
+                    blocked_connection_timeout=300,
+                )
+            )
+        except (
+            pika.exceptions.AMQPConnectionError,
+            AMQPConnectorSocketConnectError,
+        ):
+            logger.info("Waiting for connection...")
+            time.sleep(2)
+
+
+class ConnectionPool:
+    """
+    Pool of open connections to the broker.
+
+    pika connections must not be used by more than one thread at a time,
+    so each user acquires a connection, opens its own channel(s) on it,
+    and releases the connection when it is done.  Released connections
+    are handed out again rather than opening new ones.
+    """
+
+    def __init__(self, hostname=None):
+        self.hostname = hostname
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Return an open connection, reusing an idle one if there is one.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            try:
+                # service heartbeats, and find out if the broker has
+                # closed the connection while it was idle
+                connection.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError:
+                continue
+            if connection.is_open:
+                return connection
+        return connect(self.hostname)
+
+    def release(self, connection):
+        """
+        Give a connection back to the pool.
+        """
+        if connection is None or not connection.is_open:
+            return
+        with self._lock:
+            self._idle.append(connection)
+
+    def close_all(self):
+        """
+        Close all the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+
+# pool used by default throughout the package
+connection_pool = ConnectionPool()
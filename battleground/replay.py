@@ -0,0 +1,188 @@
+"""
+Regenerate the video of a game that was played in "replay" record mode.
+
+The replay log holds the game config, the random seed and every action
+the agents took, so replaying those actions in a new Battle reproduces
+the game, and this time it is rendered.  The video is uploaded to the
+location already stored as the game's video_url.
+
+Usage:
+    python -m battleground.replay --game_id <game_id>
+    python -m battleground.replay --replay_file <path>
+"""
+
+import os
+import argparse
+import tempfile
+from collections import deque
+
+from battleground.battleground import (
+    Battle,
+    RECORD_REPLAY,
+    REPLAY_LOG_SUFFIX,
+    logger,
+)
+from battleground.video import VideoWriter
+from battleground.serialization import load_replay_log
+from battleground.azure_utils import (
+    check_blob_exists,
+    retrieve_blob,
+    write_file_to_blob,
+)
+from battleground.azure_config import config
+from battleground.schema import Game, session
+
+
+class ReplayBattle(Battle):
+    """
+    A Battle whose agents' actions are read from a replay log rather
+    than requested over RabbitMQ.
+    """
+
+    def __init__(self, replay_log, **kwargs):
+        super().__init__(
+            replay_log["game_config"],
+            seed=replay_log["seed"],
+            game_id=replay_log["game_id"],
+            record_mode=RECORD_REPLAY,
+            **kwargs
+        )
+        self.replay_actions = deque(replay_log["actions"])
+
+    def setup_message_queues(self):
+        pass
+
+    def close_message_queues(self):
+        pass
+
+    def get_agent_action(self, agent_type):
+        if not self.replay_actions:
+            raise RuntimeError(
+                "Replay log of game {} ran out of actions".format(self.game_id)
+            )
+        logged_agent_type, action = self.replay_actions.popleft()
+        if logged_agent_type != agent_type:
+            raise RuntimeError(
+                "Replay of game {} out of step: expected a {} action".format(
+                    self.game_id, agent_type
+                )
+            )
+        return action
+
+
+def replay_video(replay_file_path, video_file_path):
+    """
+    Replay the game in a replay log, writing its video.
+
+    Returns:
+        result_code - the result of the replayed game, which should
+            be the same as the one in the log.
+    """
+    replay_log = load_replay_log(replay_file_path)
+    battle = ReplayBattle(replay_log)
+    battle.video_writer = VideoWriter(video_file_path)
+    state, num_turns = battle.run_game()
+    battle.video_writer.close()
+    # the caller uploads the video, so don't start an UploadManager
+    battle.video_writer.wait()
+    if state != replay_log.get("result_code"):
+        logger.warning(
+            "Replay of game {} ended with {}, not {}".format(
+                replay_log["game_id"], state, replay_log.get("result_code")
+            )
+        )
+    return state
+
+
+def find_video(game_id, dbsession=session):
+    """
+    Look up where the video of a game in the database is stored.
+
+    Returns:
+        video_url - the game's video_url
+        exists - False if the video still has to be regenerated from
+            its replay log
+    Raises:
+        RuntimeError - if the game has no video and no replay log
+    """
+    game = dbsession.query(Game).filter_by(game_id=game_id).first()
+    if not game:
+        raise RuntimeError("Game {} not found in db".format(game_id))
+    if not game.video_url:
+        raise RuntimeError(
+            "Game {} was played without a video".format(game_id)
+        )
+    video_filename = os.path.basename(game.video_url)
+    if check_blob_exists(video_filename, config["video_container_name"]):
+        return game.video_url, True
+    if not check_blob_exists(
+        video_filename + REPLAY_LOG_SUFFIX, config["replay_container_name"]
+    ):
+        raise RuntimeError(
+            "Game {} has no video or replay log".format(game_id)
+        )
+    return game.video_url, False
+
+
+def regenerate_video(game_id, force=False, dbsession=session):
+    """
+    Regenerate the video of a game in the database from its replay log,
+    and upload it to the game's video_url, unless it is already there.
+    The replay log and video are only kept locally until the upload is
+    done.
+    """
+    video_url, exists = find_video(game_id, dbsession)
+    video_filename = os.path.basename(video_url)
+    if exists and not force:
+        logger.info("Video {} already exists".format(video_filename))
+        return video_url
+
+    replay_filename = video_filename + REPLAY_LOG_SUFFIX
+    with tempfile.TemporaryDirectory() as destination:
+        retrieved, message = retrieve_blob(
+            replay_filename, config["replay_container_name"], destination
+        )
+        if not retrieved:
+            raise RuntimeError(message)
+        video_file_path = os.path.join(destination, video_filename)
+        replay_video(
+            os.path.join(destination, replay_filename), video_file_path
+        )
+        write_file_to_blob(
+            video_file_path, video_filename, config["video_container_name"]
+        )
+    return video_url
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="regenerate game videos from replay logs"
+    )
+    parser.add_argument(
+        "--game_id",
+        help="id of the game in the database - regenerate and upload",
+        type=int,
+    )
+    parser.add_argument(
+        "--replay_file",
+        help="path to a local replay log - write the video next to it",
+    )
+    parser.add_argument(
+        "--force",
+        help="regenerate the video even if it already exists",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if args.game_id is not None:
+        print(regenerate_video(args.game_id, force=args.force))
+    elif args.replay_file:
+        video_file_path = args.replay_file
+        if video_file_path.endswith(REPLAY_LOG_SUFFIX):
+            video_file_path = video_file_path[: -len(REPLAY_LOG_SUFFIX)]
+        else:
+            video_file_path += ".mp4"
+        print(replay_video(args.replay_file, video_file_path))
+    else:
+        parser.error("one of --game_id or --replay_file is required")
@@ -19,14 +19,22 @@ Pelican destroys the Panther.
 
 """
 
+from contextlib import contextmanager
+
 from sqlalchemy import Table, Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import Index, select, func, and_, inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import relationship, column_property
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy import create_engine
 
 
-from .db_config import DB_CONNECTION_STRING
+from .db_config import (
+    DB_CONNECTION_STRING,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE,
+)
 
 Base = declarative_base()
 
@@ -37,12 +45,21 @@ win_codes = {
     "ESCAPE": "panther",  # Panther has escaped
     "PELICANWIN": "pelican",  # Pelican destroyed Panther
 }
+PELICAN_WIN_CODES = [code for code, w in win_codes.items() if w == "pelican"]
+PANTHER_WIN_CODES = [code for code, w in win_codes.items() if w == "panther"]
+# logfile_url of a match until the battleground has uploaded its logfile,
+# which it does once all the games have been played
+LOGFILE_PENDING = "empty_for_now"
 
 assoc_table = Table(
     "association",
     Base.metadata,
     Column("agent_id", Integer, ForeignKey("agent.agent_id")),
     Column("tournament_id", Integer, ForeignKey("tournament.tournament_id")),
+    # for listing the agents in a tournament, and the tournaments an
+    # agent took part in
+    Index("ix_association_tournament_agent", "tournament_id", "agent_id"),
+    Index("ix_association_agent", "agent_id"),
 )
 
 
@@ -51,7 +68,7 @@ class Team(Base):
     team_id = Column(
         Integer, primary_key=True, nullable=False, autoincrement=True
     )
-    team_name = Column(String(100), nullable=False)
+    team_name = Column(String(100), nullable=False, index=True)
     team_members = Column(String(1000), nullable=False)
     agents = relationship("Agent", uselist=True, back_populates="team")
 
@@ -61,7 +78,7 @@ class Agent(Base):
     agent_id = Column(
         Integer, primary_key=True, nullable=False, autoincrement=True
     )
-    agent_name = Column(String(100), nullable=False)
+    agent_name = Column(String(100), nullable=False, index=True)
     agent_type = Column(String(100), nullable=False)
     team = relationship("Team", back_populates="agents")
     team_id = Column(Integer, ForeignKey("team.team_id"))
@@ -124,6 +141,28 @@ class Match(Base):
     logfile_url = Column(String(100), nullable=False)
     games = relationship("Game", uselist=True, back_populates="match")
 
+    # for looking up the match(es) between two agents.  Not unique, as
+    # a pairing can be replayed (e.g. when a tournament is retried).
+    __table_args__ = (
+        Index(
+            "ix_match_agents",
+            "pelican_agent_id",
+            "panther_agent_id",
+            "tournament_id",
+        ),
+    )
+
+    # games_completed, pelican_wins and panther_wins are counted by the
+    # database when the match is loaded - see below the Game class.
+
+    def games_loaded(self):
+        """
+        True if the games should be counted in Python: either they have
+        already been loaded, or the match hasn't been saved yet (so the
+        counts from the database aren't available).
+        """
+        return "games" in self.__dict__ or self.games_completed is None
+
     def score(self, pelican_or_panther):
         if pelican_or_panther not in ["pelican", "panther"]:
             raise RuntimeError(
@@ -133,6 +172,10 @@ class Match(Base):
                     pelican_or_panther
                 )
             )
+        if not self.games_loaded():
+            if pelican_or_panther == "pelican":
+                return self.pelican_wins
+            return self.panther_wins
         n_wins = 0
         for game in self.games:
             if game.winner == pelican_or_panther:
@@ -149,9 +192,11 @@ class Match(Base):
 
     @property
     def winner(self):
-        if self.pelican_score > self.panther_score:
+        pelican_score = self.pelican_score
+        panther_score = self.panther_score
+        if pelican_score > panther_score:
             return "pelican"
-        elif self.panther_score > self.pelican_score:
+        elif panther_score > pelican_score:
             return "panther"
         else:
             return "draw"
@@ -160,16 +205,21 @@ class Match(Base):
     def winning_agent(self):
         if not self.is_finished:
             return None
-        if self.winner == "pelican":
+        winner = self.winner
+        if winner == "pelican":
             return self.pelican_agent
-        elif self.winner == "panther":
+        elif winner == "panther":
             return self.panther_agent
         else:
             return None
 
     @property
     def is_finished(self):
-        if len(self.games) == self.num_games:
+        if self.games_loaded():
+            num_completed = len(self.games)
+        else:
+            num_completed = self.games_completed
+        if num_completed == self.num_games:
             return True
         else:
             return False
@@ -186,7 +236,7 @@ class Game(Base):
     # link to video (on cloud storage)
     video_url = Column(String(100), nullable=False)
     match = relationship("Match", back_populates="games")
-    match_id = Column(Integer, ForeignKey("match.match_id"))
+    match_id = Column(Integer, ForeignKey("match.match_id"), index=True)
 
     @property
     def winner(self):
@@ -194,13 +244,88 @@ class Game(Base):
         return win_codes[self.result_code]
 
 
-engine = create_engine(DB_CONNECTION_STRING)
+def count_games(*conditions):
+    """
+    Correlated subquery counting a match's games, optionally only those
+    meeting some conditions.
+    """
+    return (
+        select([func.count(Game.game_id)])
+        .where(and_(Game.match_id == Match.match_id, *conditions))
+        .correlate_except(Game)
+        .as_scalar()
+    )
+
+
+# counted in the same query that loads the match, rather than by
+# loading all its games
+Match.games_completed = column_property(count_games())
+Match.pelican_wins = column_property(
+    count_games(Game.result_code.in_(PELICAN_WIN_CODES))
+)
+Match.panther_wins = column_property(
+    count_games(Game.result_code.in_(PANTHER_WIN_CODES))
+)
+
+
+def create_missing_indexes(engine):
+    """
+    create_all doesn't add new indexes to tables that already exist,
+    so add any that are missing from a database created by an earlier
+    version of this schema.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+
+
+def make_engine(connection_string=DB_CONNECTION_STRING):
+    """
+    Create an engine with a pool of connections, checked before use so
+    that connections dropped by the server are replaced transparently.
+    """
+    if connection_string.startswith("sqlite"):
+        # sqlite doesn't use a connection pool
+        return create_engine(connection_string)
+    return create_engine(
+        connection_string,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+
+engine = make_engine()
 
 Base.metadata.create_all(engine)
+create_missing_indexes(engine)
 # Bind the engine to the metadata of the Base class so that the
 # declaratives can be accessed through a DBSession instance
 Base.metadata.bind = engine
 
 DBSession = sessionmaker(bind=engine, autoflush=False)
-# global database session used by default throughout the package
-session = DBSession()
+# database session used by default throughout the package.  Each thread
+# that uses it gets its own session (and connection from the pool);
+# call session.remove() when a thread (e.g. a web request) is done.
+session = scoped_session(DBSession)
+
+
+@contextmanager
+def session_scope():
+    """
+    Provide a new session, committed at the end of the block (or rolled
+    back if there is an error), then closed.
+    """
+    new_session = DBSession()
+    try:
+        yield new_session
+        new_session.commit()
+    except Exception:
+        new_session.rollback()
+        raise
+    finally:
+        new_session.close()
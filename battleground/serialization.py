@@ -1,11 +1,16 @@
 """
 Marshmallow schemas for serializing/deserializing game objects
-so that they can be sent as JSON
+so that they can be sent as JSON, and encoding/decoding of the
+messages sent to the agents.
 """
 
+import gzip
+import json
+
+import msgpack
+import numpy as np
 from marshmallow import Schema, fields, post_load
 
-import plark_game
 from plark_game.classes.sonobuoy import Sonobuoy
 from plark_game.classes.torpedo import Torpedo
 
@@ -45,6 +50,95 @@ class TorpedoSchema(Schema):
         return t
 
 
+# schema instances are created once and reused
+sonobuoy_schema = SonobuoySchema()
+torpedo_schema = TorpedoSchema()
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def _int_list(value):
+    return None if value is None else [int(v) for v in value]
+
+
+# the fields dumped for each type of game object, with the same
+# conversions as the marshmallow schemas above
+SONOBUOY_FIELDS = (
+    ("type", _str),
+    ("col", _int),
+    ("row", _int),
+    ("range", _int),
+    ("state", _str),
+    ("size", _int),
+)
+TORPEDO_FIELDS = (
+    ("id", _str),
+    ("type", _str),
+    ("col", _int),
+    ("row", _int),
+    ("turn", _int),
+    ("size", _int),
+    ("speed", _int_list),
+    ("searchRadius", _int),
+)
+
+# types that are returned as they are
+PLAIN_TYPES = (str, int, float, bool, type(None))
+
+
+def dump_game_object(obj, object_fields):
+    """
+    Convert a Sonobuoy or Torpedo to a dict, giving the same output
+    as the marshmallow schema's dump (attributes that the object
+    doesn't have are left out), without the overhead.
+    """
+    output = {}
+    for name, convert in object_fields:
+        try:
+            value = getattr(obj, name)
+        except AttributeError:
+            continue
+        output[name] = convert(value)
+    return output
+
+
+def _serialize(input_obj):
+    if isinstance(input_obj, PLAIN_TYPES):
+        return input_obj
+    if isinstance(input_obj, dict):
+        return {k: _serialize(v) for k, v in input_obj.items()}
+    if isinstance(input_obj, list):
+        return [_serialize(item) for item in input_obj]
+    if isinstance(input_obj, Sonobuoy):
+        return dump_game_object(input_obj, SONOBUOY_FIELDS)
+    if isinstance(input_obj, Torpedo):
+        return dump_game_object(input_obj, TORPEDO_FIELDS)
+    # any other type, just return as is
+    return input_obj
+
+
+def _deserialize(input_obj):
+    if isinstance(input_obj, dict):
+        # create Sonobuoy or Torpedo objects out of dicts that have
+        # the appropriate 'type'
+        object_type = input_obj.get("type")
+        if object_type == "SONOBUOY":
+            return sonobuoy_schema.load(input_obj)
+        if object_type == "TORPEDO":
+            return torpedo_schema.load(input_obj)
+        # for all other dicts, recursively look through their values
+        return {k: _deserialize(v) for k, v in input_obj.items()}
+    if isinstance(input_obj, list):
+        return [_deserialize(item) for item in input_obj]
+    return input_obj
+
+
 def serializer(input_obj, mode="serialize"):
     """
     Recursive function to convert any Torpedo or Sonobuoy objects in the state
@@ -59,49 +153,13 @@ def serializer(input_obj, mode="serialize"):
     =======
     output: json-serialized, or de-serialized, version of the input_obj
     """
-    if mode not in ["serialize", "deserialize"]:
-        raise RuntimeError(
-            "mode must be one of 'serialize', 'deserialize', not {}".format(
-                mode
-            )
-        )
-    output = None
-    sbs = SonobuoySchema()
-    ts = TorpedoSchema()
-    if isinstance(input_obj, dict):
-        # if we are deserializing, create Sonobuoy or Torpedo objects out of
-        # dicts that have the appropriate 'type'
-        if (
-            mode == "deserialize"
-            and "type" in input_obj.keys()
-            and input_obj["type"] == "SONOBUOY"
-        ):
-            output = sbs.load(input_obj)
-        elif (
-            mode == "deserialize"
-            and "type" in input_obj.keys()
-            and input_obj["type"] == "TORPEDO"
-        ):
-            output = ts.load(input_obj)
-        # for all other dicts, recursively look through their keys, values
-        else:
-            output = {}
-            for k, v in input_obj.items():
-                output[k] = serializer(v, mode)
-    elif isinstance(input_obj, list):
-        output = []
-        for item in input_obj:
-            output.append(serializer(item, mode))
-    # if we have an instance of Sonobuoy or Torpedo,
-    # use marshmallow schema to serialize
-    elif isinstance(input_obj, plark_game.classes.sonobuoy.Sonobuoy):
-        output = sbs.dump(input_obj)
-    elif isinstance(input_obj, plark_game.classes.torpedo.Torpedo):
-        output = ts.dump(input_obj)
-    # any other type, just return as is
-    else:
-        output = input_obj
-    return output
+    if mode == "serialize":
+        return _serialize(input_obj)
+    elif mode == "deserialize":
+        return _deserialize(input_obj)
+    raise RuntimeError(
+        "mode must be one of 'serialize', 'deserialize', not {}".format(mode)
+    )
 
 
 def serialize_state(game_state):
@@ -110,3 +168,152 @@ def serialize_state(game_state):
 
 def deserialize_state(game_state):
     return serializer(game_state, "deserialize")
+
+
+def state_delta(previous, current):
+    """
+    Difference between two serialized states, as sent to agents that
+    use the "state_delta" protocol.
+
+    Parameters
+    ==========
+    previous: dict, the last serialized state sent to the agent
+    current: dict, the new serialized state
+
+    Returns
+    =======
+    delta: dict, {"changed": {key: new value}, "removed": [key, ...]}
+    """
+    changed = {
+        k: v
+        for k, v in current.items()
+        if k not in previous or previous[k] != v
+    }
+    removed = [k for k in previous.keys() if k not in current]
+    return {"changed": changed, "removed": removed}
+
+
+def apply_state_delta(previous, delta):
+    """
+    Rebuild the new serialized state from the previous one and a delta
+    produced by state_delta.
+    """
+    state = dict(previous)
+    state.update(delta["changed"])
+    for k in delta["removed"]:
+        state.pop(k, None)
+    return state
+
+
+# encodings that agents can ask for in their "ready" message
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+CONTENT_TYPES = {
+    ENCODING_JSON: "application/json",
+    ENCODING_MSGPACK: "application/msgpack",
+}
+
+
+def _json_default(obj):
+    """
+    Convert numpy arrays and scalars for json.dumps
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Cannot serialize {}".format(type(obj)))
+
+
+def _msgpack_default(obj):
+    """
+    Pack numpy arrays as raw float32 or int32 buffers, along with their
+    dtype and shape, so that they can be rebuilt without parsing.
+    """
+    if isinstance(obj, np.ndarray):
+        if np.issubdtype(obj.dtype, np.floating):
+            obj = obj.astype(np.float32)
+        elif np.issubdtype(obj.dtype, np.integer) or obj.dtype == bool:
+            obj = obj.astype(np.int32)
+        else:
+            return obj.tolist()
+        return {
+            "__ndarray__": True,
+            "dtype": obj.dtype.str,
+            "shape": list(obj.shape),
+            "data": obj.tobytes(),
+        }
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Cannot serialize {}".format(type(obj)))
+
+
+def _msgpack_object_hook(obj):
+    if obj.get("__ndarray__"):
+        return np.frombuffer(obj["data"], dtype=obj["dtype"]).reshape(
+            obj["shape"]
+        )
+    return obj
+
+
+def encode_message(body, encoding=ENCODING_JSON):
+    """
+    Encode the body of a message to an agent.
+
+    Parameters
+    ==========
+    body: dict, may contain numpy arrays
+    encoding: str, "json" or "msgpack"
+
+    Returns
+    =======
+    payload: bytes or str, the encoded message
+    content_type: str, MIME type to send with the message
+    """
+    if encoding == ENCODING_JSON:
+        payload = json.dumps(body, default=_json_default)
+    elif encoding == ENCODING_MSGPACK:
+        payload = msgpack.packb(
+            body, default=_msgpack_default, use_bin_type=True
+        )
+    else:
+        raise RuntimeError(
+            "encoding must be one of {}, not {}".format(
+                list(CONTENT_TYPES.keys()), encoding
+            )
+        )
+    return payload, CONTENT_TYPES[encoding]
+
+
+def decode_message(payload, encoding=ENCODING_JSON):
+    """
+    Decode a message encoded by encode_message.  Arrays sent as msgpack
+    come back as (read-only) numpy arrays.
+    """
+    if encoding == ENCODING_JSON:
+        return json.loads(payload)
+    elif encoding == ENCODING_MSGPACK:
+        return msgpack.unpackb(
+            payload, object_hook=_msgpack_object_hook, raw=False
+        )
+    raise RuntimeError(
+        "encoding must be one of {}, not {}".format(
+            list(CONTENT_TYPES.keys()), encoding
+        )
+    )
+
+
+def dump_replay_log(replay_log, file_path):
+    """
+    Write a game's replay log (a JSON-serializable dict) as gzipped JSON.
+    """
+    with gzip.open(file_path, "wt", encoding="utf-8") as replay_file:
+        json.dump(replay_log, replay_file, separators=(",", ":"))
+
+
+def load_replay_log(file_path):
+    """
+    Read a replay log written by dump_replay_log.
+    """
+    with gzip.open(file_path, "rt", encoding="utf-8") as replay_file:
+        return json.load(replay_file)
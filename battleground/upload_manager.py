@@ -0,0 +1,283 @@
+"""
+Background uploads of match artifacts (videos, replay logs, logfiles)
+to blob storage.
+
+Files handed to the UploadManager are uploaded by a pool of worker
+threads, so the game loop can move straight on to the next game.  Files
+submitted with delete_after_upload=True (the temporary files the
+battleground writes to its output directory) are deleted once their
+upload has succeeded; other files are left where they are.
+Each pending upload is also recorded in a small JSON file in a spool
+directory, and only removed once the upload has succeeded, so uploads
+that were interrupted (or kept failing) are retried the next time the
+battleground starts.  The spool directory can be shared by several
+battlegrounds (the match templates mount it from the host): each one
+holds a lock on the spool files of its own uploads, so the others only
+resume uploads whose battleground has gone.
+"""
+
+import os
+import json
+import uuid
+import glob
+import fcntl
+import queue
+import threading
+import time
+import logging
+
+from battleground.azure_utils import write_file_to_blob
+
+logger = logging.getLogger("battleground_logger")
+
+UPLOAD_SPOOL_DIR = (
+    os.environ.get("UPLOAD_SPOOL_DIR") or "/tmp/plark_upload_spool"
+)
+NUM_UPLOAD_WORKERS = 4
+# connections used to upload the blocks of one file in parallel
+BLOCK_UPLOAD_CONNECTIONS = 4
+MAX_UPLOAD_ATTEMPTS = 5
+# seconds to wait before retrying, doubled after each failed attempt
+UPLOAD_RETRY_DELAY = 2
+
+
+class UploadManager:
+    """
+    Upload files to blob storage on a pool of background threads.
+
+    Usage:
+        manager = get_upload_manager()
+        manager.submit(file_path, blob_name, container_name)
+        ...
+        manager.join()  # wait for all the uploads before exiting
+    """
+
+    def __init__(
+        self,
+        spool_dir=UPLOAD_SPOOL_DIR,
+        num_workers=NUM_UPLOAD_WORKERS,
+        max_connections=BLOCK_UPLOAD_CONNECTIONS,
+        max_attempts=MAX_UPLOAD_ATTEMPTS,
+        retry_delay=UPLOAD_RETRY_DELAY,
+    ):
+        self.spool_dir = spool_dir
+        self.num_workers = num_workers
+        self.max_connections = max_connections
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # uploads that gave up after max_attempts
+        self.failed = []
+        self.jobs = queue.Queue()
+        self.workers = []
+        self._lock = threading.Lock()
+        # spool path -> file descriptor holding the lock on it
+        self._claims = {}
+
+    def start(self):
+        """
+        Start the worker threads, and queue any uploads left in the
+        spool directory by a previous run.
+        """
+        with self._lock:
+            if self.workers:
+                return
+            os.makedirs(self.spool_dir, exist_ok=True)
+            for _ in range(self.num_workers):
+                worker = threading.Thread(target=self._work, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+        self.resume()
+
+    def resume(self):
+        """
+        Queue the uploads recorded in the spool directory, other than
+        those still locked by a running battleground.
+        """
+        for spool_path in sorted(
+            glob.glob(os.path.join(self.spool_dir, "*.json"))
+        ):
+            if spool_path in self._claims or not self._claim(spool_path):
+                continue
+            try:
+                with open(spool_path) as spool_file:
+                    job = json.load(spool_file)
+            except (FileNotFoundError, ValueError):
+                # removed once its upload finished, or never written
+                self._release(spool_path, remove=True)
+                continue
+            if not os.path.exists(job["file_path"]):
+                logger.warning(
+                    "Dropping upload of missing file {}".format(
+                        job["file_path"]
+                    )
+                )
+                self._release(spool_path, remove=True)
+                continue
+            logger.info("Resuming upload of {}".format(job["file_path"]))
+            job["spool_path"] = spool_path
+            self.jobs.put(job)
+
+    def submit(
+        self, file_path, blob_name, container_name, delete_after_upload=False
+    ):
+        """
+        Queue a file to be uploaded, and return straight away.
+
+        Arguments:
+            delete_after_upload - delete the file once it has been
+                uploaded.  Only for temporary files that nothing else
+                will read.
+        """
+        if not self.workers:
+            self.start()
+        job = {
+            "file_path": os.path.abspath(file_path),
+            "blob_name": blob_name,
+            "container_name": container_name,
+            "delete_after_upload": delete_after_upload,
+            "attempts": 0,
+        }
+        while True:
+            job["spool_path"] = os.path.join(
+                self.spool_dir, "{}.json".format(uuid.uuid4().hex)
+            )
+            # another battleground's resume pass can lock the new spool
+            # file before we do (and drop it, as it is still empty), so
+            # only queue the job under a spool file we hold
+            if self._claim(job["spool_path"]):
+                break
+        self._write_spool(job)
+        self.jobs.put(job)
+
+    def join(self):
+        """
+        Block until every queued upload has either succeeded or given up.
+
+        Returns:
+            failed - list of the uploads that gave up
+        """
+        self.jobs.join()
+        return self.failed
+
+    def _claim(self, spool_path):
+        """
+        Take the lock on a spool file (creating it if need be), so that
+        no other battleground resumes its upload.  The lock is released
+        by the OS if this process dies.
+
+        Returns:
+            claimed - False if another process holds the lock, or the
+                file has already been removed
+        """
+        fd = os.open(spool_path, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        if os.fstat(fd).st_nlink == 0:
+            # removed by the process we were waiting for
+            os.close(fd)
+            return False
+        with self._lock:
+            self._claims[spool_path] = fd
+        return True
+
+    def _release(self, spool_path, remove=False):
+        """
+        Release the lock on a spool file, removing it first if the
+        upload no longer needs to be retried.
+        """
+        if remove:
+            try:
+                os.remove(spool_path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            fd = self._claims.pop(spool_path, None)
+        if fd is not None:
+            os.close(fd)
+
+    def _remove_file(self, file_path):
+        """
+        Delete a temporary file once it has been uploaded, so artifacts
+        don't build up in the match output directory on the host.
+        """
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Couldn't remove {}: {}".format(file_path, e))
+
+    def _write_spool(self, job):
+        with open(job["spool_path"], "w") as spool_file:
+            json.dump(
+                {k: v for k, v in job.items() if k != "spool_path"},
+                spool_file,
+            )
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self._upload(job)
+            finally:
+                self.jobs.task_done()
+
+    def _upload(self, job):
+        while True:
+            try:
+                write_file_to_blob(
+                    job["file_path"],
+                    job["blob_name"],
+                    job["container_name"],
+                    max_connections=self.max_connections,
+                )
+                self._release(job["spool_path"], remove=True)
+                if job.get("delete_after_upload"):
+                    self._remove_file(job["file_path"])
+                logger.info(
+                    "Uploaded {} to {}/{}".format(
+                        job["file_path"],
+                        job["container_name"],
+                        job["blob_name"],
+                    )
+                )
+                return
+            except Exception as e:
+                job["attempts"] += 1
+                self._write_spool(job)
+                if job["attempts"] >= self.max_attempts:
+                    # left in the spool, to be retried on the next start
+                    logger.error(
+                        "Giving up uploading {} after {} attempts: {}".format(
+                            job["file_path"], job["attempts"], e
+                        )
+                    )
+                    self.failed.append(job)
+                    self._release(job["spool_path"])
+                    return
+                logger.warning(
+                    "Upload of {} failed ({}), retrying".format(
+                        job["file_path"], e
+                    )
+                )
+                time.sleep(self.retry_delay * 2 ** (job["attempts"] - 1))
+
+
+_upload_manager = None
+_upload_manager_lock = threading.Lock()
+
+
+def get_upload_manager():
+    """
+    Return the UploadManager shared by the whole process, creating and
+    starting it on first use.
+    """
+    global _upload_manager
+    with _upload_manager_lock:
+        if _upload_manager is None:
+            _upload_manager = UploadManager()
+    _upload_manager.start()
+    return _upload_manager
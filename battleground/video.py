@@ -0,0 +1,123 @@
+"""
+Writing game videos on a background thread.
+
+The game loop only renders each frame and pushes it onto a bounded queue;
+a worker thread resizes and encodes the frames, and can then hand the
+finished video on (e.g. to be uploaded), so that the game's timing
+doesn't depend on the speed of the video codec.
+"""
+
+import queue
+import threading
+import logging
+
+import numpy as np
+import imageio
+import PIL.Image
+
+logger = logging.getLogger("battleground_logger")
+
+VIDEO_BASE_WIDTH = 512
+VIDEO_FPS = 1
+# maximum number of frames waiting to be encoded, before the game loop
+# has to wait for the encoder to catch up
+MAX_QUEUED_FRAMES = 50
+
+
+def resize_frame(image, base_width=VIDEO_BASE_WIDTH):
+    """
+    Resize a rendered frame to the video width, keeping its aspect ratio,
+    and return it as an array.
+    """
+    wpercent = base_width / float(image.size[0])
+    hsize = int((float(image.size[1]) * float(wpercent)))
+
+    res_image = image.resize((base_width, hsize), PIL.Image.ANTIALIAS)
+
+    return np.copy(np.array(res_image))
+
+
+class VideoWriter:
+    """
+    Encode frames to a video file on a background thread.
+
+    Usage:
+        writer = VideoWriter("game.mp4", on_finished=upload)
+        writer.add_frame(image)  # for each turn
+        writer.close()  # no more frames
+        writer.wait()  # optional - block until the video is done
+    """
+
+    def __init__(
+        self,
+        video_file_path,
+        fps=VIDEO_FPS,
+        base_width=VIDEO_BASE_WIDTH,
+        max_queued_frames=MAX_QUEUED_FRAMES,
+        on_finished=None,
+    ):
+        """
+        Arguments:
+            video_file_path - where to write the video
+            fps - frames per second of the video
+            base_width - width, in pixels, of the video
+            max_queued_frames - size of the queue of frames waiting to be
+                encoded
+            on_finished - optional function called (on the worker thread)
+                with video_file_path once the video has been written
+        """
+        self.video_file_path = video_file_path
+        self.fps = fps
+        self.base_width = base_width
+        self.on_finished = on_finished
+        self.error = None
+        self.frames = queue.Queue(maxsize=max_queued_frames)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_frame(self, image):
+        """
+        Queue a rendered PIL image to be added to the video.  Only blocks
+        if the queue is full.
+        """
+        # copy, in case the renderer reuses its image
+        self.frames.put(image.copy())
+
+    def close(self):
+        """
+        Signal that there are no more frames.
+        """
+        self.frames.put(None)
+
+    def wait(self):
+        """
+        Block until the video has been written (and on_finished has run),
+        re-raising any error from the worker thread.
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        closed = False
+        try:
+            writer = imageio.get_writer(self.video_file_path, fps=self.fps)
+            try:
+                while True:
+                    image = self.frames.get()
+                    if image is None:
+                        closed = True
+                        break
+                    writer.append_data(resize_frame(image, self.base_width))
+            finally:
+                writer.close()
+            if self.on_finished is not None:
+                self.on_finished(self.video_file_path)
+        except Exception as e:
+            logger.error(
+                "Failed to write video {}: {}".format(self.video_file_path, e)
+            )
+            self.error = e
+            # don't leave the game loop blocked on a full queue
+            while not closed:
+                closed = self.frames.get() is None
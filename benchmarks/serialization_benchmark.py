@@ -0,0 +1,109 @@
+"""
+Benchmark battleground.serialization.serialize_state against the
+previous implementation, which created new marshmallow schemas on every
+recursive call and dumped Sonobuoys and Torpedos through marshmallow.
+
+Usage:
+    python benchmarks/serialization_benchmark.py [--repeats N]
+"""
+
+import argparse
+import timeit
+
+from plark_game.classes.sonobuoy import Sonobuoy
+from plark_game.classes.torpedo import Torpedo
+
+from battleground.serialization import (
+    SonobuoySchema,
+    TorpedoSchema,
+    serialize_state,
+)
+
+
+def reference_serializer(input_obj):
+    """
+    The previous implementation of serializer(input_obj, "serialize").
+    """
+    sbs = SonobuoySchema()
+    ts = TorpedoSchema()
+    if isinstance(input_obj, dict):
+        output = {}
+        for k, v in input_obj.items():
+            output[k] = reference_serializer(v)
+    elif isinstance(input_obj, list):
+        output = []
+        for item in input_obj:
+            output.append(reference_serializer(item))
+    elif isinstance(input_obj, Sonobuoy):
+        output = sbs.dump(input_obj)
+    elif isinstance(input_obj, Torpedo):
+        output = ts.dump(input_obj)
+    else:
+        output = input_obj
+    return output
+
+
+def make_state(num_sonobuoys=10, num_torpedoes=2):
+    """
+    A game state of roughly the shape returned by Battle._state,
+    with a number of deployed sonobuoys and torpedoes.
+    """
+    sonobuoys = []
+    for i in range(num_sonobuoys):
+        sb = Sonobuoy(3)
+        sb.col = i
+        sb.row = i + 1
+        sb.state = "HOT" if i % 2 else "COLD"
+        sonobuoys.append(sb)
+    torpedoes = []
+    for i in range(num_torpedoes):
+        torpedoes.append(
+            Torpedo(
+                id="t{}".format(i),
+                col=i,
+                row=i,
+                turn=1,
+                speed=[2, 1],
+                searchRadius=2,
+            )
+        )
+    return {
+        "game_state": "Running",
+        "turn": 12,
+        "map_width": 35,
+        "map_height": 35,
+        "pelican_col": 4,
+        "pelican_row": 7,
+        "pelican_max_moves": 10,
+        "panther_col": 20,
+        "panther_row": 30,
+        "deployed_sonobuoys": sonobuoys,
+        "deployed_torpedoes": torpedoes,
+        "remaining_sonobuoys": 5,
+        "remaining_torpedoes": 3,
+        "madman_status": False,
+        "hexagons": [[0] * 35 for _ in range(35)],
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="benchmark game state serialization"
+    )
+    parser.add_argument("--repeats", type=int, default=1000)
+    args = parser.parse_args()
+
+    state = make_state()
+    assert serialize_state(state) == reference_serializer(state)
+
+    for name, function in [
+        ("previous", reference_serializer),
+        ("current", serialize_state),
+    ]:
+        seconds = timeit.timeit(lambda: function(state), number=args.repeats)
+        print(
+            "{:>8}: {:8.1f} us per state".format(
+                name, 1e6 * seconds / args.repeats
+            )
+        )
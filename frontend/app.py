@@ -93,11 +93,12 @@ def tournament(tid):
     """
     basic homepage - options to view results table or run a new test.
     """
-    url = BASE_URL+"/tournaments/{}".format(tid)
+    # results of all the matches in the tournament, in one request
+    url = BASE_URL+"/tournaments/{}/results".format(tid)
     r = requests.get(url)
     if r.status_code is not 200:
         raise RuntimeError("Couldn't reach API {}".format(url))
-    match_ids = r.json()["matches"]
+    results = r.json()
     ## prepare a dict to turn into a plot
     panther_agents = []
     pelican_agents = []
@@ -107,8 +108,7 @@ def tournament(tid):
     logfiles = []
     # loop over all the matches in the tournament
     matches = []
-    for mid in match_ids:
-        match_data = get_data("matches", mid)
+    for match_data in results:
         for _ in range(2):
             panther_agents.append(match_data["panther"])
             pelican_agents.append(match_data["pelican"])
@@ -152,7 +152,8 @@ def match(mid):
         games.append(game_data)
     return render_template(
         "match.html", mid=mid,
-        games=games
+        games=games,
+        base_url=BASE_URL
     )
 
 
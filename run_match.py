@@ -7,8 +7,27 @@ if __name__ == "__main__":
         raise RuntimeError("MATCH_ID not found in environment")
     match_id = os.environ["MATCH_ID"]
 
+    # optional per-move deadline for the agents, and the action
+    # applied on their behalf when they miss it
+    battle_kwargs = {}
+    if os.environ.get("MOVE_TIMEOUT"):
+        battle_kwargs["move_timeout"] = float(os.environ["MOVE_TIMEOUT"])
+    if os.environ.get("TIMEOUT_ACTION"):
+        battle_kwargs["timeout_action"] = os.environ["TIMEOUT_ACTION"]
+
+    # "video" (default), "replay" or "none" - games recorded for replay
+    # are set up to be reproducible from their seeds
+    record_mode = os.environ.get("RECORD_MODE") or "video"
+    battle_kwargs["record_mode"] = record_mode
+
     bg = Battleground(match_id=match_id)
 
-    bg.setup_games()
-    bg.listen_for_ready()
-    bg.play()
+    bg.setup_games(**battle_kwargs)
+    # optional limit on how long to wait for the agents to be ready
+    ready_timeout = None
+    if os.environ.get("READY_TIMEOUT"):
+        ready_timeout = float(os.environ["READY_TIMEOUT"])
+    bg.listen_for_ready(timeout=ready_timeout)
+    # number of games of the match to play at the same time
+    num_workers = int(os.environ.get("NUM_GAME_WORKERS") or 1)
+    bg.play(num_workers=num_workers, record_mode=record_mode)
@@ -0,0 +1,42 @@
+"""
+Test the API's response cache
+"""
+from api.api_cache import ResponseCache
+
+
+def test_lru_eviction():
+    """
+    Least recently used entries are dropped beyond max_entries
+    """
+    cache = ResponseCache(max_entries=2, cache_dir=None)
+    cache.set("matches/1", {"match_id": 1}, immutable=True)
+    cache.set("matches/2", {"match_id": 2}, immutable=True)
+    assert cache.get("matches/1") is not None
+    cache.set("matches/3", {"match_id": 3}, immutable=True)
+    assert cache.get("matches/2") is None
+    assert cache.get("matches/1") is not None
+
+
+def test_mutable_entries_expire():
+    """
+    Entries that may change are only cached for ttl seconds
+    """
+    cache = ResponseCache(cache_dir=None, ttl=0)
+    entry = cache.set("matches/1", {"match_id": 1}, immutable=False)
+    assert "immutable" not in entry.cache_control
+    assert cache.get("matches/1") is None
+
+
+def test_disk_backend(tmpdir):
+    """
+    Immutable entries are reloaded from disk, with the same ETag
+    """
+    cache = ResponseCache(cache_dir=str(tmpdir))
+    entry = cache.set("games/7", {"game_id": 7}, immutable=True)
+    cache.set("games/8", {"game_id": 8}, immutable=False)
+    new_cache = ResponseCache(cache_dir=str(tmpdir))
+    reloaded = new_cache.get("games/7")
+    assert reloaded.etag == entry.etag
+    assert reloaded.body == entry.body
+    assert "immutable" in reloaded.cache_control
+    assert new_cache.get("games/8") is None
@@ -0,0 +1,188 @@
+"""
+Test the API's query functions
+"""
+import datetime
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from battleground.conftest import test_session_scope, testengine
+from battleground.schema import Game
+from battleground.db_utils import bootstrap_tournament
+from api.api_utils import (
+    get_tournament,
+    get_tournament_results,
+    get_match,
+    list_agents,
+    list_matches,
+    list_tournaments,
+    results_to_columns,
+)
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL statements run inside the block
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(testengine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(
+            testengine, "before_cursor_execute", before_cursor_execute
+        )
+
+
+def make_tournament(tsession, num_matches):
+    pairings = [
+        ("api_team_a:pelican_{}".format(i), "api_team_b:panther_{}".format(i))
+        for i in range(num_matches)
+    ]
+    tournament_id, match_ids = bootstrap_tournament(
+        pairings,
+        ["10x10_balanced.json"] * num_matches,
+        num_games=2,
+        dbsession=tsession,
+    )
+    for match_id in match_ids:
+        for result_code in ["PELICANWIN", "PELICANWIN"]:
+            g = Game()
+            g.game_time = datetime.datetime.now()
+            g.num_turns = 10
+            g.result_code = result_code
+            g.video_url = ""
+            g.match_id = match_id
+            tsession.add(g)
+    tsession.commit()
+    tsession.expunge_all()
+    return tournament_id, sorted(match_ids)
+
+
+def test_get_tournament():
+    """
+    The number of queries doesn't depend on the number of matches
+    """
+    with test_session_scope() as tsession:
+        tournament_id, match_ids = make_tournament(tsession, 5)
+        with count_queries() as statements:
+            info = get_tournament(tournament_id, dbsession=tsession)
+            matches = list_matches(tournament_id, dbsession=tsession)
+        assert len(statements) == 4
+        assert info["matches"] == match_ids
+        assert len(info["pelican_agents"]) == 5
+        assert len(info["panther_agents"]) == 5
+        assert [m["match_id"] for m in matches] == match_ids
+        assert matches[0]["pelican"] == "api_team_a:pelican_0"
+
+
+def test_get_match():
+    """
+    Scores and winner are counted by the database
+    """
+    with test_session_scope() as tsession:
+        _, match_ids = make_tournament(tsession, 1)
+        with count_queries() as statements:
+            info = get_match(match_ids[0], dbsession=tsession)
+        assert len(statements) == 2
+        assert info["pelican_score"] == 2
+        assert info["panther_score"] == 0
+        assert info["winner"] == "api_team_a:pelican_0"
+        assert len(info["games"]) == 2
+
+
+def test_list_agents():
+    """
+    Agents can be filtered by any combination of tournament, type and
+    team, in one query.
+    """
+    with test_session_scope() as tsession:
+        tournament_id, _ = make_tournament(tsession, 2)
+        with count_queries() as statements:
+            pelicans = list_agents(
+                tournament=str(tournament_id),
+                agent_type="pelican",
+                dbsession=tsession,
+            )
+        assert len(statements) == 1
+        assert pelicans == ["api_team_a:pelican_0", "api_team_a:pelican_1"]
+        assert list_agents(
+            tournament=tournament_id, team="api_team_b", dbsession=tsession
+        ) == ["api_team_b:panther_0", "api_team_b:panther_1"]
+        assert "api_team_a:pelican_0" in list_agents(dbsession=tsession)
+
+
+def test_list_tournaments_pages():
+    """
+    Listing tournaments a page at a time gives them all, once each
+    """
+    with test_session_scope() as tsession:
+        for _ in range(3):
+            make_tournament(tsession, 1)
+        all_ids = [
+            t["tournament_id"] for t in list_tournaments(dbsession=tsession)
+        ]
+        paged_ids = []
+        after_id = None
+        while True:
+            page = list_tournaments(
+                limit=2,
+                after_id=after_id,
+                fields=["tournament_id"],
+                dbsession=tsession,
+            )
+            assert len(page) <= 2
+            assert all(list(t.keys()) == ["tournament_id"] for t in page)
+            paged_ids += [t["tournament_id"] for t in page]
+            after_id = page.next_after_id
+            if after_id is None:
+                break
+        assert paged_ids == all_ids
+
+
+def test_get_tournament_results():
+    """
+    All the match results come from one query
+    """
+    with test_session_scope() as tsession:
+        tournament_id, match_ids = make_tournament(tsession, 3)
+        with count_queries() as statements:
+            results = get_tournament_results(tournament_id, dbsession=tsession)
+        assert len(statements) == 1
+        assert [r["match_id"] for r in results] == match_ids
+        assert results[0]["pelican_score"] == 2
+        assert results[0]["panther_score"] == 0
+        assert results[0]["winner"] == results[0]["pelican"]
+        columns = results_to_columns(results)
+        assert columns["agent_type"][:2] == ["panther", "pelican"]
+        assert columns["score"][:2] == [0, 2]
+        assert len(columns["configs"]) == 6
+
+
+def test_get_tournament_results_db_error():
+    """
+    A database error is rolled back and raised, not returned as a
+    tournament without results.
+    """
+
+    class FailingSession:
+        def __init__(self):
+            self.rolled_back = False
+
+        def query(self, *args):
+            raise OperationalError("SELECT", {}, Exception("db down"))
+
+        def rollback(self):
+            self.rolled_back = True
+
+    dbsession = FailingSession()
+    with pytest.raises(OperationalError):
+        get_tournament_results(1, dbsession=dbsession)
+    assert dbsession.rolled_back
@@ -0,0 +1,133 @@
+"""
+Test azure_utils.py module
+"""
+from azure.common import AzureMissingResourceHttpError
+
+from battleground import azure_utils
+from battleground.azure_utils import (
+    _json_memo,
+    check_blob_exists,
+    clear_blob_name_cache,
+    delete_blob,
+    read_json,
+)
+
+
+class MockBlobService:
+    def __init__(self, blob_names):
+        self.blob_names = set(blob_names)
+        self.num_listings = 0
+
+    def exists(self, container_name, blob_name=None):
+        return blob_name in self.blob_names
+
+    def list_blob_names(self, container_name):
+        self.num_listings += 1
+        return list(self.blob_names)
+
+    def delete_blob(self, container_name, blob_name):
+        if blob_name not in self.blob_names:
+            raise AzureMissingResourceHttpError("not found", 404)
+        self.blob_names.remove(blob_name)
+
+
+def test_check_blob_exists():
+    """
+    Single checks don't list the container.
+    """
+    bbs = MockBlobService(["a.mp4", "b.mp4"])
+    assert check_blob_exists("a.mp4", "videos", bbs)
+    assert not check_blob_exists("c.mp4", "videos", bbs)
+    assert bbs.num_listings == 0
+
+
+def test_check_blob_exists_cached():
+    """
+    Cached checks list the container once, and see deletions.
+    """
+    clear_blob_name_cache()
+    bbs = MockBlobService(["a.mp4", "b.mp4"])
+    assert check_blob_exists("a.mp4", "videos", bbs, use_cache=True)
+    assert check_blob_exists("b.mp4", "videos", bbs, use_cache=True)
+    assert bbs.num_listings == 1
+    delete_blob("a.mp4", "videos", bbs)
+    assert not check_blob_exists("a.mp4", "videos", bbs, use_cache=True)
+    # deleting a missing blob is not an error
+    delete_blob("a.mp4", "videos", bbs)
+    clear_blob_name_cache()
+
+
+class MockProperties:
+    def __init__(self, etag):
+        self.etag = etag
+
+
+class MockBlob:
+    def __init__(self, content, etag):
+        self.content = content
+        self.properties = MockProperties(etag)
+
+
+class MockConfigService:
+    def __init__(self, content, etag):
+        self.blob = MockBlob(content, etag)
+        self.num_downloads = 0
+        self.available = True
+
+    def get_blob_properties(self, container_name, blob_name):
+        if not self.available:
+            raise IOError("timed out")
+        return self.blob
+
+    def get_blob_to_text(self, container_name, blob_name):
+        self.num_downloads += 1
+        return self.blob
+
+
+def test_read_json_cached(tmpdir):
+    """
+    Each version of a blob is downloaded once, and the cached copy is
+    used when storage is unavailable.
+    """
+    bbs = MockConfigService('{"map_width": 10}', '"0x1"')
+    cache_dir = str(tmpdir)
+    data = read_json("10x10.json", "configs", bbs, cache_dir=cache_dir, ttl=0)
+    assert data == {"map_width": 10}
+    # callers get their own copy
+    data["map_width"] = 20
+    data = read_json("10x10.json", "configs", bbs, cache_dir=cache_dir, ttl=0)
+    assert data == {"map_width": 10}
+    assert bbs.num_downloads == 1
+
+    # a new process (on the same host) reads it from disk
+    _json_memo.clear()
+    read_json("10x10.json", "configs", bbs, cache_dir=cache_dir, ttl=0)
+    assert bbs.num_downloads == 1
+
+    bbs.blob = MockBlob('{"map_width": 15}', '"0x2"')
+    data = read_json("10x10.json", "configs", bbs, cache_dir=cache_dir, ttl=0)
+    assert data == {"map_width": 15}
+    assert bbs.num_downloads == 2
+
+    _json_memo.clear()
+    bbs.available = False
+    data = read_json("10x10.json", "configs", bbs, cache_dir=cache_dir, ttl=0)
+    assert data == {"map_width": 15}
+    _json_memo.clear()
+
+
+def test_read_json_memo_bounded(tmpdir, monkeypatch):
+    """
+    Only the most recently read blobs are kept in memory.
+    """
+    monkeypatch.setattr(azure_utils, "CONFIG_MEMO_SIZE", 2)
+    bbs = MockConfigService('{"map_width": 10}', '"0x1"')
+    cache_dir = str(tmpdir)
+    _json_memo.clear()
+    for blob_name in ["a.json", "b.json", "a.json", "c.json"]:
+        read_json(blob_name, "configs", bbs, cache_dir=cache_dir)
+    assert list(_json_memo.keys()) == [
+        ("configs", "a.json"),
+        ("configs", "c.json"),
+    ]
+    _json_memo.clear()
@@ -2,14 +2,49 @@
 Test battleground.py module
 """
 import os
+import time
 import datetime
 import json
 import shutil
 
+import pytest
+
 from battleground.conftest import test_session_scope
-from battleground.battleground import Battleground, Battle
+from battleground.battleground import (
+    Battleground,
+    Battle,
+    parse_ready_message,
+    validate_capabilities,
+    check_queue_prefix,
+    RECORD_REPLAY,
+)
+from battleground.serialization import apply_state_delta
 from battleground.db_utils import create_db_match
 from battleground.schema import Game
+from battleground.rabbitmq_utils import connection_pool
+from battleground.upload_manager import UploadManager
+
+
+@pytest.fixture(autouse=True)
+def upload_manager(tmpdir, monkeypatch):
+    """
+    The battleground's uploads succeed straight away, with a spool in
+    tmpdir, rather than being retried against Azure from the shared
+    default spool.
+    """
+    monkeypatch.setattr(
+        "battleground.upload_manager.write_file_to_blob",
+        lambda file_path, blob_name, container_name, **kwargs: None,
+    )
+    manager = UploadManager(
+        spool_dir=str(tmpdir.join("upload_spool")),
+        num_workers=1,
+        retry_delay=0,
+    )
+    monkeypatch.setattr(
+        "battleground.battleground.get_upload_manager", lambda: manager
+    )
+    return manager
 
 
 def mock_agent_action(battle, agent_type):
@@ -26,6 +61,23 @@ def mock_setup_queues(battle):
     return True
 
 
+class MockUploadManager:
+    """
+    Records the uploads it is given, rather than uploading them.
+    """
+
+    def __init__(self):
+        self.uploads = []
+
+    def submit(
+        self, file_path, blob_name, container_name, delete_after_upload=False
+    ):
+        self.uploads.append((blob_name, container_name))
+
+    def join(self):
+        return []
+
+
 def mock_load_config(blob_name, container_name):
     print("mocking reading json from {} {}".format(blob_name, container_name))
     config_file_path = os.path.join(
@@ -36,6 +88,110 @@ def mock_load_config(blob_name, container_name):
     return json.load(open(config_file_path))
 
 
+def make_battle(monkeypatch, **kwargs):
+    """
+    Create a Battle from the test config, without message queues.
+    """
+    monkeypatch.setattr(
+        "battleground.battleground.Battle.setup_message_queues",
+        mock_setup_queues,
+    )
+    return Battle(mock_load_config("10x10_balanced", "test"), **kwargs)
+
+
+def mock_batch_turns(monkeypatch, replies):
+    """
+    Mock the batch_actions protocol: each request for a turn gets the
+    next list of actions from replies.  A pelican action "bad" is
+    rejected by the game (it doesn't change the action_footprint).
+
+    Returns:
+        asked - moves_remaining of each request
+        performed - the actions applied to the game
+    """
+    asked = []
+    performed = []
+
+    def mock_get_agent_turn(battle, agent_type, moves_remaining):
+        asked.append(moves_remaining)
+        return replies.pop(0)
+
+    def mock_perform_agent_action(battle, agent_type, action):
+        performed.append(action)
+        if action != "bad":
+            battle.pelican_move_in_turn += 1
+
+    monkeypatch.setattr(
+        "battleground.battleground.Battle.get_agent_turn",
+        mock_get_agent_turn,
+    )
+    monkeypatch.setattr(
+        "battleground.battleground.Battle.perform_agent_action",
+        mock_perform_agent_action,
+    )
+    monkeypatch.setattr(
+        "battleground.battleground.Battle.action_footprint",
+        lambda battle, agent_type: battle.pelican_move_in_turn,
+    )
+    return asked, performed
+
+
+class MockDeltaAgent:
+    """
+    An agent using the "state_delta" protocol, which keeps its own copy
+    of the state and asks for a resync when it misses a message.
+    """
+
+    def __init__(self, always_resync=False):
+        self.always_resync = always_resync
+        self.bodies = []
+        self.state = None
+        self.state_seq = None
+
+    def reply(self, body):
+        self.bodies.append(body)
+        if self.always_resync:
+            return "resync"
+        if "state" in body:
+            self.state = body["state"]
+        elif body["state_seq"] != self.state_seq + 1:
+            return "resync"
+        else:
+            self.state = apply_state_delta(self.state, body["state_delta"])
+        self.state_seq = body["state_seq"]
+        return "end"
+
+
+def make_delta_battle(monkeypatch, agent, states):
+    """
+    Create a Battle whose pelican uses the "state_delta" protocol and is
+    answered by agent.  Each request takes the next game state from
+    states.
+    """
+
+    class MockChannel:
+        def basic_publish(self, exchange, routing_key, properties, body):
+            reply = agent.reply(json.loads(body))
+            battle.on_response(None, None, properties, reply.encode())
+
+    battle = make_battle(monkeypatch)
+    monkeypatch.setattr(
+        "battleground.battleground.Battle._state",
+        lambda battle, agent_type: states.pop(0),
+    )
+    monkeypatch.setattr(
+        "battleground.battleground.serialize_state", lambda state: state
+    )
+    battle.agent_capabilities["PELICAN"] = {
+        "state_delta": True,
+        "fields": ["state"],
+    }
+    battle.channel = MockChannel()
+    battle.callback_queue = "callback"
+    battle.routing_keys = {"PELICAN": "rpc_queue_pelican"}
+    return battle
+
+
 def test_create_battleground():
     """
     test that we can create a battleground (Match)
@@ -122,3 +278,462 @@ def test_simple_battle(monkeypatch):
         assert (timenow - game.game_time).days == 0
         assert (timenow - game.game_time).seconds < 5
         assert game.result_code == "BINGO"
+
+
+def test_only_replayable_battles_reseed(monkeypatch):
+    """
+    The global random number generators are only seeded by battles set
+    up for "replay" mode, and other battles can't be played in it.
+    """
+    reseeded = []
+    monkeypatch.setattr(
+        "battleground.battleground.Battle.seed_random",
+        lambda battle, offset: reseeded.append((battle.seed, offset)),
+    )
+    battle = make_battle(monkeypatch)
+    assert reseeded == []
+    with pytest.raises(RuntimeError, match="record_mode='replay'"):
+        battle.play(record_mode=RECORD_REPLAY)
+    replayable = make_battle(monkeypatch, record_mode=RECORD_REPLAY, seed=7)
+    assert reseeded == [(7, 0)]
+    assert replayable.replayable
+
+
+def test_parse_ready_message():
+    """
+    Agents can announce themselves with a plain string, or with a JSON
+    object listing the protocol features they support.
+    """
+    message, capabilities = parse_ready_message(b"PELICAN_READY")
+    assert message == "PELICAN_READY"
+    assert capabilities == {}
+    message, capabilities = parse_ready_message(
+        b'{"ready": "PANTHER_READY", "batch_actions": true}'
+    )
+    assert message == "PANTHER_READY"
+    assert capabilities == {"batch_actions": True}
+
+
+def test_batch_agent_phase(monkeypatch):
+    """
+    An agent using batch_actions has its actions applied in turn.  When
+    one is rejected the rest of the batch is dropped, and the agent is
+    asked again for the rest of its turn.
+    """
+    battle = make_battle(monkeypatch)
+    battle.agent_capabilities["PELICAN"] = {"batch_actions": True}
+    replies = [["1", "bad", "2"], ["3", "end"]]
+    asked, performed = mock_batch_turns(monkeypatch, replies)
+    battle.pelicanPhase()
+    assert performed == ["1", "bad", "3", "end"]
+    assert len(asked) == 2
+    assert asked[1] == asked[0] - 1
+    assert replies == []
+
+
+def test_batch_agent_phase_empty_reply(monkeypatch):
+    """
+    An empty batch ends the agent's turn.
+    """
+    battle = make_battle(monkeypatch)
+    battle.agent_capabilities["PELICAN"] = {"batch_actions": True}
+    asked, performed = mock_batch_turns(monkeypatch, [[]])
+    battle.pelicanPhase()
+    assert performed == ["end"]
+    assert len(asked) == 1
+
+
+def test_get_agent_turn(monkeypatch):
+    """
+    Replies to a "turn" request can be a JSON list of actions, or a
+    single action.
+    """
+    battle = make_battle(monkeypatch)
+    replies = ["[]", "3", "up", '["1", 2]']
+    monkeypatch.setattr(
+        "battleground.battleground.Battle.request_agent",
+        lambda battle, agent_type, **kwargs: replies.pop(0),
+    )
+    assert battle.get_agent_turn("PELICAN", 4) == []
+    assert battle.get_agent_turn("PELICAN", 4) == ["3"]
+    assert battle.get_agent_turn("PELICAN", 4) == ["up"]
+    assert battle.get_agent_turn("PELICAN", 4) == ["1", "2"]
+
+
+def test_agent_timeout(monkeypatch):
+    """
+    If an agent doesn't reply within move_timeout, the timeout is
+    recorded and timeout_action is used instead.
+    """
+
+    class MockChannel:
+        def basic_publish(self, **kwargs):
+            pass
+
+    class MockConnection:
+        def __init__(self):
+            self.time_limits = []
+
+        def process_data_events(self, time_limit=None):
+            # never delivers the reply
+            self.time_limits.append(time_limit)
+            time.sleep(time_limit / 2)
+
+    battle = make_battle(monkeypatch, move_timeout=0.2, timeout_action="end")
+    battle.channel = MockChannel()
+    battle.connection = MockConnection()
+    battle.callback_queue = "callback"
+    battle.routing_keys = {"PELICAN": "rpc_queue_pelican"}
+    start = time.time()
+    reply = battle.send_request("PELICAN", {"game_id": battle.game_id})
+    assert reply == "end"
+    assert battle.timeouts == {"PELICAN": 1, "PANTHER": 0}
+    assert 0.2 <= time.time() - start < 1
+    assert battle.connection.time_limits
+    assert all(0 < limit <= 0.2 for limit in battle.connection.time_limits)
+
+
+def test_validate_capabilities():
+    """
+    Unusable "encoding" and "fields" capabilities are dropped, so the
+    agent gets JSON messages with all the fields.
+    """
+    capabilities = {"encoding": "msgpack", "fields": ["obs"]}
+    assert validate_capabilities("PELICAN_READY", capabilities) == (
+        capabilities
+    )
+    assert (
+        validate_capabilities(
+            "PELICAN_READY",
+            {"encoding": "xml", "fields": "obs", "batch_actions": True},
+        )
+        == {"batch_actions": True}
+    )
+    assert (
+        validate_capabilities(
+            "PANTHER_READY", {"fields": ["obs", "observation"]}
+        )
+        == {}
+    )
+
+
+def test_play_games_in_parallel(monkeypatch, tmpdir):
+    """
+    Games played on several threads (each with its own db session and
+    pooled connection) are all recorded, and don't reseed the random
+    number generators they share.
+    """
+    monkeypatch.setattr(
+        "battleground.battleground.read_json", mock_load_config
+    )
+    monkeypatch.setattr(
+        "battleground.battleground.Battle.setup_message_queues",
+        mock_setup_queues,
+    )
+    monkeypatch.setattr(
+        "battleground.battleground.Battle.get_agent_action",
+        mock_agent_action,
+    )
+    monkeypatch.setattr(
+        "battleground.battleground.get_upload_manager", MockUploadManager
+    )
+    with test_session_scope() as ts:
+        match_id = create_db_match(
+            pelican_agent=None,
+            panther_agent=None,
+            game_config="10x10_balanced",
+            num_games=4,
+            dbsession=ts,
+        )
+        bg = Battleground(
+            match_id=match_id, dbsession=ts, output_dir=str(tmpdir)
+        )
+        bg.setup_games()
+        reseeded = []
+        monkeypatch.setattr(
+            "battleground.battleground.Battle.seed_random",
+            lambda battle, offset: reseeded.append(battle.game_id),
+        )
+        bg.play(num_workers=3, record_mode="none")
+        games = ts.query(Game).filter_by(match_id=match_id).all()
+        assert len(games) == 4
+        assert all(game.result_code == "BINGO" for game in games)
+        assert reseeded == []
+
+
+def test_replay_mode_plays_games_in_turn(monkeypatch, tmpdir):
+    """
+    Games recorded for replay are played one at a time, even if more
+    workers are asked for, as they share the global random state.
+    """
+
+    class MockGame:
+        def wait_for_video(self):
+            pass
+
+    played = []
+
+    def mock_play_game(bg, game_index, game, record_mode, own_session=False):
+        played.append((game_index, own_session))
+
+    monkeypatch.setattr(
+        "battleground.battleground.Battleground.play_game", mock_play_game
+    )
+    monkeypatch.setattr(
+        "battleground.battleground.get_upload_manager", MockUploadManager
+    )
+    with test_session_scope() as ts:
+        match_id = create_db_match(
+            pelican_agent=None,
+            panther_agent=None,
+            game_config="10x10_balanced",
+            num_games=3,
+            dbsession=ts,
+        )
+        bg = Battleground(
+            match_id=match_id, dbsession=ts, output_dir=str(tmpdir)
+        )
+        bg.activeGames = [MockGame() for _ in range(3)]
+        bg.play(num_workers=3, record_mode=RECORD_REPLAY)
+        assert played == [(0, False), (1, False), (2, False)]
+
+
+def test_state_delta_requests(monkeypatch):
+    """
+    The first request of a game carries the full state, and the later
+    ones the changes since the last, with consecutive sequence numbers.
+    """
+    agent = MockDeltaAgent()
+    states = [{"turn": 1, "gone": 0}, {"turn": 2}, {"turn": 3}]
+    battle = make_delta_battle(monkeypatch, agent, list(states))
+    for _ in states:
+        assert battle.get_agent_action("PELICAN") == "end"
+    assert [body["state_seq"] for body in agent.bodies] == [1, 2, 3]
+    assert agent.bodies[0]["state"] == states[0]
+    assert all("state" not in body for body in agent.bodies[1:])
+    assert agent.bodies[1]["state_delta"] == {
+        "changed": {"turn": 2},
+        "removed": ["gone"],
+    }
+    assert agent.state == states[-1]
+
+
+def test_state_delta_resync(monkeypatch):
+    """
+    An agent that sees a gap in the sequence numbers asks for a resync,
+    and the request is sent again with the full state.
+    """
+    agent = MockDeltaAgent()
+    states = [{"turn": 1}, {"turn": 2}, {"turn": 3}, {"turn": 3}]
+    battle = make_delta_battle(monkeypatch, agent, states)
+    assert battle.get_agent_action("PELICAN") == "end"
+    # a request that never reaches the agent
+    battle.build_request("PELICAN")
+    assert battle.get_agent_action("PELICAN") == "end"
+    assert [body["state_seq"] for body in agent.bodies] == [1, 3, 4]
+    assert "state_delta" in agent.bodies[1]
+    assert agent.bodies[2]["state"] == {"turn": 3}
+    assert agent.state == {"turn": 3}
+    assert states == []
+
+
+def test_state_delta_resync_of_full_state(monkeypatch):
+    """
+    Asking for a resync of a full state gets timeout_action, rather than
+    resending the same state.
+    """
+    agent = MockDeltaAgent(always_resync=True)
+    battle = make_delta_battle(monkeypatch, agent, [{"turn": 1}])
+    battle.timeout_action = "end"
+    assert battle.get_agent_action("PELICAN") == "end"
+    assert len(agent.bodies) == 1
+    assert agent.bodies[0]["state"] == {"turn": 1}
+
+
+class MockReadyConnection:
+    """
+    Delivers the given "ready" messages to the consumer in turn, then,
+    if it is still consuming, fires the timeout set with call_later.
+    """
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.timers = []
+        self.is_open = True
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue):
+        self.queue = queue
+
+    def basic_qos(self, prefetch_count):
+        pass
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self.callback = on_message_callback
+
+    def start_consuming(self):
+        self.consuming = True
+        while self.consuming and self.messages:
+            self.callback(self, None, None, self.messages.pop(0))
+        if self.consuming and self.timers:
+            self.timers.pop()()
+
+    def stop_consuming(self):
+        self.consuming = False
+
+    def call_later(self, delay, callback):
+        self.timers.append(callback)
+        return callback
+
+    def remove_timeout(self, timer):
+        self.timers.remove(timer)
+
+    def close(self):
+        pass
+
+
+def listen_for_ready(monkeypatch, messages, **kwargs):
+    """
+    Run Battleground.listen_for_ready with the given "ready" messages.
+
+    Returns:
+        bg - the Battleground
+        connection - the MockReadyConnection it listened on
+    """
+    connection = MockReadyConnection(messages)
+    monkeypatch.setattr(connection_pool, "acquire", lambda: connection)
+    monkeypatch.setattr(connection_pool, "release", lambda connection: None)
+    monkeypatch.setattr("battleground.battleground.time.sleep", lambda s: 0)
+    with test_session_scope() as ts:
+        match_id = create_db_match(
+            pelican_agent=None,
+            panther_agent=None,
+            game_config="dummy",
+            dbsession=ts,
+        )
+        bg = Battleground(match_id=match_id, dbsession=ts)
+        bg.listen_for_ready(**kwargs)
+    return bg, connection
+
+
+def test_check_queue_prefix(monkeypatch):
+    """
+    With a shared broker, agents must confirm this match's QUEUE_PREFIX.
+    """
+    monkeypatch.delenv("QUEUE_PREFIX", raising=False)
+    check_queue_prefix("PELICAN_READY", {})
+    monkeypatch.setenv("QUEUE_PREFIX", "match_3.")
+    check_queue_prefix("PELICAN_READY", {"queue_prefix": "match_3."})
+    with pytest.raises(RuntimeError, match="QUEUE_PREFIX"):
+        check_queue_prefix("PELICAN_READY", {})
+    with pytest.raises(RuntimeError, match="QUEUE_PREFIX"):
+        check_queue_prefix("PELICAN_READY", {"queue_prefix": "match_4."})
+
+
+def test_shared_broker_ready(monkeypatch):
+    """
+    Agents that confirm the prefix are ready, and the timeout is
+    cancelled once they are.
+    """
+    monkeypatch.setenv("QUEUE_PREFIX", "match_3.")
+    bg, connection = listen_for_ready(
+        monkeypatch,
+        [
+            b'{"ready": "PELICAN_READY", "queue_prefix": "match_3."}',
+            b'{"ready": "PANTHER_READY", "queue_prefix": "match_3.", '
+            b'"batch_actions": true}',
+        ],
+    )
+    assert connection.queue == "match_3.rpc_queue_ready"
+    assert bg.pelican_ready and bg.panther_ready
+    assert bg.agent_capabilities["PANTHER"] == {"batch_actions": True}
+    assert connection.timers == []
+
+
+def test_shared_broker_prefix_not_confirmed(monkeypatch):
+    """
+    An agent that doesn't confirm the prefix stops the match straight
+    away.
+    """
+    monkeypatch.setenv("QUEUE_PREFIX", "match_3.")
+    with pytest.raises(RuntimeError, match="PANTHER_READY did not confirm"):
+        listen_for_ready(
+            monkeypatch,
+            [
+                b'{"ready": "PELICAN_READY", "queue_prefix": "match_3."}',
+                b"PANTHER_READY",
+            ],
+        )
+
+
+def test_shared_broker_ready_timeout(monkeypatch):
+    """
+    An agent that never sends its ready message to the prefixed queue
+    (e.g. because it ignores QUEUE_PREFIX) makes the match fail once
+    the timeout expires, rather than hang.
+    """
+    monkeypatch.setenv("QUEUE_PREFIX", "match_3.")
+    with pytest.raises(RuntimeError, match="PANTHER not ready in time"):
+        listen_for_ready(
+            monkeypatch,
+            [b'{"ready": "PELICAN_READY", "queue_prefix": "match_3."}'],
+        )
+
+
+def test_own_broker_waits_for_ready(monkeypatch):
+    """
+    With a broker of its own, the match doesn't need the prefix to be
+    confirmed, and waits for the agents without a timeout.
+    """
+    monkeypatch.delenv("QUEUE_PREFIX", raising=False)
+    bg, connection = listen_for_ready(
+        monkeypatch, [b"PELICAN_READY", b"PANTHER_READY"]
+    )
+    assert connection.queue == "rpc_queue_ready"
+    assert bg.pelican_ready and bg.panther_ready
+    assert connection.timers == []
+
+
+def test_shared_broker_queues_deleted(monkeypatch):
+    """
+    With a shared broker, the match's prefixed queues are deleted once
+    its games are over.  A match with its own broker leaves them.
+    """
+    deleted = []
+
+    class MockQueueConnection:
+        is_open = True
+
+        def channel(self):
+            return self
+
+        def queue_delete(self, queue):
+            deleted.append(queue)
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(
+        connection_pool, "acquire", lambda: MockQueueConnection()
+    )
+    monkeypatch.setattr(connection_pool, "release", lambda connection: None)
+    with test_session_scope() as ts:
+        match_id = create_db_match(
+            pelican_agent=None,
+            panther_agent=None,
+            game_config="dummy",
+            dbsession=ts,
+        )
+        bg = Battleground(match_id=match_id, dbsession=ts)
+        monkeypatch.delenv("QUEUE_PREFIX", raising=False)
+        bg.delete_match_queues()
+        assert deleted == []
+        monkeypatch.setenv("QUEUE_PREFIX", "match_3.")
+        bg.delete_match_queues()
+        assert deleted == [
+            "match_3.rpc_queue_ready",
+            "match_3.rpc_queue_pelican",
+            "match_3.rpc_queue_panther",
+        ]
@@ -1,6 +1,8 @@
 import datetime
+import threading
+
 from battleground.conftest import test_session_scope
-from battleground.schema import Team, Agent, Tournament, Match, Game
+from battleground.schema import Team, Agent, Tournament, Match, Game, session
 
 
 def test_add_team():
@@ -168,3 +170,22 @@ def test_add_match_games():
         nm = tsession.query(Match).order_by(Match.match_id.desc()).first()
         assert nm.is_finished
         assert nm.winner == "panther"
+        assert nm.panther_score == 10
+        # the scores were counted by the db, without loading the games
+        assert "games" not in nm.__dict__
+
+
+def test_session_per_thread():
+    """
+    The default session gives each thread its own session.
+    """
+    sessions = []
+
+    def get_session():
+        sessions.append(session())
+        session.remove()
+
+    thread = threading.Thread(target=get_session)
+    thread.start()
+    thread.join()
+    assert sessions[0] is not session()
@@ -1,9 +1,13 @@
+import datetime
+
 from battleground.conftest import test_session_scope
-from battleground.schema import Team, Agent, Match
+from battleground.schema import Team, Agent, Match, Game, Tournament
 from battleground.db_utils import (
+    bootstrap_tournament,
     create_db_team,
     create_db_agent,
     create_db_match,
+    match_finished,
 )
 
 
@@ -56,3 +60,110 @@ def test_create_match():
         assert isinstance(nm, Match)
         assert nm.pelican_agent.agent_name == "test_team:pelican_agent"
         assert nm.panther_agent.agent_name == "test_team:panther_agent"
+
+
+def test_match_finished():
+    """
+    A match is finished once all its games are in the db
+    """
+    with test_session_scope() as tsession:
+        match_id = create_db_match(
+            pelican_agent=None,
+            panther_agent=None,
+            num_games=2,
+            dbsession=tsession,
+        )
+        assert not match_finished(match_id, dbsession=tsession)
+        for _ in range(2):
+            g = Game()
+            g.game_time = datetime.datetime.now()
+            g.num_turns = 10
+            g.result_code = "ESCAPE"
+            g.video_url = ""
+            g.match_id = match_id
+            tsession.add(g)
+        tsession.commit()
+        assert match_finished(match_id, dbsession=tsession)
+
+
+def test_create_match_check_for_existing():
+    """
+    With check_for_existing, a match between the same agents is reused
+    """
+    with test_session_scope() as tsession:
+        create_db_agent(
+            "test_team:pelican_agent", "pelican", dbsession=tsession
+        )
+        create_db_agent(
+            "test_team:panther_agent", "panther", dbsession=tsession
+        )
+        match_id = create_db_match(
+            pelican_agent="test_team:pelican_agent",
+            panther_agent="test_team:panther_agent",
+            dbsession=tsession,
+        )
+        existing_id = create_db_match(
+            pelican_agent="test_team:pelican_agent",
+            panther_agent="test_team:panther_agent",
+            check_for_existing=True,
+            dbsession=tsession,
+        )
+        nm = tsession.query(Match).filter_by(match_id=existing_id).first()
+        assert nm.pelican_agent.agent_name == "test_team:pelican_agent"
+        assert nm.panther_agent.agent_name == "test_team:panther_agent"
+        assert existing_id <= match_id
+
+
+def test_bootstrap_tournament():
+    """
+    Create the agents, a tournament and its matches in one go
+    """
+    pairings = [
+        ("team_a:pelican_1", "team_b:panther_1"),
+        ("team_b:pelican_1", "team_a:panther_1"),
+    ]
+    with test_session_scope() as tsession:
+        tournament_id, match_ids = bootstrap_tournament(
+            pairings,
+            ["10x10_balanced.json"] * 2,
+            num_games=3,
+            dbsession=tsession,
+        )
+        assert len(match_ids) == len(pairings)
+        tourn = (
+            tsession.query(Tournament)
+            .filter_by(tournament_id=tournament_id)
+            .first()
+        )
+        assert len(tourn.agents) == 4
+        assert len(tourn.matches) == 2
+        for (pelican, panther), match_id in zip(pairings, match_ids):
+            nm = tsession.query(Match).filter_by(match_id=match_id).first()
+            assert nm.pelican_agent.agent_name == pelican
+            assert nm.panther_agent.agent_name == panther
+            assert nm.pelican_agent.agent_type == "pelican"
+            assert nm.num_games == 3
+        # retrying the tournament reuses the agents
+        num_agents = tsession.query(Agent).count()
+        same_id, _ = bootstrap_tournament(
+            pairings[:1],
+            ["10x10_balanced.json"],
+            tournament_id=tournament_id,
+            dbsession=tsession,
+        )
+        assert same_id == tournament_id
+        assert tsession.query(Agent).count() == num_agents
+
+
+def test_bootstrap_tournament_repeated_pairing():
+    """
+    A pairing listed twice gets two matches, each of which is returned
+    """
+    pairings = [("team_a:pelican_1", "team_b:panther_1")] * 2
+    with test_session_scope() as tsession:
+        _, match_ids = bootstrap_tournament(
+            pairings,
+            ["10x10_balanced.json"] * 2,
+            dbsession=tsession,
+        )
+        assert len(set(match_ids)) == 2
@@ -0,0 +1,48 @@
+"""
+Test rabbitmq_utils.py module
+"""
+from battleground.rabbitmq_utils import ConnectionPool, queue_name
+
+
+class MockConnection:
+    def __init__(self):
+        self.is_open = True
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def mock_connect(hostname=None):
+    return MockConnection()
+
+
+def test_queue_name(monkeypatch):
+    """
+    Queue names are prefixed when the broker is shared between matches.
+    """
+    monkeypatch.delenv("QUEUE_PREFIX", raising=False)
+    assert queue_name("rpc_queue_ready") == "rpc_queue_ready"
+    monkeypatch.setenv("QUEUE_PREFIX", "match_3.")
+    assert queue_name("rpc_queue_ready") == "match_3.rpc_queue_ready"
+
+
+def test_connection_pool_reuse(monkeypatch):
+    """
+    Released connections are handed out again, closed ones are not.
+    """
+    monkeypatch.setattr("battleground.rabbitmq_utils.connect", mock_connect)
+    pool = ConnectionPool()
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    # two users at once need two connections
+    second = pool.acquire()
+    assert second is not first
+    pool.release(first)
+    pool.release(second)
+    pool.close_all()
+    assert not first.is_open
+    assert pool.acquire() not in [first, second]
@@ -0,0 +1,102 @@
+"""
+Test serialization.py module
+"""
+import json
+
+import numpy as np
+from plark_game.classes.sonobuoy import Sonobuoy
+from plark_game.classes.torpedo import Torpedo
+
+from battleground.serialization import (
+    SonobuoySchema,
+    TorpedoSchema,
+    serialize_state,
+    encode_message,
+    decode_message,
+    state_delta,
+    apply_state_delta,
+    dump_replay_log,
+    load_replay_log,
+)
+
+
+def test_encode_json():
+    """
+    JSON messages look the same as when the arrays were sent as lists
+    """
+    body = {
+        "state": {"turn": 3, "sonobuoys": []},
+        "obs": np.array([0.5, 1.0, 2.0]),
+        "domain_parameters": [1, 2],
+    }
+    payload, content_type = encode_message(body, "json")
+    assert content_type == "application/json"
+    assert json.loads(payload) == {
+        "state": {"turn": 3, "sonobuoys": []},
+        "obs": [0.5, 1.0, 2.0],
+        "domain_parameters": [1, 2],
+    }
+
+
+def test_encode_msgpack_round_trip():
+    """
+    msgpack messages carry the arrays as raw float32/int32 buffers
+    """
+    body = {
+        "state": {"turn": 3, "panther_col": None},
+        "obs": np.array([[1, 2], [3, 4]]),
+        "obs_normalised": np.array([0.25, 0.5]),
+    }
+    payload, content_type = encode_message(body, "msgpack")
+    assert content_type == "application/msgpack"
+    decoded = decode_message(payload, "msgpack")
+    assert decoded["state"] == {"turn": 3, "panther_col": None}
+    assert decoded["obs"].dtype == np.int32
+    assert decoded["obs"].shape == (2, 2)
+    assert np.array_equal(decoded["obs"], body["obs"])
+    assert decoded["obs_normalised"].dtype == np.float32
+    assert np.allclose(decoded["obs_normalised"], [0.25, 0.5])
+
+
+def test_state_delta_round_trip():
+    """
+    Applying a delta to the previous state gives the new state
+    """
+    previous = {"turn": 1, "pelican_col": 2, "torpedoes": [], "gone": 0}
+    current = {"turn": 2, "pelican_col": 2, "torpedoes": [{"col": 1}]}
+    delta = state_delta(previous, current)
+    assert delta["changed"] == {"turn": 2, "torpedoes": [{"col": 1}]}
+    assert delta["removed"] == ["gone"]
+    assert apply_state_delta(previous, delta) == current
+
+
+def test_serialize_matches_marshmallow():
+    """
+    The direct conversion of Sonobuoys and Torpedos gives the same
+    output as dumping them with the marshmallow schemas
+    """
+    sb = Sonobuoy(3)
+    sb.col = 2
+    sb.row = 5
+    t = Torpedo(id="t1", col=1, row=2, turn=0, speed=[2, 1])
+    state = {"turn": 1, "sonobuoys": [sb], "torpedoes": [t], "col": None}
+    output = serialize_state(state)
+    assert output["sonobuoys"] == [SonobuoySchema().dump(sb)]
+    assert output["torpedoes"] == [TorpedoSchema().dump(t)]
+    assert output["turn"] == 1
+    assert output["col"] is None
+
+
+def test_replay_log_round_trip(tmp_path):
+    """
+    Replay logs are written as gzipped JSON and read back unchanged
+    """
+    replay_log = {
+        "game_id": "1_0",
+        "seed": 1234,
+        "game_config": {"game_settings": {"maximum_turns": 40}},
+        "actions": [["PELICAN", "1"], ["PELICAN", "end"], ["PANTHER", "3"]],
+    }
+    file_path = str(tmp_path / "game.mp4.replay.json.gz")
+    dump_replay_log(replay_log, file_path)
+    assert load_replay_log(file_path) == replay_log
@@ -1,7 +1,7 @@
 """
 """
 
-from tournament.tournament import get_match_config_file
+from tournament.tournament import ConfigIndex, get_match_config_file
 
 
 def test_get_match_config_file():
@@ -9,3 +9,37 @@ def test_get_match_config_file():
     file = get_match_config_file()
 
     assert file is not None
+
+
+def test_config_index(monkeypatch):
+    """
+    The config container is listed once, and the choice of config is
+    reproducible from the seed.
+    """
+    listings = []
+
+    def mock_list_directory(path, container_name):
+        listings.append(container_name)
+        return [
+            "2021_03_01_10x10_a.json",
+            "2021_03_01_10x10_b.json",
+            "2021_03_01_15x15_a.json",
+            "default_10x10_a.json",
+            "10x10_balanced.json",
+        ]
+
+    monkeypatch.setattr(
+        "tournament.tournament.list_directory", mock_list_directory
+    )
+    index = ConfigIndex(seed=42)
+    choices = [index.choose("10x10", "2021_03_01") for _ in range(20)]
+    assert set(choices) == {
+        "2021_03_01_10x10_a.json",
+        "2021_03_01_10x10_b.json",
+    }
+    assert index.choose("10x10", "2021_03_02") == "default_10x10_a.json"
+    assert index.choose("20x20", "2021_03_02") == "10x10_balanced.json"
+    assert len(listings) == 1
+
+    index = ConfigIndex(seed=42)
+    assert [index.choose("10x10", "2021_03_01") for _ in range(20)] == choices
@@ -0,0 +1,146 @@
+"""
+Test upload_manager.py module
+"""
+import os
+import threading
+
+from battleground import upload_manager
+from battleground.upload_manager import UploadManager
+
+
+def test_upload_retried_and_spool_cleared(tmpdir, monkeypatch):
+    """
+    Failed uploads are retried, and the spool entry (and the file, if
+    asked) are removed once done.
+    """
+    attempts = []
+
+    def flaky_write(file_path, blob_name, container_name, **kwargs):
+        attempts.append(blob_name)
+        if len(attempts) < 3:
+            raise IOError("connection reset")
+
+    monkeypatch.setattr(upload_manager, "write_file_to_blob", flaky_write)
+    artifact = tmpdir.join("game.mp4")
+    artifact.write("video")
+    spool_dir = str(tmpdir.mkdir("spool"))
+    manager = UploadManager(spool_dir=spool_dir, retry_delay=0)
+    manager.submit(
+        str(artifact), "game.mp4", "videos", delete_after_upload=True
+    )
+    assert manager.join() == []
+    assert attempts == ["game.mp4"] * 3
+    assert os.listdir(spool_dir) == []
+    assert not artifact.exists()
+
+
+def test_uploaded_file_kept_by_default(tmpdir, monkeypatch):
+    """
+    Files submitted without delete_after_upload are left in place.
+    """
+    monkeypatch.setattr(
+        upload_manager,
+        "write_file_to_blob",
+        lambda file_path, blob_name, container_name, **kwargs: None,
+    )
+    artifact = tmpdir.join("game.mp4")
+    artifact.write("video")
+    spool_dir = str(tmpdir.mkdir("spool"))
+    manager = UploadManager(spool_dir=spool_dir)
+    manager.submit(str(artifact), "game.mp4", "videos")
+    assert manager.join() == []
+    assert os.listdir(spool_dir) == []
+    assert artifact.read() == "video"
+
+
+def test_failed_upload_resumed(tmpdir, monkeypatch):
+    """
+    Uploads that give up stay in the spool, and are picked up by the
+    next UploadManager that starts.
+    """
+
+    def failing_write(file_path, blob_name, container_name, **kwargs):
+        raise IOError("storage unavailable")
+
+    monkeypatch.setattr(upload_manager, "write_file_to_blob", failing_write)
+    artifact = tmpdir.join("match.log")
+    artifact.write("log")
+    spool_dir = str(tmpdir.mkdir("spool"))
+    manager = UploadManager(spool_dir=spool_dir, max_attempts=2, retry_delay=0)
+    manager.submit(str(artifact), "match.log", "logfiles")
+    assert len(manager.join()) == 1
+    assert len(os.listdir(spool_dir)) == 1
+
+    uploaded = []
+    monkeypatch.setattr(
+        upload_manager,
+        "write_file_to_blob",
+        lambda file_path, blob_name, container_name, **kwargs: uploaded.append(
+            (blob_name, container_name)
+        ),
+    )
+    restarted = UploadManager(spool_dir=spool_dir)
+    restarted.start()
+    assert restarted.join() == []
+    assert uploaded == [("match.log", "logfiles")]
+    assert os.listdir(spool_dir) == []
+
+
+def test_shared_spool_not_resumed_while_in_progress(tmpdir, monkeypatch):
+    """
+    A battleground sharing the spool directory doesn't resume uploads
+    that another one is still working on.
+    """
+    release = threading.Event()
+    uploaded = []
+
+    def slow_write(file_path, blob_name, container_name, **kwargs):
+        release.wait(10)
+        uploaded.append(blob_name)
+
+    monkeypatch.setattr(upload_manager, "write_file_to_blob", slow_write)
+    artifact = tmpdir.join("game.mp4")
+    artifact.write("video")
+    spool_dir = str(tmpdir.mkdir("spool"))
+    manager = UploadManager(spool_dir=spool_dir)
+    manager.submit(str(artifact), "game.mp4", "videos")
+
+    other = UploadManager(spool_dir=spool_dir)
+    other.start()
+    assert other.jobs.unfinished_tasks == 0
+
+    release.set()
+    assert manager.join() == []
+    assert uploaded == ["game.mp4"]
+    assert os.listdir(spool_dir) == []
+
+
+def test_submit_skips_spool_file_claimed_elsewhere(tmpdir, monkeypatch):
+    """
+    If another battleground locks a new spool file first, the upload is
+    queued once, under a spool file of our own.
+    """
+    uploaded = []
+    monkeypatch.setattr(
+        upload_manager,
+        "write_file_to_blob",
+        lambda file_path, blob_name, container_name, **kwargs: uploaded.append(
+            blob_name
+        ),
+    )
+    artifact = tmpdir.join("game.mp4")
+    artifact.write("video")
+    spool_dir = str(tmpdir.mkdir("spool"))
+    manager = UploadManager(spool_dir=spool_dir)
+    claim = manager._claim
+    claimed = []
+
+    def lose_first_claim(spool_path):
+        claimed.append(spool_path)
+        return len(claimed) > 1 and claim(spool_path)
+
+    monkeypatch.setattr(manager, "_claim", lose_first_claim)
+    manager.submit(str(artifact), "game.mp4", "videos")
+    assert manager.join() == []
+    assert uploaded == ["game.mp4"]
+    assert len(claimed) == 2 and claimed[0] != claimed[1]
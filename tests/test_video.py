@@ -0,0 +1,78 @@
+"""
+Test video.py module
+"""
+import pytest
+import imageio
+import PIL.Image
+
+from battleground.video import VideoWriter
+
+
+def make_frame(colour):
+    return PIL.Image.new("RGB", (100, 50), colour)
+
+
+def test_video_written_and_callback_fired(tmpdir):
+    """
+    close() and wait() finish the video file, then on_finished is called
+    with its path.
+    """
+    video_file_path = str(tmpdir.join("game.mp4"))
+    finished = []
+    writer = VideoWriter(
+        video_file_path, base_width=64, on_finished=finished.append
+    )
+    for colour in ["red", "green", "blue"]:
+        writer.add_frame(make_frame(colour))
+    writer.close()
+    writer.wait()
+    assert finished == [video_file_path]
+    reader = imageio.get_reader(video_file_path)
+    try:
+        assert reader.count_frames() == 3
+        assert reader.get_meta_data()["size"] == (64, 32)
+    finally:
+        reader.close()
+
+
+def test_worker_error_reaches_caller(tmpdir):
+    """
+    An exception raised by on_finished is re-raised by wait().
+    """
+
+    def fail(video_file_path):
+        raise IOError("disk full")
+
+    writer = VideoWriter(
+        str(tmpdir.join("game.mp4")),
+        base_width=64,
+        on_finished=fail,
+    )
+    writer.add_frame(make_frame("red"))
+    writer.close()
+    with pytest.raises(IOError, match="disk full"):
+        writer.wait()
+
+
+def test_encoding_error_reaches_caller(tmpdir, monkeypatch):
+    """
+    A frame that can't be encoded fails the video, and the frames queued
+    after it are still consumed, so add_frame() doesn't block.
+    """
+
+    def bad_resize(image, base_width):
+        raise ValueError("bad frame")
+
+    monkeypatch.setattr("battleground.video.resize_frame", bad_resize)
+    finished = []
+    writer = VideoWriter(
+        str(tmpdir.join("game.mp4")),
+        max_queued_frames=1,
+        on_finished=finished.append,
+    )
+    for colour in ["red", "green", "blue"]:
+        writer.add_frame(make_frame(colour))
+    writer.close()
+    with pytest.raises(ValueError, match="bad frame"):
+        writer.wait()
+    assert finished == []
@@ -9,13 +9,15 @@ import logging
 from datetime import date, datetime
 import time
 import random
+import glob
+import shutil
+import queue
+import threading
 
 from battleground.azure_config import config as az_config
 from battleground.azure_utils import list_directory
 from battleground.db_utils import (
-    create_db_agent,
-    create_db_tournament,
-    create_db_match,
+    bootstrap_tournament,
     match_finished,
 )
 
@@ -32,11 +34,29 @@ CONST_GITHUB_ADDRESS = (
     + "alan-turing-institute/rl_tournament/main/teams/"
 )
 CONST_DOCKER_COMPOSE_TEMPLATE = "docker-compose-template.yml"
+# used when all the matches share one long-lived RabbitMQ broker
+CONST_SHARED_BROKER_TEMPLATE = "docker-compose-shared-broker-template.yml"
+CONST_BROKER_DOCKER_COMPOSE = "docker-compose-broker.yml"
+CONST_BROKER_PROJECT = "plark_broker"
 CONST_TOURNAMENT_FILE = "/tmp/tournament.txt"
-CONST_TEMP_DOCKER_COMPOSE = "/tmp/docker-compose.yml"
+# each match gets its own working directory and compose project
+CONST_MATCH_DIR = "/tmp/plark_match_{}"
+CONST_COMPOSE_PROJECT = "plark_match_{}"
+CONST_DOCKER_COMPOSE_FILE = "docker-compose.yml"
+CONST_MATCH_LOG_FILE = "docker-compose.log"
+# resources needed by one match (battleground, two agents and RabbitMQ),
+# used to work out how many matches can run at once
+CONST_CPUS_PER_MATCH = 3
+CONST_MEMORY_PER_MATCH_GB = 4
+# the scheduler is woken up as soon as a match's battleground exits, but
+# also checks the docker-compose processes this often (in seconds), in
+# case an exit is missed
+CONST_MATCH_CHECK_INTERVAL = 60
 CONST_DEFAULT_MATCH_CONFIG_FILE = "10x10_balanced.json"
 
 CONST_DEFAULT_MAP_SIZE = "10x10"
+# seconds between listings of the config container during a tournament
+CONST_CONFIG_REFRESH_INTERVAL = 600
 
 
 def get_team_repository_tags(team_name):
@@ -61,7 +81,7 @@ def get_team_repository_tags(team_name):
 
 def create_tournament(test_run=False, map_size=CONST_DEFAULT_MAP_SIZE):
     """
-    Creates a tournament file.
+    Creates a tournament file, listing the pairings of agents.
 
     """
 
@@ -135,87 +155,319 @@ def create_tournament(test_run=False, map_size=CONST_DEFAULT_MAP_SIZE):
     logging.info(
         "Tournament file %s has been created." % (CONST_TOURNAMENT_FILE)
     )
-    # add the teams and tournament to the database
+    # the agents, tournament and matches are added to the database
+    # together by run_tournament
 
-    for agent in pelicans:
-        create_db_agent(agent, "pelican")
-    for agent in panthers:
-        create_db_agent(agent, "panther")
-    tournament_id = create_db_tournament(pelicans + panthers)
-    return tournament_id
 
+class ConfigIndex:
+    """
+    The config files in the config container, indexed by day and map
+    size, so that choosing a config for each match doesn't list the
+    whole container.
+
+    Config file names start with the day they are for (YYYY_MM_DD) or
+    with "default", and contain the map size (e.g. 10x10).  The listing
+    is refreshed at most every refresh_interval seconds, and the random
+    choice between candidate configs is reproducible from the seed.
+    """
+
+    def __init__(
+        self, refresh_interval=CONST_CONFIG_REFRESH_INTERVAL, seed=None
+    ):
+        self.refresh_interval = refresh_interval
+        self.rng = random.Random(seed)
+        self.configs_list = []
+        # day (or "default") -> config files
+        self.by_day = {}
+        # (day, map_size) -> config files
+        self.candidates = {}
+        self.last_refresh = None
+
+    def refresh(self, force=False):
+        """
+        List the config container, if it hasn't been listed in the
+        last refresh_interval seconds.
+        """
+        if (
+            not force
+            and self.last_refresh is not None
+            and time.time() - self.last_refresh < self.refresh_interval
+        ):
+            return
+        container_name = az_config["config_container_name"]
+        self.configs_list = sorted(list_directory("", container_name))
+        self.by_day = {}
+        self.candidates = {}
+        for config_file in self.configs_list:
+            if config_file.startswith("default"):
+                day = "default"
+            else:
+                day = config_file[: len("YYYY_MM_DD")]
+            self.by_day.setdefault(day, []).append(config_file)
+        self.last_refresh = time.time()
+        logging.info("Total number of configs: %d" % (len(self.configs_list)))
+
+    def get_candidates(self, day, map_size):
+        """
+        Config files for the day (or "default") and map size.
+        """
+        key = (day, map_size)
+        if key not in self.candidates:
+            self.candidates[key] = [
+                config_file
+                for config_file in self.by_day.get(day, [])
+                if config_file.startswith(day) and map_size in config_file
+            ]
+        return self.candidates[key]
+
+    def choose(self, map_size=CONST_DEFAULT_MAP_SIZE, day=None):
+        """
+        Choose a config file for the day, falling back to the default
+        ones.
+
+        Returns:
+            the name of a config file, or None if there are none
+        """
+        self.refresh()
+
+        if day is None:
+            current_day = date.today().strftime("%Y_%m_%d")
+        else:
+            current_day = day
+
+        if len(self.configs_list) == 0:
+            logging.info("Could not find any configurations.")
+            return None
+
+        sel_configs = self.get_candidates(current_day, map_size)
+
+        logging.info(
+            "Total number of configs (%s) for the day: %d"
+            % (map_size, len(sel_configs))
+        )
+
+        if len(sel_configs) == 0:
+            logging.info(
+                "Could not find any %s " % (map_size)
+                + "configuration for today. Using default ones."
+            )
+            sel_configs = self.get_candidates("default", map_size)
+
+        if len(sel_configs) == 0:
+            logging.info(
+                "Could not find a list of default configurations, will use: %s"
+                % (CONST_DEFAULT_MATCH_CONFIG_FILE)
+            )
+            if CONST_DEFAULT_MATCH_CONFIG_FILE in self.configs_list:
+                return CONST_DEFAULT_MATCH_CONFIG_FILE
+            return None
+
+        return self.rng.choice(sel_configs)
 
-def get_match_config_file(map_size=CONST_DEFAULT_MAP_SIZE, day=None):
+
+# used by get_match_config_file when not given an index
+_config_index = None
+
+
+def get_match_config_file(
+    map_size=CONST_DEFAULT_MAP_SIZE, day=None, config_index=None
+):
     """
     Looks for a config file depending on the curent day. If a match file
         for the current day cannot be found, a default will be used.
 
+    Arguments:
+        config_index - the ConfigIndex to choose from (default: one
+            shared by all calls)
+
     Returns:
-        a list of files in the matches container
+        the name of a file in the config container
     """
+    global _config_index
 
-    config_file_name = None
+    if config_index is None:
+        if _config_index is None:
+            _config_index = ConfigIndex()
+        config_index = _config_index
 
-    if day is None:
-        current_day = date.today().strftime("%Y_%m_%d")
-    else:
-        current_day = day
+    config_file_name = config_index.choose(map_size=map_size, day=day)
 
-    logging.info("Looking for a config file for: %s" % (current_day))
+    logging.info("For %s will use %s" % (day or "today", config_file_name))
 
-    path = ""
-    container_name = az_config["config_container_name"]
+    return config_file_name
 
-    configs_list = list_directory(path, container_name)
 
-    if len(configs_list) == 0:
-        logging.info("Could not find any configurations.")
-        return config_file_name
+def get_total_memory_gb():
+    """
+    Total physical memory of this host, in GB.
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
 
-    logging.info("Total number of configs: %d" % (len(configs_list)))
 
-    sel_configs = []
+def get_max_parallel_matches(
+    cpu_budget=None,
+    memory_budget_gb=None,
+    cpus_per_match=CONST_CPUS_PER_MATCH,
+    memory_per_match_gb=CONST_MEMORY_PER_MATCH_GB,
+):
+    """
+    Work out how many matches can run at the same time within the
+    given CPU and memory budgets.
 
-    for config_file in configs_list:
-        if config_file.startswith(current_day) and map_size in config_file:
-            sel_configs.append(config_file)
+    Arguments:
+        cpu_budget - number of CPUs the tournament may use
+            (default: all the CPUs on this host)
+        memory_budget_gb - memory, in GB, the tournament may use
+            (default: all the memory on this host)
+        cpus_per_match - CPUs needed by one match
+        memory_per_match_gb - memory, in GB, needed by one match
 
-    logging.info(
-        "Total number of configs (%s) for the day: %d"
-        % (map_size, len(sel_configs))
+    Returns:
+        max_parallel - number of matches to run at once (at least 1)
+    """
+
+    if cpu_budget is None:
+        cpu_budget = os.cpu_count() or 1
+    if memory_budget_gb is None:
+        memory_budget_gb = get_total_memory_gb()
+
+    max_parallel = min(
+        int(cpu_budget // cpus_per_match),
+        int(memory_budget_gb // memory_per_match_gb),
     )
+    return max(1, max_parallel)
 
-    if len(sel_configs) == 0:
-        logging.info(
-            "Could not find any %s " % (map_size)
-            + "configuration for today. Using default ones."
-        )
 
-        for config_file in configs_list:
-            if config_file.startswith("default") and map_size in config_file:
-                sel_configs.append(config_file)
+def docker_compose(args, match_dir, match_id, no_sudo=False, log_file=None):
+    """
+    Run a docker-compose command for a match.  Each match has its own
+    compose project name (and hence its own containers and network)
+    and its own working directory, so several can run at once.
 
-        logging.info(
-            "Total number of default %s configs: %d"
-            % (map_size, len(sel_configs))
-        )
+    Arguments:
+        args - docker-compose arguments, e.g. ["up"]
+        match_dir - working directory containing the match's
+            docker-compose.yml
+        match_id - id of the match in the database
+        no_sudo - don't use sudo for docker commands
+        log_file - if given, run in the background, sending the output
+            to this file
 
-    if len(sel_configs) == 0:
-        logging.info(
-            "Could not find a list of default configurations, will use: %s"
-            % (CONST_DEFAULT_MATCH_CONFIG_FILE)
-        )
+    Returns:
+        the CompletedProcess, or the Popen object for background commands
+    """
 
-        for config_file in configs_list:
-            if config_file == CONST_DEFAULT_MATCH_CONFIG_FILE:
-                config_file_name = config_file
-                break
-    else:
-        config_file_name = random.choice(sel_configs)
+    command = [
+        "docker-compose",
+        "-p",
+        CONST_COMPOSE_PROJECT.format(match_id),
+    ] + args
+    if not no_sudo:
+        command = ["sudo"] + command
+    if log_file is None:
+        return subprocess.run(command, cwd=match_dir)
+    return subprocess.Popen(
+        command, cwd=match_dir, stdout=log_file, stderr=subprocess.STDOUT
+    )
 
-    logging.info("For %s will use %s" % (current_day, config_file_name))
 
-    return config_file_name
+def start_match(match_id, pelican, panther, template, no_sudo=False):
+    """
+    Write the docker-compose file for a match into its own working
+    directory, and bring the match up in the background.
+
+    Returns:
+        match_dir - the working directory of the match
+    """
+
+    match_dir = CONST_MATCH_DIR.format(match_id)
+    os.makedirs(match_dir, exist_ok=True)
+
+    # prepare yaml file
+    match_yaml = template
+    match_yaml = match_yaml.replace("<<PELICAN>>", pelican)
+    match_yaml = match_yaml.replace("<<PANTHER>>", panther)
+    match_yaml = match_yaml.replace("<<MATCH_ID>>", str(match_id))
+
+    compose_path = os.path.join(match_dir, CONST_DOCKER_COMPOSE_FILE)
+    logging.info("writing docker-compose file: %s", compose_path)
+    # write docker-compose
+    with open(compose_path, "w") as file:
+        file.write(match_yaml)
+
+    logging.info("docker-compose pull (match %d)" % (match_id))
+    docker_st = time.time()
+    docker_compose(["pull"], match_dir, match_id, no_sudo)
+    logging.info("docker-compose pull took %d s." % (time.time() - docker_st))
+
+    logging.info("docker-compose up (match %d)" % (match_id))
+    log_file = open(os.path.join(match_dir, CONST_MATCH_LOG_FILE), "w")
+    # the battleground exits once it has played all the games, and
+    # --exit-code-from then stops the other containers and makes
+    # "up" return, so the end of the process marks the end of the match
+    up_process = docker_compose(
+        ["up", "--exit-code-from", "battleground"],
+        match_dir,
+        match_id,
+        no_sudo,
+        log_file=log_file,
+    )
+    log_file.close()
+
+    return match_dir, up_process
+
+
+def watch_match(match_id, up_process, events):
+    """
+    Wait (on a background thread) for a match's docker-compose process
+    to exit, then put (match_id, exit code) on the events queue.
+    """
+
+    def wait():
+        events.put((match_id, up_process.wait()))
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    return thread
+
+
+def stop_match(match_id, match_dir, no_sudo=False):
+    """
+    Bring down the containers and network of a match.
+    """
+
+    logging.info("docker-compose down (match %d)" % (match_id))
+    docker_st = time.time()
+    docker_compose(["down"], match_dir, match_id, no_sudo)
+    time.sleep(3)
+    # run this again, to make sure we remove the network
+    docker_compose(["down"], match_dir, match_id, no_sudo)
+    logging.info("docker-compose down took %d s." % (time.time() - docker_st))
+
+
+def shared_broker(command, no_sudo=False):
+    """
+    Bring the shared RabbitMQ broker up or down.
+
+    Arguments:
+        command - "up" or "down"
+        no_sudo - don't use sudo for docker commands
+    """
+
+    path = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    compose_path = os.path.join(path, CONST_BROKER_DOCKER_COMPOSE)
+
+    command = [
+        "docker-compose",
+        "-p",
+        CONST_BROKER_PROJECT,
+        "-f",
+        compose_path,
+    ] + (["up", "-d"] if command == "up" else ["down"])
+    if not no_sudo:
+        command = ["sudo"] + command
+    logging.info("shared broker: %s" % (" ".join(command)))
+    subprocess.run(command)
 
 
 def run_tournament(
@@ -225,9 +477,24 @@ def run_tournament(
     day=None,
     no_sudo=False,
     test_run=False,
+    max_parallel_matches=None,
+    use_shared_broker=False,
+    seed=None,
 ):
     """
-    Runs the tournament by running multiple docker-compose files
+    Runs the tournament by running multiple docker-compose files,
+    up to max_parallel_matches at a time.  All the matches are added to
+    the database (along with any new agents) before the first one runs.
+
+    Arguments:
+        tournament_id - id of the tournament to add the matches to, or
+            None to create a new one
+        max_parallel_matches - how many matches to run at once
+            (default: as many as get_max_parallel_matches allows)
+        use_shared_broker - if True, start one RabbitMQ broker for the
+            whole tournament, rather than one per match
+        seed - random seed for choosing the match configs, so that
+            the same configs are chosen when the tournament is re-run
 
     Returns:
         success - flag whether the tournament was executed successfully
@@ -239,7 +506,10 @@ def run_tournament(
 
     path = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
-    template_path = os.path.join(path, CONST_DOCKER_COMPOSE_TEMPLATE)
+    if use_shared_broker:
+        template_path = os.path.join(path, CONST_SHARED_BROKER_TEMPLATE)
+    else:
+        template_path = os.path.join(path, CONST_DOCKER_COMPOSE_TEMPLATE)
 
     with open(template_path, "r") as file:
         template = file.read()
@@ -250,108 +520,134 @@ def run_tournament(
     no_matches = len(matches)
     logging.info("The tournament will have %d match(es)" % (no_matches))
 
-    for match_idx, match in enumerate(matches):
+    if max_parallel_matches is None:
+        max_parallel_matches = get_max_parallel_matches()
+    logging.info("Running up to %d match(es) at once" % (max_parallel_matches))
+
+    if test_run:
+        time_limit = 120
+    else:
+        time_limit = 1800
 
-        # get a match config file for the day
-        config_file_name = get_match_config_file(map_size=map_size, day=day)
+    pairings = [tuple(match.split()) for match in matches]
 
+    # choose a match config file for the day for each pairing, listing
+    # the config container once rather than for every match
+    config_index = ConfigIndex(seed=seed)
+    config_file_names = []
+    for _ in pairings:
+        config_file_name = get_match_config_file(
+            map_size=map_size, day=day, config_index=config_index
+        )
         if config_file_name is None:
             print("Could not find a match config file.")
-            break
-
-        logging.info("Running match %d/%d" % (match_idx + 1, no_matches))
+            success = False
+            error = "Could not find a match config file."
+            return success, error
+        config_file_names.append(config_file_name)
 
-        match_yaml = template
+    # register the agents, tournament and all the matches at once
+    try:
+        tournament_id, match_ids = bootstrap_tournament(
+            pairings,
+            config_file_names,
+            num_games=num_games_per_match,
+            tournament_id=tournament_id,
+        )
+    except RuntimeError as e:
+        success = False
+        error = "cannot create the matches: %s" % (e)
+        return success, error
 
-        pelican, panther = match.split()
+    logging.info("tournament_id: %d" % (tournament_id))
 
-        # register new match
-        try:
-            # create the match in the database
-            match_id = create_db_match(
-                pelican,
-                panther,
-                game_config=config_file_name,
-                num_games=num_games_per_match,
-                tournament_id=tournament_id,
-            )
+    if use_shared_broker:
+        shared_broker("up", no_sudo)
 
-        except RuntimeError:
-            match_id = None
+    pending = list(enumerate(pairings))
+    # match_id -> (match_dir, docker-compose process, start time)
+    running = {}
+    # (match_id, exit code) of matches whose docker-compose has exited
+    events = queue.Queue()
 
-        if match_id is None:
-            error += "%s - %s resulted into an error: %s" % (
-                pelican,
-                panther,
-                "cannot obtain match_id",
-            )
-            success = False
-            break
+    while pending or running:
 
-        logging.info("match_id: %d" % (match_id))
+        # start new matches while we have capacity
+        while pending and len(running) < max_parallel_matches:
 
-        # prepare yaml file
-        match_yaml = match_yaml.replace("<<PELICAN>>", pelican)
-        match_yaml = match_yaml.replace("<<PANTHER>>", panther)
-        match_yaml = match_yaml.replace("<<MATCH_ID>>", str(match_id))
+            match_idx, (pelican, panther) = pending.pop(0)
 
-        logging.info(
-            "writing docker-compose file: %s", CONST_TEMP_DOCKER_COMPOSE
-        )
-        # write docker-compose
-        with open(CONST_TEMP_DOCKER_COMPOSE, "w") as file:
-            file.write(match_yaml)
+            logging.info("Running match %d/%d" % (match_idx + 1, no_matches))
 
-        cwd = os.getcwd()
+            match_id = match_ids[match_idx]
 
-        logging.info("chdir /tmp")
-        os.chdir("/tmp")
+            logging.info("match_id: %d" % (match_id))
 
-        logging.info("docker-compose pull")
-        docker_st = time.time()
-        command = ["docker-compose", "pull"]
-        if not no_sudo:
-            command = ["sudo"] + command
-        subprocess.run(command)
-        logging.info(
-            "docker-compose pull took %d s." % (time.time() - docker_st)
-        )
+            match_dir, up_process = start_match(
+                match_id, pelican, panther, template, no_sudo
+            )
+            running[match_id] = (match_dir, up_process, time.time())
+            watch_match(match_id, up_process, events)
 
-        docker_st = time.time()
-        logging.info("docker-compose up")
-        command = ["docker-compose", "up"]
-        if not no_sudo:
-            command = ["sudo"] + command
-        subprocess.Popen(command)
+        if not running:
+            continue
 
-        if test_run:
-            time_limit = 120
-        else:
-            time_limit = 1800
-
-        while (time.time() - docker_st) < time_limit:
+        # sleep until a match exits, or the next one runs out of time
+        next_deadline = min(st for _, _, st in running.values()) + time_limit
+        timeout = min(
+            max(next_deadline - time.time(), 0), CONST_MATCH_CHECK_INTERVAL
+        )
+        try:
+            exited = [events.get(timeout=timeout)]
+        except queue.Empty:
+            exited = []
+        while not events.empty():
+            exited.append(events.get())
+
+        to_stop = []
+        for match_id, exit_code in exited:
+            if match_id not in running:
+                # already stopped after running out of time
+                continue
             if match_finished(match_id):
-                logging.info("Match took %d s." % (time.time() - docker_st))
-                break
+                logging.info(
+                    "Match %d took %d s."
+                    % (match_id, time.time() - running[match_id][2])
+                )
             else:
-                logging.info("Match is still running. Sleep(5)")
-                time.sleep(5)
-
-        logging.info("docker-compose down")
-        docker_st = time.time()
-        command = ["docker-compose", "down"]
-        if not no_sudo:
-            command = ["sudo"] + command
-        subprocess.run(command)
-        time.sleep(3)
-        # run this again, to make sure we remove the network
-        subprocess.run(command)
-        logging.info(
-            "docker-compose down took %d s." % (time.time() - docker_st)
-        )
+                logging.info(
+                    "Match %d exited (code %s) before finishing."
+                    % (match_id, exit_code)
+                )
+            to_stop.append(match_id)
+
+        # a match whose battleground is still running may have recorded
+        # all its games but still be uploading their videos and logfile,
+        # so it is only stopped early if its docker-compose process has
+        # exited without us hearing about it, or on the time limit
+        for match_id, (match_dir, up_process, docker_st) in running.items():
+            if match_id in to_stop:
+                continue
+            if up_process.poll() is not None:
+                logging.info(
+                    "Match %d exited (code %s)."
+                    % (match_id, up_process.returncode)
+                )
+            elif (time.time() - docker_st) >= time_limit:
+                logging.info("Match %d ran out of time." % (match_id))
+            else:
+                continue
+            to_stop.append(match_id)
+
+        for match_id in to_stop:
+            stop_match(match_id, running[match_id][0], no_sudo)
+            del running[match_id]
+
+        if running:
+            logging.info("%d match(es) still running." % (len(running)))
 
-        logging.info("chdir %s", cwd)
-        os.chdir(cwd)
+    if use_shared_broker:
+        shared_broker("down", no_sudo)
 
     return success, error
 
@@ -363,10 +659,8 @@ def clean_up():
 
     os.remove(CONST_TOURNAMENT_FILE)
 
-    try:
-        os.remove(CONST_TEMP_DOCKER_COMPOSE)
-    except FileNotFoundError:
-        print("no need to delete %s" % (CONST_TEMP_DOCKER_COMPOSE))
+    for match_dir in glob.glob(CONST_MATCH_DIR.format("*")):
+        shutil.rmtree(match_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -414,6 +708,39 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "--max_parallel_matches",
+        help="""
+        Number of matches to run at once.  By default this is worked out
+        from the CPU and memory budgets.
+        """,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--cpu_budget",
+        help="number of CPUs the tournament may use (default: all)",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--memory_budget_gb",
+        help="memory in GB the tournament may use (default: all)",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--shared_broker",
+        help="use one RabbitMQ broker for all the matches",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--seed",
+        help="random seed for choosing the match configs",
+        type=int,
+    )
+
     parser.add_argument(
         "--test_run",
         help="Tournament test run",
@@ -431,15 +758,24 @@ if __name__ == "__main__":
     if test_run:
         num_games_per_match = 1
 
+    max_parallel_matches = args.max_parallel_matches
+    if max_parallel_matches is None:
+        max_parallel_matches = get_max_parallel_matches(
+            cpu_budget=args.cpu_budget,
+            memory_budget_gb=args.memory_budget_gb,
+        )
+
     # If we already have a tournament_id (i.e. we're retrying one)
     # Note that this will use /tmp/tournament.txt - this needs to
     # be edited if we only want to run e.g. the last part of a tournament
     if args.tournament_id:
         tid = args.tournament_id
     else:
-        # create a new tournament using CONST_TEAMS_LIST and the txt files
-        # in the repo, in the normal way
-        tid = create_tournament(test_run=test_run, map_size=map_size)
+        # create a new tournament file using CONST_TEAMS_LIST and the txt
+        # files in the repo, in the normal way - run_tournament then
+        # creates the tournament in the database
+        create_tournament(test_run=test_run, map_size=map_size)
+        tid = None
 
     success, error = run_tournament(
         tid,
@@ -448,6 +784,9 @@ if __name__ == "__main__":
         day=tour_day,
         no_sudo=no_sudo,
         test_run=test_run,
+        max_parallel_matches=max_parallel_matches,
+        use_shared_broker=args.shared_broker,
+        seed=args.seed,
     )
 
     clean_up()